@@ -1,16 +1,29 @@
 import os
 import time
 
-from src.parser.grammar import unpickle_grammar, pickle_grammar, write_grammar_to_files
+from src.parser.compiled_grammar import compile_grammar, load_compiled_grammar
+from src.parser.grammar import pickle_grammar, write_grammar_to_files
 from src.parser.models import NP1VC2HC
+from src.parser.parse_cache import ParseCache
 from src.util.split_corpus import generate_corpus_in_bounds
 from src.util.tree.builders import node_tree_from_sequence
 from src.util.tree.get_yield import get_yield
 from src.util.tree.treebank import read_corpus
 
 override_existing_run = True
+# Also store the packed parse forests of every length bucket, for consumers which shouldn't re-parse
+write_forest_stores = False
+# Number of processes to train and to parse with
+train_processes = 1
+parse_processes = 1
 train_path = "../data/heb-ctrees.train"
 gold_path = "../data/heb-ctrees.gold"
+# Persistent cache of parses shared by all runs (see ParseCache), so unchanged models don't re-parse unchanged buckets.
+# None to always parse.
+parse_cache_path = "../output/parse_cache.sqlite"
+# Seconds every decoding stage may take per sentence before falling back to a faster one (see
+# ParserModel.decode_with_fallback), None for no limit
+sentence_budget = 60.0
 
 if __name__ == '__main__':
     model_list = [NP1VC2HC()]
@@ -20,18 +33,23 @@ if __name__ == '__main__':
         model_name = model.__class__.__name__
         model_out_dir_name = "../output/{}/".format(model_name)
         pkl_path = model_out_dir_name + "{}_grammar.pkl".format(model_name)
+        compiled_path = model_out_dir_name + "{}_grammar.compiled".format(model_name)
         print("Running {} :".format(model_name))
         if not os.path.isdir(model_out_dir_name):
             os.mkdir(model_out_dir_name)
-        if not os.path.isfile(pkl_path):
+        if not os.path.isdir(compiled_path):
             print("Training Model : ")
             corpus = read_corpus(gold_path)
-            model.train(corpus)
+            model.train(corpus, processes=train_processes)
             pickle_grammar(model.grammar, pkl_path)
             write_grammar_to_files(model.grammar, *map(
                 lambda ftype: model_out_dir_name + "{}.{}".format(model_name, ftype), ("gram", "lex")))
-        else:
-            model.grammar = unpickle_grammar(pkl_path)
+            compile_grammar(model.grammar, compiled_path)
+        # Decode with the compiled grammar, memory mapped and shared by parsing processes
+        model.grammar = load_compiled_grammar(compiled_path)
+        if parse_cache_path is not None:
+            model.parse_cache = ParseCache(parse_cache_path)
+        model.sentence_budget = sentence_budget
         for min_len, max_len in len_bounds_list:
             out_path = model_out_dir_name + "{}_{}-{}.txt".format(model_name, min_len, max_len)
             if not override_existing_run and os.path.isfile(out_path):
@@ -41,5 +59,8 @@ if __name__ == '__main__':
             clean_sentences = [list(map(lambda node: node.tag, get_yield(node_tree_from_sequence(sent)))) for sent in
                                gold_corp]
             st = time.monotonic()
-            model.write_parse(clean_sentences, out_path, versbose=True)
+            model.write_parse(clean_sentences, out_path, versbose=True, processes=parse_processes)
             print("Total time : {} \n".format(time.monotonic() - st))
+            if write_forest_stores:
+                model.write_forests(clean_sentences, model_out_dir_name + "{}_{}-{}.forest".format(
+                    model_name, min_len, max_len))
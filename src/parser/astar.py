@@ -0,0 +1,232 @@
+import heapq
+from typing import List, Tuple, Dict, Iterator, Optional
+
+from math import inf
+
+import numpy as np
+
+from src.parser.cky import init_chart, check_deadline, DecodeFailure, UNARY_SPLIT
+from src.parser.grammar import ProbGrammar, ScoredLhsList, child_groups
+from src.util.tree.node import Node
+
+
+# Number of items popped from the agenda between checks of the deadline
+_DEADLINE_CHECK_POPS = 256
+
+
+class AgendaStats:
+    """
+    Counts of agenda operations and chart entries built, accumulated over all decoded sentences.
+    """
+
+    def __init__(self):
+        self.sentence_count = 0
+        self.pushed = 0
+        self.popped = 0
+        self.built = 0
+
+    def __str__(self):
+        return "{} sentences : {} items pushed, {} popped, {} chart entries built".format(
+            self.sentence_count, self.pushed, self.popped, self.built)
+
+
+def astar_parse(grammar: ProbGrammar, sentence: List[str], include_unary=False, stats: AgendaStats = None,
+                deadline: float = None) -> Node:
+    """
+    Agenda based exact Viterbi parsing (A*) : chart items are finalized in order of their inside score plus an
+    admissible and consistent estimate of their outside score, and decoding stops as soon as a start symbol spanning
+    the whole sentence is finalized. Yields the same most probable parse as cky, usually building a small fraction
+    of the chart.
+
+    The outside estimate of a symbol over a span is the larger of two admissible and consistent estimates :
+    1. The grammar's context summary estimate of the symbol (see ProbGrammar.context_summary_estimates), plus the best
+       lexical rule cost of every word outside the span.
+    2. The Viterbi outside score of the symbol's projection over the span, under the grammar's optimistic projection
+       (see ProbGrammar.optimistic_projection), when the sentence can be parsed by it.
+    :param grammar: The probabilistic grammar to use.
+    :param sentence: A sentence of lexical tokens separated by white space.
+    :param include_unary: True if to support unary rules in run, False otherwise.
+    :param stats: Statistics to update, if any.
+    :param deadline: Time to stop decoding at, checked every _DEADLINE_CHECK_POPS popped items (see cky.check_deadline).
+                     None for no deadline.
+    :return: Most probable parse tree for given sentence.
+    """
+    n = len(sentence)
+    binary_rules = grammar.binary_rule_index()
+    binary_rules_by_right = grammar.binary_rule_index(by_right_child=True)
+    unary_closure = grammar.unary_closure()
+    chart, symbol_ids = init_chart(grammar, sentence, include_unary)
+    _, context_outside = grammar.context_summary_estimates()
+    # Symbols missing from the grammar (UNK) can't be part of a derivation
+    context_outside = np.append(context_outside, [inf] * (len(chart.tags) - context_outside.size)).tolist()
+    start_ids = {symbol_ids[ss] for ss in grammar.start_symbols if ss in symbol_ids}
+
+    # Lexical outside estimate of every span : sum of the best lexical rule costs of the words outside it
+    lexical_costs = [_best_lexical_cost(grammar, word) for word in sentence]
+    prefix_costs = np.concatenate(([0.0], np.cumsum(lexical_costs))).tolist()
+
+    projected = grammar.optimistic_projection()
+    projection_outside = _projection_outside_estimates(projected.grammar, sentence)
+    symbol_projection = projected.symbol_projection.tolist()
+
+    def __estimate(span_length: int, span_start: int, symbol_id: int) -> float:
+        estimate = context_outside[symbol_id] + prefix_costs[n] - (prefix_costs[span_start + span_length] -
+                                                                   prefix_costs[span_start])
+        if projection_outside is None or estimate == inf:
+            return estimate
+        return max(estimate, projection_outside.item(span_length, span_start, symbol_projection[symbol_id]))
+
+    agenda: List[Tuple[float, float, int, int, int]] = []
+    pushed = popped = 0
+
+    def __push(span_length: int, span_start: int, symbol_id: int, minus_log_prob: float):
+        nonlocal pushed
+        estimate = __estimate(span_length, span_start, symbol_id)
+        if estimate < inf:
+            heapq.heappush(agenda, (minus_log_prob + estimate, minus_log_prob, span_length, span_start, symbol_id))
+            pushed += 1
+
+    finished = np.zeros(chart.scores.shape, dtype=bool)
+    # Finished items by the position their span starts at and ends at : span length -> symbol id -> inside score
+    finished_by_start: List[Dict[int, Dict[int, float]]] = [dict() for _ in range(n + 1)]
+    finished_by_end: List[Dict[int, Dict[int, float]]] = [dict() for _ in range(n + 1)]
+
+    for j in range(n):
+        for symbol_id in np.flatnonzero(chart.scores[1, j] < inf).tolist():
+            __push(1, j, symbol_id, chart.scores[1, j, symbol_id])
+
+    root = None
+    while agenda:
+        _, minus_log_prob, span_length, span_start, symbol_id = heapq.heappop(agenda)
+        # Skip items already finished, or pushed before their score was improved
+        if finished[span_length, span_start, symbol_id] or minus_log_prob > chart.scores[
+                span_length, span_start, symbol_id]:
+            continue
+        finished[span_length, span_start, symbol_id] = True
+        popped += 1
+        if popped % _DEADLINE_CHECK_POPS == 0:
+            check_deadline(deadline, chart)
+        if span_length == n and symbol_id in start_ids:
+            root = symbol_id
+            break
+        span_end = span_start + span_length
+
+        # Unary chains over the item
+        if include_unary:
+            for lhs, chain_minus_log_prob in unary_closure.ancestors.get(symbol_id, ()):
+                if chain_minus_log_prob + minus_log_prob < chart.scores[span_length, span_start, lhs]:
+                    chart.set_entry(span_length, span_start, lhs, chain_minus_log_prob + minus_log_prob, UNARY_SPLIT,
+                                    symbol_id)
+                    __push(span_length, span_start, lhs, chain_minus_log_prob + minus_log_prob)
+
+        # The item as a left child, with finished items to it's right
+        for right_length, right_items in finished_by_start[span_end].items():
+            for right_id, right_minus_log_prob, rules in _pair(binary_rules.get(symbol_id, {}), right_items):
+                for lhs, rule_minus_log_prob in rules:
+                    rule_prob = minus_log_prob + right_minus_log_prob + rule_minus_log_prob
+                    if rule_prob < chart.scores[span_length + right_length, span_start, lhs]:
+                        chart.set_entry(span_length + right_length, span_start, lhs, rule_prob, span_length,
+                                        symbol_id, right_id)
+                        __push(span_length + right_length, span_start, lhs, rule_prob)
+        # The item as a right child, with finished items to it's left
+        for left_length, left_items in finished_by_end[span_start].items():
+            for left_id, left_minus_log_prob, rules in _pair(binary_rules_by_right.get(symbol_id, {}), left_items):
+                for lhs, rule_minus_log_prob in rules:
+                    rule_prob = left_minus_log_prob + minus_log_prob + rule_minus_log_prob
+                    if rule_prob < chart.scores[left_length + span_length, span_start - left_length, lhs]:
+                        chart.set_entry(left_length + span_length, span_start - left_length, lhs, rule_prob,
+                                        left_length, left_id, symbol_id)
+                        __push(left_length + span_length, span_start - left_length, lhs, rule_prob)
+
+        finished_by_start[span_start].setdefault(span_length, dict())[symbol_id] = minus_log_prob
+        finished_by_end[span_end].setdefault(span_length, dict())[symbol_id] = minus_log_prob
+
+    if stats is not None:
+        stats.sentence_count += 1
+        stats.pushed += pushed
+        stats.popped += popped
+        stats.built += np.count_nonzero(chart.scores < inf)
+    if root is None:
+        raise DecodeFailure("No start symbol spans the sentence", chart)
+    return chart.build_tree(n, 0, root)
+
+
+def _pair(rules_by_sibling: Dict[int, ScoredLhsList], siblings: Dict[int, float]) -> \
+        Iterator[Tuple[int, float, ScoredLhsList]]:
+    """
+    Iterate the finished siblings an item has rules with, scanning the smaller of the two sides.
+    :return: An iterator of (sibling id, sibling's inside score, rules deriving the item and the sibling).
+    """
+    if len(rules_by_sibling) <= len(siblings):
+        return ((sibling, siblings[sibling], rules) for sibling, rules in rules_by_sibling.items() if
+                sibling in siblings)
+    return ((sibling, score, rules_by_sibling[sibling]) for sibling, score in siblings.items() if
+            sibling in rules_by_sibling)
+
+
+def _best_lexical_cost(grammar: ProbGrammar, word: str) -> float:
+    """
+    Minimal minus log probability of a lexical rule deriving a word (by signature for unknown words, see
+    ProbGrammar.lexical_rules). Words having no lexical rules at all are tagged at no cost.
+    """
+    return min((minus_log_prob for _, minus_log_prob in grammar.lexical_rules(word)), default=0.0)
+
+
+def _projection_outside_estimates(coarse: ProbGrammar, sentence: List[str]) -> Optional[np.ndarray]:
+    """
+    Compute the Viterbi outside score of every symbol over every span of a sentence under a coarse grammar, taken over
+    entries before and after applying unary chains (the smaller of the two).
+    :return: Outside scores (minus log probabilities), indexed by (span length, span start, symbol id), or None if the
+             sentence has no parse under the coarse grammar.
+    """
+    n = len(sentence)
+    symbols, symbol_ids = coarse.non_terminal_index()
+    rules = coarse.binary_rule_arrays()
+    closure = coarse.unary_closure_arrays()
+    by_lhs, by_left, by_right = child_groups(rules.lhs), child_groups(rules.left), child_groups(rules.right)
+    closure_by_lhs, closure_by_descendant = child_groups(closure.lhs), child_groups(closure.left)
+    shape = (n + 1, n, len(symbols))
+
+    # Viterbi inside scores, after applying unary chains
+    inside = np.full(shape, inf)
+    for j, word in enumerate(sentence):
+        lexical_rules = coarse.lexical_rules(word)
+        if not lexical_rules:
+            return None
+        for lhs_id, minus_log_prob in lexical_rules:
+            inside[1, j, lhs_id] = minus_log_prob
+    _min_into(inside[1], inside[1][:, closure.left] + closure.minus_log_probs, closure_by_lhs)
+    for span_length in range(2, n + 1):
+        starts = n - span_length + 1
+        cells = inside[span_length, 0:starts]
+        for partition in range(1, span_length):
+            _min_into(cells, inside[partition, 0:starts][:, rules.left] + rules.minus_log_probs +
+                      inside[span_length - partition, partition:partition + starts][:, rules.right], by_lhs)
+        _min_into(cells, cells[:, closure.left] + closure.minus_log_probs, closure_by_lhs)
+
+    start_ids = [symbol_ids[ss] for ss in coarse.start_symbols if ss in symbol_ids]
+    if not start_ids or inside[n, 0, start_ids].min() == inf:
+        return None
+    # Viterbi outside scores : of entries after applying unary chains, and then (in place) of entries before
+    outside = np.full(shape, inf)
+    outside[n, 0, start_ids] = 0.0
+    for span_length in range(n, 0, -1):
+        starts = n - span_length + 1
+        cells = outside[span_length, 0:starts]
+        _min_into(cells, cells[:, closure.lhs] + closure.minus_log_probs, closure_by_descendant)
+        for partition in range(1, span_length):
+            parent_scores = cells[:, rules.lhs] + rules.minus_log_probs
+            _min_into(outside[partition, 0:starts], parent_scores +
+                      inside[span_length - partition, partition:partition + starts][:, rules.right], by_left)
+            _min_into(outside[span_length - partition, partition:partition + starts], parent_scores +
+                      inside[partition, 0:starts][:, rules.left], by_right)
+    return outside
+
+
+def _min_into(cells: np.ndarray, rule_scores: np.ndarray, groups):
+    """
+    Lower the scores of cells (rows) by symbol, to the best score of the rules (columns) grouped by the symbol.
+    """
+    order, group_ids, group_starts = groups
+    cells[:, group_ids] = np.minimum(cells[:, group_ids], np.minimum.reduceat(rule_scores[:, order], group_starts,
+                                                                             axis=1))
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+from math import inf
+
+import numpy as np
+
+from src.parser.grammar import ProbGrammar
+
+# The entries of a filled chart cell (see CkyChart) : their symbol ids, scores and backpointers
+CachedCell = NamedTuple("CachedCell", [("symbols", np.ndarray), ("scores", np.ndarray), ("splits", np.ndarray),
+                                       ("left", np.ndarray), ("right", np.ndarray)])
+# A cell's key : the words of it's span, whether the span starts (ends) the sentence, and whether unary rules are
+# applied. With no pruning, these determine the cell's entries, and the entries of all cells below it.
+CellKey = Tuple[Tuple[str, ...], bool, bool, bool]
+
+
+class ChartCache:
+    """
+    An LRU cache of filled chart cells shared by the sentences decoded with cky (see cky's cache argument), for spans
+    of up to max_span_length words. Sentences often repeat the same short word sequences, whose cells are then seeded
+    from the cache rather than filled again. A cell's backpointers lead to cells of shorter spans of the same words,
+    which are filled (or seeded) the same way in every sentence, so decoded trees are unchanged.
+    Cells are kept while their total size (of their arrays, in bytes) is at most max_bytes, evicting the least
+    recently used first. The cache is emptied whenever the grammar decoded with changes.
+    Counts of hits, misses and evicted cells are accumulated over all decoded sentences.
+    """
+
+    def __init__(self, max_span_length: int = 4, max_bytes: int = 64 * 2 ** 20):
+        self.max_span_length = max_span_length
+        self.max_bytes = max_bytes
+        self.cells: "OrderedDict[CellKey, CachedCell]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The rule index of the grammar cells were filled with, rebuilt by the grammar whenever it changes
+        self._rule_index = None
+
+    def start_sentence(self, grammar: ProbGrammar):
+        """
+        Called before decoding every sentence, emptying the cache if the grammar changed since the last one.
+        """
+        rule_index = grammar.binary_rule_index()
+        if rule_index is not self._rule_index:
+            self.clear()
+            self._rule_index = rule_index
+
+    def seed(self, chart, span_length: int, span_start: int, key: CellKey) -> bool:
+        """
+        Seed a chart cell with the cached cell of a key, if any.
+        :param chart: The chart (a CkyChart).
+        :return: True if the cell was cached (and is now filled).
+        """
+        cell = self.cells.get(key)
+        if cell is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        self.cells.move_to_end(key)
+        entries = span_length, span_start, cell.symbols
+        chart.scores[entries] = cell.scores
+        chart.splits[entries] = cell.splits
+        chart.left[entries] = cell.left
+        chart.right[entries] = cell.right
+        return True
+
+    def store(self, chart, span_length: int, span_start: int, key: CellKey):
+        """
+        Cache a filled chart cell, evicting least recently used cells as needed.
+        :param chart: The chart (a CkyChart).
+        """
+        symbols = np.flatnonzero(chart.scores[span_length, span_start] < inf)
+        entries = span_length, span_start, symbols
+        cell = CachedCell(symbols, chart.scores[entries], chart.splits[entries], chart.left[entries],
+                          chart.right[entries])
+        cell_bytes = sum(array.nbytes for array in cell)
+        if cell_bytes > self.max_bytes:
+            return
+        previous: Optional[CachedCell] = self.cells.pop(key, None)
+        if previous is not None:
+            self.nbytes -= sum(array.nbytes for array in previous)
+        self.cells[key] = cell
+        self.nbytes += cell_bytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.cells.popitem(last=False)
+            self.nbytes -= sum(array.nbytes for array in evicted)
+            self.evictions += 1
+
+    def clear(self):
+        self.cells.clear()
+        self.nbytes = 0
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return "Chart cache : {} hits of {} lookups ({:.1%}), {} cells cached ({:.1f} MB), {} evicted".format(
+            self.hits, lookups, self.hits / lookups if lookups else 0.0, len(self.cells), self.nbytes / 2 ** 20,
+            self.evictions)
@@ -0,0 +1,160 @@
+from typing import Dict, Iterable, List, Tuple
+
+from math import inf
+
+import numpy as np
+
+from src.parser.grammar import ProbGrammar
+from src.parser.pruning import CellPruning
+from src.util.tree.node import Node
+
+# Padding words before and after a sentence, as context features of it's first and last words
+_SENTENCE_START = "<s>"
+_SENTENCE_END = "</s>"
+# Number of letters of the prefix and suffix features
+_AFFIX_LENGTH = 2
+
+
+class BoundaryClassifier:
+    """
+    A linear time tagger predicting, for every word of a sentence, whether a constituent of several words begins
+    there, and whether one ends there. Two logistic regressions over features of a window of words around every word
+    (see _word_features), trained on the spans of a treebank's trees.
+    """
+
+    def __init__(self, iterations: int = 100, learning_rate: float = 0.5, l2: float = 1e-6):
+        self.iterations = iterations
+        self.learning_rate = learning_rate
+        self.l2 = l2
+        # Feature id of every feature seen in training. Id 0 stands for unseen features, and has no weight.
+        self.feature_ids: Dict[str, int] = dict()
+        # Weights of every feature id, for beginning (column 0) and ending (column 1) a constituent
+        self.weights: np.ndarray = np.zeros((1, 2))
+
+    def train(self, trees: Iterable[Node]):
+        """
+        Fit the classifier to the constituents of trees (as decoded, e.g. binarized) : the words every constituent
+        spanning several words begins and ends at.
+        """
+        rows, labels = [], []
+        for tree in trees:
+            words, begins, ends = constituent_boundaries(tree)
+            for features in _word_features(words):
+                rows.append([self.feature_ids.setdefault(feature, len(self.feature_ids) + 1) for feature in features])
+            labels.extend(zip(begins, ends))
+        if not rows:
+            return
+        features = np.array(rows, dtype=np.int64)
+        labels = np.array(labels, dtype=np.float64)
+        feature_count = len(self.feature_ids) + 1
+        # Full batch gradient descent on the mean log loss, with per weight (AdaGrad) learning rates
+        self.weights = np.zeros((feature_count, 2))
+        squared_gradients = np.zeros((feature_count, 2))
+        for _ in range(self.iterations):
+            errors = self._probabilities(features) - labels
+            gradients = np.stack([np.bincount(features.ravel(), np.repeat(errors[:, column], features.shape[1]),
+                                              feature_count) for column in range(2)], axis=1) / len(labels)
+            gradients += self.l2 * self.weights
+            gradients[0] = 0.0
+            squared_gradients += gradients ** 2
+            self.weights -= self.learning_rate * gradients / (np.sqrt(squared_gradients) + 1e-8)
+
+    def predict(self, words: List[str]) -> np.ndarray:
+        """
+        Probabilities of beginning (column 0) and ending (column 1) a constituent of several words, by word.
+        """
+        features = np.array([[self.feature_ids.get(feature, 0) for feature in word_features] for word_features in
+                             _word_features(words)], dtype=np.int64).reshape(len(words), -1)
+        return self._probabilities(features)
+
+    def _probabilities(self, features: np.ndarray) -> np.ndarray:
+        return 1.0 / (1.0 + np.exp(-self.weights[features].sum(axis=1)))
+
+
+class ChartConstraints(CellPruning):
+    """
+    Chart constraints : a boundary classifier (see BoundaryClassifier), trained along with the model on it's
+    transformed training trees, predicts the words a constituent of several words may begin or end at. Cells of spans
+    beginning or ending elsewhere are closed, and never filled (see CellPruning.cell_open).
+    A word is closed when it's probability of beginning (ending) a constituent is below boundary_threshold, so lower
+    thresholds close fewer cells at a higher recall of the treebank's constituents.
+    Beam, threshold and cap pruning (see CellPruning) can be applied on top.
+    Counts of closed cells are accumulated over all decoded sentences.
+    """
+
+    def __init__(self, boundary_threshold: float = 0.05, beam_width: int = None, threshold: float = None,
+                 max_entries: int = None, classifier: BoundaryClassifier = None):
+        super().__init__(beam_width, threshold, max_entries)
+        self.boundary_threshold = boundary_threshold
+        self.classifier = BoundaryClassifier() if classifier is None else classifier
+        # Whether a constituent of several words may begin (ends) at every word of the sentence decoded
+        self.begins: List[bool] = []
+        self.ends: List[bool] = []
+        self.cell_count = 0
+        self.closed_count = 0
+
+    def train(self, trees: Iterable[Node]):
+        self.classifier.train(trees)
+
+    def start_sentence(self, grammar: ProbGrammar, sentence: List[str]):
+        open_words = self.classifier.predict(sentence) >= self.boundary_threshold
+        self.begins = open_words[:, 0].tolist()
+        self.ends = open_words[:, 1].tolist()
+        n = len(sentence)
+        # Cells of spans of several words, except the span of the whole sentence
+        self.cell_count += (n - 1) * n // 2 - 1 if n > 1 else 0
+        self.closed_count += sum(1 for span_length in range(2, n) for span_start in range(0, n - span_length + 1) if
+                                 not self.cell_open(span_length, span_start))
+
+    def cell_open(self, span_length: int, span_start: int) -> bool:
+        if span_length == 1 or span_length == len(self.begins):
+            return True
+        return self.begins[span_start] and self.ends[span_start + span_length - 1]
+
+    def prune_derived(self, span_length: int, span_start: int, cell_scores: np.ndarray):
+        # Decoders filling cells regardless of cell_open (as the vectorized ones) get their closed cells emptied
+        for row in range(cell_scores.shape[0]):
+            if not self.cell_open(span_length, span_start + row):
+                cell_scores[row] = inf
+        super().prune_derived(span_length, span_start, cell_scores)
+
+    def __str__(self):
+        return "{}, closed {} of {} chart cells ({:.1%})".format(
+            super().__str__(), self.closed_count, self.cell_count,
+            self.closed_count / self.cell_count if self.cell_count else 0.0)
+
+
+def constituent_boundaries(tree: Node) -> Tuple[List[str], List[bool], List[bool]]:
+    """
+    The words of a tree, and for every word whether a constituent spanning several words begins or ends at it.
+    """
+    words: List[str] = []
+    begins: List[bool] = []
+    ends: List[bool] = []
+
+    def __visit(node: Node):
+        if not node.children:
+            words.append(node.tag)
+            begins.append(False)
+            ends.append(False)
+            return
+        start = len(words)
+        for child in node.children:
+            __visit(child)
+        if len(words) - start > 1:
+            begins[start] = True
+            ends[-1] = True
+
+    __visit(tree)
+    return words, begins, ends
+
+
+def _word_features(words: List[str]) -> List[List[str]]:
+    """
+    Features of every word of a sentence : a bias, the word, it's neighbours, the bigrams it's in, and it's prefix
+    and suffix.
+    """
+    padded = [_SENTENCE_START] + words + [_SENTENCE_END]
+    return [["b", "w=" + word, "p=" + previous, "n=" + following, "pw=" + previous + " " + word,
+             "wn=" + word + " " + following, "x=" + word[:_AFFIX_LENGTH], "s=" + word[-_AFFIX_LENGTH:]]
+            for previous, word, following in zip(padded, padded[1:], padded[2:])]
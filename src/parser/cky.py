@@ -1,112 +1,477 @@
 import copy
+import time
 from typing import NamedTuple, Dict, Tuple, List, Type
 
 from math import inf, sqrt
 
-from src.parser.grammar import ProbGrammar, write_grammar_to_files, pickle_grammar, unpickle_grammar, precolate_grammar
-from src.parser.parser_model import ParserModel
-from src.parser.symbol import Symbol, MultiSymbol, Terminal, NonTerminal
+import numpy as np
+
+from src.parser.chart_cache import ChartCache
+from src.parser.grammar import ProbGrammar, RuleArrays, UnaryClosure, write_grammar_to_files, pickle_grammar, unpickle_grammar, precolate_grammar
+from src.parser.pruning import CellPruning
+from src.parser.symbol import Symbol, NonTerminal
 from src.parser.pipeline import TreeTransformationPipeline, GrammarTransformationPipeline
 from src.util.tree.builders import node_tree_from_sequence
-from src.util.tree.cnf import binarization, revert_binarization
+from src.util.tree.cnf import binarization, revert_binarization, brother_separator
 from src.util.tree.get_yield import get_yield
 from src.util.tree.node import Node
 from src.util.tree.treebank import read_corpus
 from src.util.tree.writer import write_tree
 
 # TODO : Move elsewhere.
-# For simplicity, unseen tokens shall be marked as NN
+# For simplicity, unseen tokens the grammar has no signature rules for (see lexicon.py) shall be marked as NN
 # Possible improvement : HMM\MEMM with some smoothing?
 UNK_SYMBOL = NonTerminal("NN")
 
+# Root of parses stitched from a chart's partial constituents, and of flat parses (see partial_parse, flat_parse) : the
+# constituent spanning most sentences of the treebank
+PARTIAL_PARSE_ROOT = NonTerminal("S")
+
 CkyTableEntry = NamedTuple("CkyTableEntry", [("node", Node), ("minus_log_prob", float)])
 
+# Backpointer split values of entries not derived by a binary rule
+LEXICAL_SPLIT = -1
+UNARY_SPLIT = 0
+
+
+class DecodeFailure(Exception):
+    """
+    Raised by a decoder failing to parse a sentence, as when no start symbol spans it, with the chart it filled (None
+    for decoders having none). Cells of the chart hold the best derivations found of their spans, so it's partial
+    constituents may still be used (see partial_parse).
+    """
+
+    def __init__(self, message: str, chart: "CkyChart" = None):
+        super().__init__(message)
+        self.chart = chart
+
+
+class DecodeTimeout(DecodeFailure):
+    """
+    Raised by a decoder which passed it's deadline, with the chart filled so far.
+    """
+    pass
+
+
+def check_deadline(deadline: float, chart: "CkyChart" = None):
+    """
+    Raise DecodeTimeout if a deadline (in time.monotonic seconds, None for no deadline) has passed.
+    """
+    if deadline is not None and time.monotonic() > deadline:
+        raise DecodeTimeout("Deadline passed", chart)
+
+
+class CkyChart:
+    """
+    A CKY chart held in preallocated arrays indexed by (span length, span start, non-terminal id).
+    Every entry keeps the best minus log probability found so far and a backpointer to the derivation achieving it :
+    the split point (partition) and the ids of the left and right children. Lexical and unary entries are marked
+    by LEXICAL_SPLIT and UNARY_SPLIT. A unary entry is derived by a chain of unary rules, and keeps the chain's bottom
+    symbol as the left child. The intermediate symbols are recovered from the unary chains given.
+    Trees are built only once decoding is done, by following the backpointers from the chosen root entry.
+    If keep_derived, the scores of entries derived by lexical or binary rules (before applying unary chains) are kept
+    as well, as needed for extracting more than the best derivation (see kbest.py).
+    """
+
+    def __init__(self, sentence: List[str], symbols: List[Symbol],
+                 unary_chains: Dict[Tuple[int, int], Tuple[int, ...]] = None, keep_derived=False):
+        n = len(sentence)
+        shape = (n + 1, n, len(symbols))
+        self.sentence = sentence
+        self.tags = [sym.symbol_string for sym in symbols]
+        self.unary_chains = unary_chains if unary_chains is not None else dict()
+        self.scores = np.full(shape, inf)
+        self.splits = np.full(shape, LEXICAL_SPLIT, dtype=np.int16)
+        self.left = np.full(shape, -1, dtype=np.int32)
+        self.right = np.full(shape, -1, dtype=np.int32)
+        self.derived_scores = np.full(shape, inf) if keep_derived else None
+
+    def keep_derived(self, span_length: int, span_start: int, starts: int = 1):
+        """
+        Keep the current scores of a batch of cells as their derived scores, if these are kept.
+        """
+        if self.derived_scores is not None:
+            self.derived_scores[span_length, span_start:span_start + starts] = \
+                self.scores[span_length, span_start:span_start + starts]
+
+    def set_entry(self, span_length: int, span_start: int, symbol_id: int, minus_log_prob: float, split: int,
+                  left_id: int = -1, right_id: int = -1):
+        entry = span_length, span_start, symbol_id
+        self.scores[entry] = minus_log_prob
+        self.splits[entry] = split
+        self.left[entry] = left_id
+        self.right[entry] = right_id
+
+    def build_tree(self, span_length: int, span_start: int, symbol_id: int) -> Node:
+        """
+        Build the parse tree of the best derivation of an entry.
+        """
+        entry = span_length, span_start, symbol_id
+        split = self.splits[entry]
+        if split == LEXICAL_SPLIT:
+            children = [Node(self.sentence[span_start])]
+        elif split == UNARY_SPLIT:
+            node = self.build_tree(span_length, span_start, self.left[entry])
+            for symbol in reversed(self.unary_chains.get((symbol_id, self.left[entry]), ())):
+                node = Node(self.tags[symbol], [node])
+            children = [node]
+        else:
+            children = [self.build_tree(split, span_start, self.left[entry]),
+                        self.build_tree(span_length - split, span_start + split, self.right[entry])]
+        return Node(self.tags[symbol_id], children)
+
+
+def init_chart(grammar: ProbGrammar, sentence: List[str], include_unary=False, pruning: CellPruning = None,
+               keep_derived=False) -> Tuple[CkyChart, Dict[Symbol, int]]:
+    """
+    Create a chart for a sentence and fill it's lexical level (spans of length 1).
+    :return: The chart, and the mapping of symbols to their ids in it.
+    """
+    symbols, symbol_ids = grammar.non_terminal_index()
+    if UNK_SYMBOL not in symbol_ids:
+        symbol_ids = dict(symbol_ids)
+        symbol_ids[UNK_SYMBOL] = len(symbols)
+        symbols = symbols + [UNK_SYMBOL]
+    unary_closure = grammar.unary_closure()
+    if pruning is not None:
+        pruning.start_sentence(grammar, sentence)
+
+    chart = CkyChart(sentence, symbols, unary_closure.chains, keep_derived)
+    for j in range(0, len(sentence)):
+        lexical_rules = grammar.lexical_rules(sentence[j])
+        # Check if the word is derived by some lexical rule in grammar
+        if lexical_rules:
+            # Iterate all rules generating the word
+            for lhs_id, rule_minus_log_prob in lexical_rules:
+                if rule_minus_log_prob < chart.scores[1, j, lhs_id]:
+                    chart.set_entry(1, j, lhs_id, rule_minus_log_prob, LEXICAL_SPLIT)
+            if pruning is not None and len(sentence) > 1:
+                pruning.prune_derived(1, j, chart.scores[1, j:j + 1])
+            chart.keep_derived(1, j)
+            # Unknown words are tagged by their signature's preterminals, having no precolated lexical rules (see
+            # precolate_grammar), so unary chains are applied to their cells in any case
+            if include_unary or not grammar.is_known_word(sentence[j]):
+                close_unary(chart, 1, j, unary_closure)
+            if pruning is not None and len(sentence) > 1:
+                pruning.prune_closed(1, j, chart.scores[1, j:j + 1])
+        else:
+            # Initiate assuming no match in lexical rules in grammar (not even by the word's signature), and therefore
+            # UNK symbol most probable (See note near definition of UNK_SYMBOL )
+            chart.set_entry(1, j, symbol_ids[UNK_SYMBOL], -0.0, LEXICAL_SPLIT)
+            chart.keep_derived(1, j)
+    return chart, symbol_ids
+
+
+def best_parse(grammar: ProbGrammar, chart: CkyChart, symbol_ids: Dict[Symbol, int]) -> Node:
+    """
+    Build the tree of the most probable start symbol spanning the whole sentence.
+    """
+    n = len(chart.sentence)
+    found_start_syms = [symbol_ids[ss] for ss in grammar.start_symbols if
+                        ss in symbol_ids and chart.scores[n, 0, symbol_ids[ss]] < inf]
+    if not found_start_syms:
+        raise DecodeFailure("No start symbol spans the sentence", chart)
+    return chart.build_tree(n, 0, min(found_start_syms, key=lambda ss: chart.scores[n, 0, ss]))
+
+
+def partial_parse(chart: CkyChart) -> Node:
+    """
+    Stitch a parse from the constituents of a chart having no start symbol spanning the sentence (or filled only
+    partially) : the sentence is covered by the fewest spans having an entry (the most probable cover among these),
+    and the trees of the best entries of these spans are put under PARTIAL_PARSE_ROOT. Words whose cell is empty are
+    tagged as UNK_SYMBOL.
+    "Fake" entries (created by binarization) are replaced by their children, as debinarization only expects them as
+    the last child of their parent.
+    """
+    n = len(chart.sentence)
+    best_entries = chart.scores.argmin(axis=2)
+    best_scores = chart.scores.min(axis=2)
+    # Best cover of the first words of the sentence, as (number of spans, score), by number of words, and the length of
+    # it's last span
+    covers = [(0, 0.0)] + [(inf, inf)] * n
+    last_lengths = [0] * (n + 1)
+    for end in range(1, n + 1):
+        for span_length in range(1, end + 1):
+            span_score = best_scores[span_length, end - span_length]
+            if span_score == inf:
+                if span_length > 1:
+                    continue
+                span_score = 0.0
+            pieces, score = covers[end - span_length]
+            if (pieces + 1, score + span_score) < covers[end]:
+                covers[end] = pieces + 1, score + span_score
+                last_lengths[end] = span_length
+    children = []
+    end = n
+    while end > 0:
+        span_length, span_start = last_lengths[end], end - last_lengths[end]
+        if best_scores[span_length, span_start] < inf:
+            pieces = [chart.build_tree(span_length, span_start, best_entries[span_length, span_start])]
+        else:
+            pieces = [Node(UNK_SYMBOL.symbol_string, [Node(chart.sentence[span_start])])]
+        while any(piece.children and brother_separator in piece.tag for piece in pieces):
+            pieces = [child for piece in pieces for child in (
+                piece.children if piece.children and brother_separator in piece.tag else [piece])]
+        children[:0] = pieces
+        end = span_start
+    return Node(PARTIAL_PARSE_ROOT.symbol_string, children)
+
+
+def flat_parse(grammar: ProbGrammar, sentence: List[str]) -> Node:
+    """
+    A flat parse of a sentence : every word under it's most probable tag (UNK_SYMBOL for words having none), all under
+    PARTIAL_PARSE_ROOT.
+    """
+    symbols = grammar.non_terminal_index().symbols
+    children = []
+    for word in sentence:
+        lexical_rules = grammar.lexical_rules(word)
+        tag = symbols[min(lexical_rules, key=lambda rule: rule[1])[0]] if lexical_rules else UNK_SYMBOL
+        children.append(Node(tag.symbol_string, [Node(word)]))
+    return Node(PARTIAL_PARSE_ROOT.symbol_string, children)
+
 
-def cky(grammar: ProbGrammar, sentence: List[str], include_unary=False) -> Node:
+def cky(grammar: ProbGrammar, sentence: List[str], include_unary=False, pruning: CellPruning = None,
+        cache: ChartCache = None, deadline: float = None) -> Node:
     """
     An implementation of CKY algorithm in it's wikipedia version.
     :param grammar: The probabilistic grammar to use.
     :param sentence: A sentence of lexical tokens separated by white space.
     :param include_unary: True if to support unary rules in run, False otherwise.
+    :param pruning: Pruning to apply to chart cells, None for exhaustive decoding.
+    :param cache: Cache of cells of short spans shared across sentences, None for no caching. Only used when
+                  decoding exhaustively, as pruned cells depend on the rest of the sentence.
+    :param deadline: Time (in time.monotonic seconds) to stop decoding at, raising DecodeTimeout with the chart filled
+                     so far (see check_deadline). None for no deadline.
     :return: Most probable parse tree for given sentence.
     """
     n = len(sentence)
-    cky_table: Dict[Tuple[int, int, Symbol], CkyTableEntry] = {}
-    for j in range(0, n):
-        rhs = Terminal(sentence[j])
-        terminal_node = Node(sentence[j])
-        cky_table[0, j, rhs] = CkyTableEntry(terminal_node, -0.0)
-        # Check if symbol exists as some rule's RHS in grammar
-        if MultiSymbol((rhs,)) in grammar.rhs_to_lhs_map:
-            # Iterate all rules generating this as rhs
-            for rule in grammar.rhs_to_lhs_map[MultiSymbol((rhs,))]:
-                assert rule.is_lexical()  # Sanity check
-                node = Node(str(rule.lhs), [terminal_node])
-                cky_table[1, j, rule.lhs[0]] = CkyTableEntry(node, grammar[rule].minus_log_prob)
-                if include_unary:
-                    expand_unary((1, j, rule.lhs[0]), cky_table, grammar)
-        else:
-            # Initiate assuming no match in lexical rules in grammar, and therefore UNK symbol most probable
-            # (See note near definition of UNK_SYMBOL )
-            node = Node(str(UNK_SYMBOL), [terminal_node])
-            cky_table[1, j, UNK_SYMBOL] = CkyTableEntry(node, -0.0)
+    if pruning is not None:
+        cache = None
+    if cache is not None:
+        cache.start_sentence(grammar)
+    binary_rules = grammar.binary_rule_index()
+    unary_closure = grammar.unary_closure()
+    chart, symbol_ids = init_chart(grammar, sentence, include_unary, pruning)
+    left_child, right_child, feasible = _feasibility_masks(grammar, symbol_ids, include_unary)
+    # Cells starting the sentence (or spanning all of it) only keep the few symbols which may derive a left child (or a
+    # start symbol), so only rules deriving these are visited. Other cells are left with few infeasible LHS.
+    edge_rules = [grammar.feasible_binary_rule_index("left_span" if include_unary else "left_child"),
+                  grammar.feasible_binary_rule_index("root_span")]
+    # Entries of every finished cell which are the left (right) child of some rule, scanned once per cell rather than
+    # once per partition
+    left_entries: Dict[Tuple[int, int], List[int]] = dict()
+    right_entries: Dict[Tuple[int, int], List[int]] = dict()
+
+    def __finish_cell(span_length: int, span_start: int):
+        active = np.flatnonzero(chart.scores[span_length, span_start] < inf)
+        left_entries[span_length, span_start] = active[left_child[active]].tolist()
+        right_entries[span_length, span_start] = active[right_child[active]].tolist()
+
+    for span_start in range(0, n):
+        _drop_infeasible(chart.scores[1, span_start], feasible[0, int(span_start == 0), int(span_start == n - 1)])
+        __finish_cell(1, span_start)
 
     for span_length in range(2, n + 1):
+        # The cell spanning the whole sentence is never pruned
+        prune = pruning is not None and span_length < n
         for span_start in range(0, n - span_length + 1):
+            check_deadline(deadline, chart)
+            if prune and not pruning.cell_open(span_length, span_start):
+                left_entries[span_length, span_start] = right_entries[span_length, span_start] = []
+                continue
+            cell_key = None
+            if cache is not None and span_length <= cache.max_span_length:
+                cell_key = (tuple(sentence[span_start:span_start + span_length]), span_start == 0,
+                            span_start + span_length == n, include_unary)
+                if cache.seed(chart, span_length, span_start, cell_key):
+                    __finish_cell(span_length, span_start)
+                    continue
+            cell_scores = chart.scores[span_length, span_start]
+            cell_feasible = feasible[1, int(span_start == 0), int(span_start + span_length == n)]
+            cell_rules = edge_rules[span_length == n] if span_start == 0 else binary_rules
             for partition in range(1, span_length):
-                # Iterate all RHS symbols
-                for rhs, rules in grammar.rhs_to_lhs_map.items():
-                    if len(rhs.symbol_list) < 2:
+                active_right = right_entries[span_length - partition, span_start + partition]
+                if not active_right:
+                    continue
+                left_scores = chart.scores[partition, span_start]
+                right_scores = chart.scores[span_length - partition, span_start + partition]
+                # Iterate only symbols present in the left sub-span, which are the left child of some rule
+                for rhs_B in left_entries[partition, span_start]:
+                    rules_by_C = cell_rules.get(rhs_B)
+                    if rules_by_C is None:
                         continue
-                    # Check if RHS components are relevant for this entry, i.e that they exist in corresponding
-                    # locations in the table : if RHS = B C, check whether cky_table[p,s,B]
-                    # and cky_table[l-p,s+p,C] exist
-                    if (partition, span_start, rhs[0]) not in cky_table or (
-                            span_length - partition, span_start + partition, rhs[1]) not in cky_table:
-                        continue
-                    # Retrieve entries in table corresponding to RHS components
-                    rhs_B_entry = cky_table[partition, span_start, rhs[0]]
-                    rhs_C_entry = cky_table[span_length - partition, span_start + partition, rhs[1]]
-                    # if rhs_B_entry.minus_log_prob + rhs_C_entry.minus_log_prob > 50:
-                    #     continue
-                    # Examine all rules deriving RHS
-                    for rule in rules:
-                        rule_prob = rhs_B_entry.minus_log_prob + rhs_C_entry.minus_log_prob + grammar[
-                            rule].minus_log_prob
-                        # If LHS first seen for this entry or was already considered for this entry but a better
-                        # rule was found
-                        if (span_length, span_start, rule.lhs[0]) not in cky_table or rule_prob < \
-                                cky_table[span_length, span_start, rule.lhs[0]].minus_log_prob:
-                            node = Node(str(rule.lhs), [rhs_B_entry.node, rhs_C_entry.node])
-                            cky_table[span_length, span_start, rule.lhs[0]] = CkyTableEntry(node, rule_prob)
-                            if include_unary:
-                                expand_unary((span_length, span_start, rule.lhs[0]), cky_table, grammar)
-
-    found_start_syms = [ss for ss in grammar.start_symbols if (n, 0, ss) in cky_table]
-    assert found_start_syms
-    return cky_table[n, 0, min(found_start_syms, key=lambda ss: cky_table[n, 0, ss].minus_log_prob)].node
-
-
-def expand_unary(cky_entry: Tuple[int, int, Symbol], cky_table: Dict[Tuple[int, int, Symbol], CkyTableEntry],
-                 grammar: ProbGrammar):
-    if MultiSymbol((cky_entry[2],)) not in grammar.rhs_to_lhs_map:
-        return
-    # Retrieve all unary rules deriving the current entry as RHS symbol
-    rules_to_add = [rule for rule in grammar.rhs_to_lhs_map[MultiSymbol((cky_entry[2],))] if rule.is_unary()]
-    while rules_to_add:
-        rule = rules_to_add.pop()
-        assert rule.is_unary()
-        lhs_entry = (cky_entry[0], cky_entry[1], rule.lhs[0])
-        rhs_entry = (cky_entry[0], cky_entry[1], rule.rhs[0])
-        # Check if lhs not in this level in table or using current rule yields path wih better probability
-        if lhs_entry not in cky_table or cky_table[lhs_entry].minus_log_prob > grammar[rule].minus_log_prob + cky_table[
-            rhs_entry].minus_log_prob:
-            node = Node(str(rule.lhs), [cky_table[rhs_entry].node])
-            cky_table[lhs_entry] = CkyTableEntry(node,
-                                                 grammar[rule].minus_log_prob + cky_table[rhs_entry].minus_log_prob)
-            # Add all new possible unary rules for deriving the newly added cell
-            if rule.lhs in grammar.rhs_to_lhs_map:
-                rules_to_add += [new_rule for new_rule in grammar.rhs_to_lhs_map[rule.lhs] if new_rule.is_unary()]
+                    rhs_B_score = left_scores[rhs_B]
+                    # Pair with the symbols present in the right sub-span, scanning the smaller of the two sides
+                    if len(rules_by_C) <= len(active_right):
+                        candidates = [(rhs_C, rules) for rhs_C, rules in rules_by_C.items() if
+                                      right_scores[rhs_C] < inf]
+                    else:
+                        candidates = [(rhs_C, rules_by_C[rhs_C]) for rhs_C in active_right if rhs_C in rules_by_C]
+                    for rhs_C, rules in candidates:
+                        rhs_C_score = right_scores[rhs_C]
+                        # Examine all rules deriving RHS
+                        for lhs, rule_minus_log_prob in rules:
+                            rule_prob = rhs_B_score + rhs_C_score + rule_minus_log_prob
+                            # If LHS first seen for this entry or was already considered for this entry but a better
+                            # rule was found
+                            if rule_prob < cell_scores[lhs]:
+                                chart.set_entry(span_length, span_start, lhs, rule_prob, partition, rhs_B, rhs_C)
+            _drop_infeasible(cell_scores, cell_feasible)
+            if prune:
+                pruning.prune_derived(span_length, span_start, chart.scores[span_length, span_start:span_start + 1])
+            chart.keep_derived(span_length, span_start)
+            if include_unary:
+                close_unary(chart, span_length, span_start, unary_closure)
+                _drop_infeasible(cell_scores, cell_feasible)
+            if prune:
+                pruning.prune_closed(span_length, span_start, chart.scores[span_length, span_start:span_start + 1])
+            if cell_key is not None:
+                cache.store(chart, span_length, span_start, cell_key)
+            __finish_cell(span_length, span_start)
+
+    return best_parse(grammar, chart, symbol_ids)
+
+
+def _feasibility_masks(grammar: ProbGrammar, symbol_ids: Dict[Symbol, int],
+                       include_unary: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Masks of the chart entries which may be part of a full parse, from the grammar's symbol feasibility tables
+    (see ProbGrammar.symbol_feasibility). Symbols missing from the grammar (as UNK_SYMBOL may be) are never feasible.
+    :return: Masks of the symbols which are the left (right) child of some binary rule, and masks of the feasible
+             entries of a cell, indexed by (0 for spans of a single word and 1 otherwise, 1 if the span starts the
+             sentence and 0 otherwise, 1 if the span ends the sentence and 0 otherwise).
+    """
+    feasibility = grammar.symbol_feasibility()
+    padding = len(symbol_ids) - len(feasibility.reachable)
+    left_child, right_child, left_span, right_span, root_span, reachable, phrasal = (
+        np.pad(table, (0, padding)) for table in (
+            feasibility.left_child, feasibility.right_child, feasibility.left_span, feasibility.right_span,
+            feasibility.root_span, feasibility.reachable, ~feasibility.preterminal_only))
+    if not include_unary:
+        # Entries are derived by binary rules only, so the entries of a span are the children of the span above it
+        left_span, right_span = left_child, right_child
+        root_span = np.zeros(len(symbol_ids), dtype=bool)
+        root_span[[symbol_ids[ss] for ss in grammar.start_symbols if ss in symbol_ids]] = True
+    feasible = np.empty((2, 2, 2, len(symbol_ids)), dtype=bool)
+    feasible[:, 0, 0] = left_span | right_span
+    feasible[:, 1, 0] = left_span
+    feasible[:, 0, 1] = right_span
+    feasible[:, 1, 1] = root_span
+    feasible &= reachable
+    feasible[1] &= phrasal
+    return left_child, right_child, feasible
+
+
+def _drop_infeasible(cell_scores: np.ndarray, cell_feasible: np.ndarray):
+    """
+    Remove the entries of a cell which can't be part of a full parse.
+    """
+    active = np.flatnonzero(cell_scores < inf)
+    cell_scores[active[~cell_feasible[active]]] = inf
+
+
+def close_unary(chart: CkyChart, span_length: int, span_start: int, unary_closure: UnaryClosure):
+    """
+    Apply the grammar's unary closure to a chart cell whose lexical or binary entries are final : every entry is
+    relaxed with the best unary chain deriving it from another entry of the cell.
+    """
+    cell_scores = chart.scores[span_length, span_start]
+    # The closure is transitive, so chains are applied from the cell's entries as they are before any relaxation
+    active = np.flatnonzero(cell_scores < inf).tolist()
+    for rhs, rhs_score in zip(active, cell_scores[active].tolist()):
+        for lhs, chain_minus_log_prob in unary_closure.ancestors.get(rhs, ()):
+            if cell_scores[lhs] > chain_minus_log_prob + rhs_score:
+                chart.set_entry(span_length, span_start, lhs, chain_minus_log_prob + rhs_score, UNARY_SPLIT, rhs)
+
+
+def max_plus_cky(grammar: ProbGrammar, sentence: List[str], include_unary=False, pruning: CellPruning = None,
+                 deadline: float = None) -> Node:
+    """
+    A vectorized CKY : every span length is filled at once for all span starts and partitions, using batched
+    max-plus (min-plus over minus log probabilities) operations on the grammar's rule arrays instead of looping over
+    symbols. Yields the same most probable parse as cky.
+    :param grammar: The probabilistic grammar to use.
+    :param sentence: A sentence of lexical tokens separated by white space.
+    :param include_unary: True if to support unary rules in run, False otherwise.
+    :param pruning: Pruning to apply to chart cells, None for exhaustive decoding.
+    :param deadline: Time to stop decoding at (see cky), None for no deadline.
+    :return: Most probable parse tree for given sentence.
+    """
+    chart, symbol_ids = max_plus_chart(grammar, sentence, include_unary, pruning, deadline=deadline)
+    return best_parse(grammar, chart, symbol_ids)
+
+
+def max_plus_chart(grammar: ProbGrammar, sentence: List[str], include_unary=False, pruning: CellPruning = None,
+                   keep_derived=False, deadline: float = None) -> Tuple[CkyChart, Dict[Symbol, int]]:
+    """
+    Fill a chart for a sentence using vectorized max-plus operations (see max_plus_cky).
+    :param keep_derived: True to keep the scores of entries before applying unary chains in the chart.
+    :param deadline: Time to stop decoding at, checked before every span length (see cky), None for no deadline.
+    :return: The chart, and the mapping of symbols to their ids in it.
+    """
+    n = len(sentence)
+    binary_rules = grammar.binary_rule_arrays()
+    unary_closure = grammar.unary_closure_arrays()
+    chart, symbol_ids = init_chart(grammar, sentence, include_unary, pruning, keep_derived)
+
+    for span_length in range(2, n + 1):
+        check_deadline(deadline, chart)
+        starts = n - span_length + 1
+        # Best score of every (span start, rule), and the partition achieving it
+        best_scores = np.full((starts, binary_rules.lhs.size), inf)
+        best_partitions = np.zeros((starts, binary_rules.lhs.size), dtype=np.int16)
+        for partition in range(1, span_length):
+            left_scores = chart.scores[partition, 0:starts][:, binary_rules.left]
+            right_scores = chart.scores[span_length - partition, partition:partition + starts][:, binary_rules.right]
+            scores = left_scores + right_scores + binary_rules.minus_log_probs
+            improved = scores < best_scores
+            best_scores[improved] = scores[improved]
+            best_partitions[improved] = partition
+        _relax_cells(chart, span_length, starts, binary_rules, best_scores, best_partitions)
+        # The cell spanning the whole sentence is never pruned
+        prune = pruning is not None and span_length < n
+        if prune:
+            pruning.prune_derived(span_length, 0, chart.scores[span_length, 0:starts])
+        chart.keep_derived(span_length, 0, starts)
+        if include_unary:
+            _relax_cells(chart, span_length, starts, unary_closure, unary_closure.minus_log_probs + chart.scores[
+                span_length, 0:starts][:, unary_closure.left], np.full((starts, unary_closure.lhs.size), UNARY_SPLIT,
+                                                                       dtype=np.int16))
+        if prune:
+            pruning.prune_closed(span_length, 0, chart.scores[span_length, 0:starts])
+
+    return chart, symbol_ids
+
+
+def _relax_cells(chart: CkyChart, span_length: int, starts: int, rules: RuleArrays, scores: np.ndarray,
+                 splits: np.ndarray) -> bool:
+    """
+    Minimize rule scores over every LHS and store the improved entries (score and backpointer) in the chart.
+    :param scores: Score of every rule (columns) at every span start (rows).
+    :param splits: Split point of every rule's derivation at every span start.
+    :return: True if any chart entry was improved, False otherwise.
+    """
+    if not rules.lhs.size:
+        return False
+    # Rules are sorted by LHS, so the minimum of each LHS group is a segment reduction
+    lhs_ids = rules.lhs[rules.group_starts]
+    group_scores = np.minimum.reduceat(scores, rules.group_starts, axis=1)
+    improved_rows, improved_groups = np.nonzero(group_scores < chart.scores[span_length, 0:starts][:, lhs_ids])
+    if not improved_rows.size:
+        return False
+    # Pick the first rule of each group achieving the group's minimum
+    group_sizes = np.diff(np.append(rules.group_starts, rules.lhs.size))
+    achieving = np.where(scores == np.repeat(group_scores, group_sizes, axis=1), np.arange(rules.lhs.size),
+                         rules.lhs.size)
+    best_rules = np.minimum.reduceat(achieving, rules.group_starts, axis=1)[improved_rows, improved_groups]
+
+    entries = span_length, improved_rows, lhs_ids[improved_groups]
+    chart.scores[entries] = group_scores[improved_rows, improved_groups]
+    chart.splits[entries] = splits[improved_rows, best_rules]
+    chart.left[entries] = rules.left[best_rules]
+    chart.right[entries] = rules.right[best_rules]
+    return True
 
 
 def add_top(head: Node) -> Node:
@@ -0,0 +1,170 @@
+from typing import List, Optional
+
+from math import inf, log
+
+import numpy as np
+
+from src.parser.compiled_grammar import CompiledGrammar
+from src.parser.grammar import ProbGrammar, project_grammar, child_groups
+from src.parser.pruning import CellPruning
+from src.util.tree.cnf import project_tag
+
+
+class CoarseGrammar:
+    """
+    A (small) grammar compiled for summing over derivations : rule probabilities as arrays, and the sum over all unary
+    chains as a dense matrix.
+    """
+
+    def __init__(self, grammar: ProbGrammar):
+        self.grammar = grammar
+        self.symbols, self.symbol_ids = grammar.non_terminal_index()
+        self.binary_rules = grammar.binary_rule_arrays()
+        self.binary_probs = np.exp(-self.binary_rules.minus_log_probs)
+        # Orderings of the binary rules by left and right child, for accumulating outside scores of children
+        self.by_left = child_groups(self.binary_rules.left)
+        self.by_right = child_groups(self.binary_rules.right)
+        # Sum of probabilities of all unary chains A ->* B (including the empty chain) : (I - U)^-1
+        unary = np.zeros((len(self.symbols), len(self.symbols)))
+        for child, rules in grammar.unary_rule_index().items():
+            for lhs, minus_log_prob in rules:
+                unary[lhs, child] += np.exp(-minus_log_prob)
+        self.unary_closure = np.maximum(np.linalg.inv(np.eye(len(self.symbols)) - unary), 0.0)
+        self.start_ids = [self.symbol_ids[ss] for ss in grammar.start_symbols if ss in self.symbol_ids]
+
+    def posteriors(self, sentence: List[str]) -> Optional[np.ndarray]:
+        """
+        Compute the posterior probability of every symbol over every span of a sentence, using the inside-outside
+        algorithm. Scores are kept as log probabilities, and rescaled by the maximum of every cell when summing.
+        :return: Log posteriors, indexed by (span length, span start, symbol id), or None if the sentence has no
+                 parse under this grammar.
+        """
+        n = len(sentence)
+        shape = (n + 1, n, len(self.symbols))
+        # Inside and outside scores of entries derived by lexical or binary rules, and after applying unary chains
+        inside_derived, inside_closed = np.full(shape, -inf), np.full(shape, -inf)
+        outside_derived, outside_closed = np.full(shape, -inf), np.full(shape, -inf)
+        rules = self.binary_rules
+
+        for j, word in enumerate(sentence):
+            for lhs_id, minus_log_prob in self.grammar.lexical_rules(word):
+                inside_derived[1, j, lhs_id] = -minus_log_prob
+        inside_closed[1] = _log_dot(inside_derived[1], self.unary_closure.T)
+        for span_length in range(2, n + 1):
+            starts = n - span_length + 1
+            for partition in range(1, span_length):
+                left, left_max = _exp_rows(inside_closed[partition, 0:starts])
+                right, right_max = _exp_rows(inside_closed[span_length - partition, partition:partition + starts])
+                sums = np.add.reduceat(left[:, rules.left] * right[:, rules.right] * self.binary_probs,
+                                       rules.group_starts, axis=1)
+                cells = inside_derived[span_length, 0:starts]
+                cells[:, rules.lhs[rules.group_starts]] = np.logaddexp(
+                    cells[:, rules.lhs[rules.group_starts]], _log(sums) + (left_max + right_max)[:, None])
+            inside_closed[span_length, 0:starts] = _log_dot(inside_derived[span_length, 0:starts],
+                                                            self.unary_closure.T)
+
+        if not self.start_ids or np.isneginf(inside_closed[n, 0, self.start_ids]).all():
+            return None
+        total = np.logaddexp.reduce(inside_closed[n, 0, self.start_ids])
+        outside_closed[n, 0, self.start_ids] = 0.0
+        for span_length in range(n, 0, -1):
+            starts = n - span_length + 1
+            outside_derived[span_length, 0:starts] = _log_dot(outside_closed[span_length, 0:starts],
+                                                              self.unary_closure)
+            if span_length == 1:
+                break
+            parent, parent_max = _exp_rows(outside_derived[span_length, 0:starts])
+            for partition in range(1, span_length):
+                left, left_max = _exp_rows(inside_closed[partition, 0:starts])
+                right, right_max = _exp_rows(inside_closed[span_length - partition, partition:partition + starts])
+                parent_probs = parent[:, rules.lhs] * self.binary_probs
+                _add_outside(outside_closed[partition, 0:starts], parent_probs * right[:, rules.right],
+                             parent_max + right_max, self.by_left)
+                _add_outside(outside_closed[span_length - partition, partition:partition + starts],
+                             parent_probs * left[:, rules.left], parent_max + left_max, self.by_right)
+
+        return np.maximum(inside_derived + outside_derived, inside_closed + outside_closed) - total
+
+
+class CoarseToFinePruning(CellPruning):
+    """
+    Coarse-to-fine pruning : every sentence is first parsed with a coarse projection of the grammar (see
+    project_grammar), and entries of the fine chart are pruned when the posterior probability of their projection
+    over the entry's span falls below a threshold.
+    Beam, threshold and cap pruning (see CellPruning) can be applied on top.
+    """
+
+    def __init__(self, posterior_threshold: float = 1e-4, beam_width: int = None, threshold: float = None,
+                 max_entries: int = None):
+        super().__init__(beam_width, threshold, max_entries)
+        self.log_posterior_threshold = log(posterior_threshold)
+        self.fine_grammar: ProbGrammar = None
+        self.coarse_grammar: CoarseGrammar = None
+        # Coarse symbol id of every fine symbol id, -1 for symbols with no projection (never pruned)
+        self.projection: np.ndarray = None
+        self.allowed: np.ndarray = None
+
+    def start_sentence(self, grammar: ProbGrammar, sentence: List[str]):
+        if grammar is not self.fine_grammar:
+            self.fine_grammar = grammar
+            # Compiled grammars don't hold their rules as such, project the grammar they were compiled from instead
+            self.coarse_grammar = CoarseGrammar(project_grammar(
+                grammar.to_prob_grammar() if isinstance(grammar, CompiledGrammar) else grammar))
+            self.projection = np.array([self.coarse_grammar.symbol_ids.get(
+                type(sym)(project_tag(sym.symbol_string)), -1) for sym in grammar.non_terminal_index().symbols] + [-1],
+                dtype=np.int64)
+        posteriors = self.coarse_grammar.posteriors(sentence)
+        # Coarse symbols allowed over every span, with a trailing column for fine symbols having no projection
+        self.allowed = None if posteriors is None else np.concatenate(
+            (posteriors >= self.log_posterior_threshold, np.ones(posteriors.shape[:2] + (1,), dtype=bool)), axis=2)
+
+    def prune_derived(self, span_length: int, span_start: int, cell_scores: np.ndarray):
+        self._prune_by_projection(span_length, span_start, cell_scores)
+        super().prune_derived(span_length, span_start, cell_scores)
+
+    def prune_closed(self, span_length: int, span_start: int, cell_scores: np.ndarray):
+        self._prune_by_projection(span_length, span_start, cell_scores)
+        super().prune_closed(span_length, span_start, cell_scores)
+
+    def _prune_by_projection(self, span_length: int, span_start: int, cell_scores: np.ndarray):
+        if self.allowed is None:
+            return
+        projection = self.projection[:cell_scores.shape[1]]
+        allowed = self.allowed[span_length, span_start:span_start + cell_scores.shape[0]][:, projection]
+        dropped = ~allowed & (cell_scores < inf)
+        pruned = np.count_nonzero(dropped)
+        self.entry_count += pruned
+        self.pruned_count += pruned
+        cell_scores[dropped] = inf
+
+
+def _exp_rows(log_scores: np.ndarray):
+    """
+    Exponentiate log scores rescaled by the maximum of every row.
+    :return: The rescaled scores, and the maximum of every row (-inf for rows holding no scores).
+    """
+    row_max = log_scores.max(axis=1)
+    finite_max = np.where(np.isneginf(row_max), 0.0, row_max)
+    return np.exp(log_scores - finite_max[:, None]), row_max
+
+
+def _log(scores: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore"):
+        return np.log(scores)
+
+
+def _log_dot(log_scores: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """
+    Multiply rows of log scores by a matrix of (non log) probabilities.
+    """
+    scores, row_max = _exp_rows(log_scores)
+    return _log(scores @ matrix) + row_max[:, None]
+
+
+def _add_outside(outside: np.ndarray, rule_scores: np.ndarray, rule_scale: np.ndarray, child_order):
+    """
+    Accumulate the (rescaled) outside contribution of every rule at every span start to the rule's child.
+    """
+    order, child_ids, group_starts = child_order
+    sums = np.add.reduceat(rule_scores[:, order], group_starts, axis=1)
+    outside[:, child_ids] = np.logaddexp(outside[:, child_ids], _log(sums) + rule_scale[:, None])
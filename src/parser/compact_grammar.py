@@ -0,0 +1,367 @@
+from typing import List, Dict, Iterator, Tuple, Optional, Mapping, FrozenSet, Set
+
+from math import inf
+
+import numpy as np
+
+from src.parser.grammar import ProbGrammar, ScoredLhsList, PrecolatedRule
+from src.parser.rule import Rule
+from src.parser.symbol import Symbol, Terminal, NonTerminal, MultiSymbol
+
+# Kinds of rules, as kept in CompactGrammar.rule_kinds
+BINARY_RULE = 0
+UNARY_RULE = 1
+LEXICAL_RULE = 2
+
+
+class CompactGrammar(ProbGrammar):
+    """
+    A probabilistic grammar held as a struct of typed arrays, rather than as rule, count and set objects : every rule
+    is a row of symbol ids (LHS and up to two RHS symbols, -1 where missing), it's count and minus log probability.
+    Rows are sorted by (LHS, RHS), so the rules of an LHS are a contiguous range, and an ordering of the rows by RHS
+    serves lookups by RHS. Symbols are kept once, in a symbol table (non-terminals first, in the order of
+    non_terminal_index, then terminals).
+
+    The grammar is a facade over the arrays, keeping the interface of ProbGrammar : rule maps, lhs_counts and the
+    LHS/RHS multi maps are read only views building rules once asked for, indexing (grammar[rule]) returns a view of
+    the rule's count and probability which may be altered, start symbols and symbol sets are kept as is, and decoding
+    structures are built from the arrays directly. Rules may be counted again (see add_rule_counts) but not added nor
+    removed, so transformations adding rules (as precolation) should run before compacting a grammar (see
+    compact_grammar).
+    """
+
+    def __init__(self, symbols: List[Symbol], start_symbols: List[Symbol], rule_lhs: np.ndarray,
+                 rule_rhs: np.ndarray, rule_counts: np.ndarray, rule_minus_log_probs: np.ndarray,
+                 lhs_count_array: np.ndarray):
+        # No call to ProbGrammar.__init__, all of it's containers are replaced by views
+        self.symbols = symbols
+        self.symbol_ids: Dict[Symbol, int] = {sym: i for i, sym in enumerate(symbols)}
+        self.start_symbols = set(start_symbols)
+        self.terminals = {sym for sym in symbols if type(sym) is Terminal}
+        self.non_terminals = {sym for sym in symbols if type(sym) is NonTerminal}
+        # Rule rows, sorted by key
+        order = np.argsort(_rule_keys(len(symbols), rule_lhs, rule_rhs), kind="stable")
+        self.rule_lhs = rule_lhs[order].astype(np.int32)
+        self.rule_rhs = rule_rhs[order].astype(np.int32)
+        self.rule_counts = rule_counts[order].astype(np.int32)
+        self.rule_minus_log_probs = rule_minus_log_probs[order].astype(np.float64)
+        self.rule_kinds = np.where(self.rule_rhs[:, 1] >= 0, BINARY_RULE, np.where(
+            np.isin(self.rule_rhs[:, 0], [i for i, sym in enumerate(symbols) if type(sym) is Terminal]),
+            LEXICAL_RULE, UNARY_RULE)).astype(np.int8)
+        self.lhs_count_array = lhs_count_array.astype(np.int32)
+        self._build_indices()
+        self.syntactic_rule_map = _RuleMapView(self, BINARY_RULE)
+        self.unary_rule_map = _RuleMapView(self, UNARY_RULE)
+        self.lexical_rule_map = _RuleMapView(self, LEXICAL_RULE)
+        self.lhs_to_rhs_map = _RuleIndexView(self, by_rhs=False)
+        self.rhs_to_lhs_map = _RuleIndexView(self, by_rhs=True)
+        self.lhs_counts = _LhsCountsView(self)
+        self.dirty_lhs: Set[MultiSymbol] = set()
+        self.precolated_rules: Dict[Rule, PrecolatedRule] = dict()
+        self._decode_cache: Dict[str, object] = dict()
+
+    def _build_indices(self):
+        # Offsets of every LHS's rules, and the ordering of rules by RHS
+        self._rule_keys = _rule_keys(len(self.symbols), self.rule_lhs, self.rule_rhs)
+        self._lhs_starts = np.searchsorted(self.rule_lhs, np.arange(len(self.symbols) + 1)).astype(np.int32)
+        rhs_keys = _rhs_keys(len(self.symbols), self.rule_rhs)
+        self._rhs_order = np.argsort(rhs_keys, kind="stable").astype(np.int32)
+        self._rhs_keys = rhs_keys[self._rhs_order]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the grammar's rule arrays and indices, in bytes.
+        """
+        return sum(array.nbytes for array in (
+            self.rule_lhs, self.rule_rhs, self.rule_counts, self.rule_minus_log_probs, self.rule_kinds,
+            self.lhs_count_array, self._rule_keys, self._lhs_starts, self._rhs_order, self._rhs_keys))
+
+    def __getstate__(self):
+        return {"symbols": [(sym.symbol_string, type(sym) is Terminal) for sym in self.symbols],
+                "start_symbols": [self.symbol_ids[sym] for sym in self.start_symbols],
+                "arrays": (self.rule_lhs, self.rule_rhs, self.rule_counts, self.rule_minus_log_probs,
+                           self.lhs_count_array),
+                "precolated_rules": self.precolated_rules, "dirty_lhs": self.dirty_lhs}
+
+    def __setstate__(self, state):
+        symbols = [Terminal(symbol) if terminal else NonTerminal(symbol) for symbol, terminal in state["symbols"]]
+        self.__init__(symbols, [symbols[i] for i in state["start_symbols"]], *state["arrays"])
+        self.precolated_rules = state["precolated_rules"]
+        self.dirty_lhs = state["dirty_lhs"]
+
+    def find_rule(self, rule: Rule) -> int:
+        """
+        Find the row of a rule.
+        :return: The rule's row, -1 if the grammar has no such rule.
+        """
+        ids = [self.symbol_ids.get(sym, -1) for sym in rule.lhs.symbol_list + rule.rhs.symbol_list]
+        if len(rule.lhs.symbol_list) != 1 or not 2 <= len(ids) <= 3 or -1 in ids:
+            return -1
+        ids += [-1] * (3 - len(ids))
+        key = _rule_keys(len(self.symbols), np.array(ids[:1]), np.array([ids[1:]])).item()
+        row = np.searchsorted(self._rule_keys, key).item()
+        return row if row < len(self._rule_keys) and self._rule_keys[row] == key else -1
+
+    def rule_at(self, row: int) -> Rule:
+        """
+        Build the rule of a row.
+        """
+        rhs = self.rule_rhs[row]
+        return Rule(MultiSymbol((self.symbols[self.rule_lhs.item(row)],)),
+                    MultiSymbol(tuple(self.symbols[i] for i in rhs.tolist() if i >= 0)))
+
+    def add_rule_counts(self, rule_counts: Dict[Rule, int]):
+        """
+        Count more occurrences of rules of the grammar (see ProbGrammar.add_rule_counts).
+        """
+        rows = [self.find_rule(rule) for rule in rule_counts]
+        if -1 in rows:
+            raise ValueError("Rule doesn't exist in grammar, rules can't be added to a compact grammar.")
+        self.invalidate_decode_cache()
+        for row, count in zip(rows, rule_counts.values()):
+            self.rule_counts[row] += count
+            self.rule_minus_log_probs[row] = inf
+            self.lhs_count_array[self.rule_lhs[row]] += count
+
+    def remove_rule(self, rule: Rule):
+        raise ValueError("Rules can't be removed from a compact grammar.")
+
+    def generate_rule_probabilities(self):
+        self.invalidate_decode_cache()
+        self.rule_minus_log_probs = -np.log(self.rule_counts / self.lhs_count_array[self.rule_lhs])
+        self.dirty_lhs.clear()
+
+    def lexical_index(self) -> Dict[str, ScoredLhsList]:
+        # Non-terminal ids of the symbol table are their ids in non_terminal_index
+        if "lexical_index" not in self._decode_cache:
+            self.renormalize()
+            index: Dict[str, ScoredLhsList] = dict()
+            rows = np.flatnonzero(self.rule_kinds == LEXICAL_RULE)
+            for lhs, word, score in zip(self.rule_lhs[rows].tolist(), self.rule_rhs[rows, 0].tolist(),
+                                        self.rule_minus_log_probs[rows].tolist()):
+                index.setdefault(self.symbols[word].symbol_string, []).append((lhs, score))
+            self._decode_cache["lexical_index"] = index
+        return self._decode_cache["lexical_index"]
+
+    def binary_rule_index(self, by_right_child=False) -> Dict[int, Dict[int, ScoredLhsList]]:
+        key = "binary_rule_index_by_right" if by_right_child else "binary_rule_index"
+        if key not in self._decode_cache:
+            self.renormalize()
+            rows = np.flatnonzero(self.rule_kinds == BINARY_RULE)
+            first, second = (self.rule_rhs[rows, 1], self.rule_rhs[rows, 0]) if by_right_child else \
+                (self.rule_rhs[rows, 0], self.rule_rhs[rows, 1])
+            index: Dict[int, Dict[int, ScoredLhsList]] = dict()
+            for lhs, first_id, second_id, score in zip(self.rule_lhs[rows].tolist(), first.tolist(), second.tolist(),
+                                                       self.rule_minus_log_probs[rows].tolist()):
+                index.setdefault(first_id, dict()).setdefault(second_id, []).append((lhs, score))
+            self._decode_cache[key] = index
+        return self._decode_cache[key]
+
+    def unary_rule_index(self) -> Dict[int, ScoredLhsList]:
+        if "unary_rule_index" not in self._decode_cache:
+            self.renormalize()
+            rows = np.flatnonzero(self.rule_kinds == UNARY_RULE)
+            index: Dict[int, ScoredLhsList] = dict()
+            for lhs, child, score in zip(self.rule_lhs[rows].tolist(), self.rule_rhs[rows, 0].tolist(),
+                                         self.rule_minus_log_probs[rows].tolist()):
+                index.setdefault(child, []).append((lhs, score))
+            self._decode_cache["unary_rule_index"] = index
+        return self._decode_cache["unary_rule_index"]
+
+
+class CompactRuleEntry:
+    """
+    The count and probability of a rule of a compact grammar, as CountAndProbability. Setting them alters the
+    grammar's arrays.
+    """
+    __slots__ = ("grammar", "row")
+
+    def __init__(self, grammar: CompactGrammar, row: int):
+        self.grammar = grammar
+        self.row = row
+
+    @property
+    def count(self) -> int:
+        return self.grammar.rule_counts.item(self.row)
+
+    @count.setter
+    def count(self, count: int):
+        self.grammar.rule_counts[self.row] = count
+
+    @property
+    def minus_log_prob(self) -> float:
+        return self.grammar.rule_minus_log_probs.item(self.row)
+
+    @minus_log_prob.setter
+    def minus_log_prob(self, minus_log_prob: float):
+        self.grammar.rule_minus_log_probs[self.row] = minus_log_prob
+
+
+class _RuleMapView(Mapping):
+    """
+    The rules of a compact grammar of a single kind, as a (read only) rule map : rule -> CompactRuleEntry.
+    """
+
+    def __init__(self, grammar: CompactGrammar, kind: int):
+        self.grammar = grammar
+        self.kind = kind
+
+    def _rows(self) -> np.ndarray:
+        return np.flatnonzero(self.grammar.rule_kinds == self.kind)
+
+    def _find(self, rule: Rule) -> int:
+        row = self.grammar.find_rule(rule)
+        return row if row >= 0 and self.grammar.rule_kinds[row] == self.kind else -1
+
+    def __getitem__(self, rule: Rule) -> CompactRuleEntry:
+        row = self._find(rule)
+        if row < 0:
+            raise KeyError(rule)
+        return CompactRuleEntry(self.grammar, row)
+
+    def __contains__(self, rule: Rule) -> bool:
+        return self._find(rule) >= 0
+
+    def __iter__(self) -> Iterator[Rule]:
+        return (self.grammar.rule_at(row) for row in self._rows().tolist())
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.grammar.rule_kinds == self.kind))
+
+    def items(self) -> Iterator[Tuple[Rule, CompactRuleEntry]]:
+        return ((self.grammar.rule_at(row), CompactRuleEntry(self.grammar, row)) for row in self._rows().tolist())
+
+
+class _RuleIndexView(Mapping):
+    """
+    The rules of a compact grammar by LHS (as lhs_to_rhs_map) or by RHS (as rhs_to_lhs_map) : multi symbol -> rules.
+    """
+
+    def __init__(self, grammar: CompactGrammar, by_rhs: bool):
+        self.grammar = grammar
+        self.by_rhs = by_rhs
+
+    def _rows(self, multi_symbol: MultiSymbol) -> Optional[np.ndarray]:
+        grammar = self.grammar
+        ids = [grammar.symbol_ids.get(sym, -1) for sym in multi_symbol.symbol_list]
+        if -1 in ids:
+            return None
+        if not self.by_rhs:
+            if len(ids) != 1:
+                return None
+            rows = np.arange(grammar._lhs_starts[ids[0]], grammar._lhs_starts[ids[0] + 1])
+        else:
+            if len(ids) > 2:
+                return None
+            key = _rhs_keys(len(grammar.symbols), np.array([ids + [-1] * (2 - len(ids))])).item()
+            rows = grammar._rhs_order[np.searchsorted(grammar._rhs_keys, key, "left"):
+                                      np.searchsorted(grammar._rhs_keys, key, "right")]
+        return rows if rows.size else None
+
+    def __getitem__(self, multi_symbol: MultiSymbol) -> FrozenSet[Rule]:
+        rows = self._rows(multi_symbol)
+        if rows is None:
+            raise KeyError(multi_symbol)
+        return frozenset(self.grammar.rule_at(row) for row in rows.tolist())
+
+    def __contains__(self, multi_symbol: MultiSymbol) -> bool:
+        return self._rows(multi_symbol) is not None
+
+    def __iter__(self) -> Iterator[MultiSymbol]:
+        grammar = self.grammar
+        if not self.by_rhs:
+            return (MultiSymbol((grammar.symbols[lhs],)) for lhs in np.unique(grammar.rule_lhs).tolist())
+        return (MultiSymbol(tuple(grammar.symbols[i] for i in rhs if i >= 0)) for rhs in
+                np.unique(grammar.rule_rhs, axis=0).tolist())
+
+    def __len__(self) -> int:
+        grammar = self.grammar
+        return len(np.unique(grammar.rule_rhs, axis=0) if self.by_rhs else np.unique(grammar.rule_lhs))
+
+
+class _LhsCountsView(Mapping):
+    """
+    The LHS counts of a compact grammar, as lhs_counts : LHS -> count, for every LHS of the grammar's rules.
+    Counts may be altered.
+    """
+
+    def __init__(self, grammar: CompactGrammar):
+        self.grammar = grammar
+
+    def _symbol_id(self, lhs: MultiSymbol) -> int:
+        grammar = self.grammar
+        symbol_id = grammar.symbol_ids.get(lhs[0], -1) if len(lhs.symbol_list) == 1 else -1
+        if symbol_id < 0 or grammar._lhs_starts[symbol_id] == grammar._lhs_starts[symbol_id + 1]:
+            raise KeyError(lhs)
+        return symbol_id
+
+    def __getitem__(self, lhs: MultiSymbol) -> int:
+        return self.grammar.lhs_count_array.item(self._symbol_id(lhs))
+
+    def __setitem__(self, lhs: MultiSymbol, count: int):
+        self.grammar.lhs_count_array[self._symbol_id(lhs)] = count
+
+    def __iter__(self) -> Iterator[MultiSymbol]:
+        grammar = self.grammar
+        return (MultiSymbol((grammar.symbols[lhs],)) for lhs in np.unique(grammar.rule_lhs).tolist())
+
+    def __len__(self) -> int:
+        return len(np.unique(self.grammar.rule_lhs))
+
+
+def _rule_keys(symbol_count: int, lhs: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    """
+    Sort keys of rules, by LHS and then RHS.
+    """
+    return lhs.astype(np.int64) * (symbol_count + 1) ** 2 + _rhs_keys(symbol_count, rhs)
+
+
+def _rhs_keys(symbol_count: int, rhs: np.ndarray) -> np.ndarray:
+    """
+    Sort keys of RHS symbol ids (with -1 for missing symbols).
+    """
+    return (rhs[:, 0].astype(np.int64) + 1) * (symbol_count + 1) + rhs[:, 1] + 1
+
+
+def compact_nbytes(rule_count: int, symbol_count: int) -> int:
+    """
+    Size of the rule arrays and indices (see CompactGrammar.nbytes) of a compact grammar having the given numbers of
+    rules and symbols, in bytes, without compacting a grammar.
+    """
+    # Per rule : LHS, 2 RHS symbols, count and RHS ordering (int32), probability and 2 keys (int64), kind (int8). Per
+    # symbol : LHS count and LHS offset (int32), with one more offset.
+    return rule_count * (5 * 4 + 3 * 8 + 1) + symbol_count * 2 * 4 + 4
+
+
+def compact_grammar(grammar: ProbGrammar) -> CompactGrammar:
+    """
+    Convert a grammar to a compact grammar, holding the same rules, counts, probabilities and LHS counts.
+    Can be used as the last step of a GrammarTransformationPipeline.
+    :param grammar: The grammar to convert.
+    :return: The compact grammar.
+    """
+    if isinstance(grammar, CompactGrammar):
+        return grammar
+    non_terminals = grammar.non_terminal_index().symbols
+    symbols = non_terminals + sorted(grammar.terminals, key=lambda sym: sym.symbol_string)
+    symbol_ids = {sym: i for i, sym in enumerate(symbols)}
+    rules: List[Tuple[int, int, int, int, float]] = []
+    for rule_map in (grammar.syntactic_rule_map, grammar.unary_rule_map, grammar.lexical_rule_map):
+        for rule, count_and_prob in rule_map.items():
+            if len(rule.lhs.symbol_list) != 1 or len(rule.rhs.symbol_list) > 2:
+                raise ValueError("Only binarized grammars may be compacted, found {}.".format(rule))
+            rhs = [symbol_ids[sym] for sym in rule.rhs.symbol_list] + [-1]
+            rules.append((symbol_ids[rule.lhs[0]], rhs[0], rhs[1], count_and_prob.count,
+                          count_and_prob.minus_log_prob))
+    lhs_count_array = np.zeros(len(symbols), dtype=np.int32)
+    for lhs, count in grammar.lhs_counts.items():
+        lhs_count_array[symbol_ids[lhs[0]]] = count
+    compact = CompactGrammar(symbols, list(grammar.start_symbols),
+                             np.array([rule[0] for rule in rules], dtype=np.int32),
+                             np.array([rule[1:3] for rule in rules], dtype=np.int32).reshape(-1, 2),
+                             np.array([rule[3] for rule in rules], dtype=np.int32),
+                             np.array([rule[4] for rule in rules], dtype=np.float64), lhs_count_array)
+    compact.precolated_rules = dict(grammar.precolated_rules)
+    compact.dirty_lhs = set(grammar.dirty_lhs)
+    return compact
@@ -0,0 +1,297 @@
+import hashlib
+import os
+from typing import List, Dict, Tuple, Set
+
+import numpy as np
+
+from src.parser.grammar import ProbGrammar, RuleArrays, ScoredLhsList, SymbolIndex, UnaryClosure, ProjectedGrammar, \
+    PrecolatedRule, SymbolFeasibility, context_summary_estimates, symbol_feasibility, restrict_rule_index
+from src.parser.lexicon import unknown_word_index, unknown_word_rules
+from src.parser.rule import Rule
+from src.parser.symbol import Terminal, NonTerminal, MultiSymbol
+
+# Arrays of a compiled grammar. Binary rules and the unary closure are sorted by LHS (as RuleArrays), lexical rules
+# are grouped by word, with the offsets of every word's group in lexicon_offsets. The intermediate symbols of every
+# unary closure chain are in closure_chain_symbols, at the chain's offsets in closure_chain_offsets.
+_ARRAYS = ("start_ids", "lhs_counts",
+           "binary_lhs", "binary_left", "binary_right", "binary_scores", "binary_counts", "binary_group_starts",
+           "unary_lhs", "unary_child", "unary_scores", "unary_counts",
+           "lexicon_offsets", "lexicon_lhs", "lexicon_scores", "lexicon_counts",
+           "closure_lhs", "closure_descendants", "closure_scores", "closure_group_starts", "closure_chain_offsets",
+           "closure_chain_symbols")
+# Precolated rules (see precolate_grammar) are kept as text, a rule per line : it's LHS, the LHS of the rule it was
+# derived from, the chain's intermediate symbols, 1 for lexical rules (0 otherwise) and the RHS, separated by tabs
+# (symbols of a sequence are separated by spaces).
+_PRECOLATED_RULES_FILE = "precolated.txt"
+
+
+class CompiledGrammar:
+    """
+    A trained grammar compiled for decoding : it's symbol table, and it's rules, lexicon and unary closure as arrays
+    of symbol ids (see compile_grammar). Loading a compiled grammar memory maps it's arrays, so it takes milliseconds
+    regardless of the grammar's size, and processes loading the same grammar share it's pages.
+
+    A compiled grammar provides the decoding interface of ProbGrammar (symbol index, rule indices and arrays, unary
+    closure, context summary estimates and optimistic projection), so every decode algorithm accepts either. Lookup
+    structures are built from the arrays once asked for. A compiled grammar is read only, convert it to a ProbGrammar
+    (see to_prob_grammar) for anything else.
+    """
+
+    def __init__(self, path: str, symbols: List[str], words: List[str], arrays: Dict[str, np.ndarray]):
+        self.path = path
+        self.words = words
+        self.arrays = arrays
+        non_terminals = [NonTerminal(symbol) for symbol in symbols]
+        self._symbol_index = SymbolIndex(non_terminals, {sym: i for i, sym in enumerate(non_terminals)})
+        self.start_symbols: Set[NonTerminal] = {non_terminals[i] for i in arrays["start_ids"].tolist()}
+        # Lookup structures derived from the arrays, built lazily
+        self._decode_cache: Dict[str, object] = dict()
+
+    def __reduce__(self):
+        # Processes receiving a compiled grammar map it's file again, rather than copying it's arrays
+        return load_compiled_grammar, (self.path,)
+
+    def non_terminal_index(self) -> SymbolIndex:
+        return self._symbol_index
+
+    def lexical_rules(self, word: str) -> ScoredLhsList:
+        word_id = self._word_ids().get(word)
+        if word_id is None:
+            return unknown_word_rules(self.unknown_word_index(), word)
+        start, end = self.arrays["lexicon_offsets"][word_id:word_id + 2].tolist()
+        return list(zip(self.arrays["lexicon_lhs"][start:end].tolist(),
+                        self.arrays["lexicon_scores"][start:end].tolist()))
+
+    def is_known_word(self, word: str) -> bool:
+        return word in self._word_ids()
+
+    def unknown_word_index(self) -> Dict[str, ScoredLhsList]:
+        if "unknown_word_index" not in self._decode_cache:
+            word_ids = np.repeat(np.arange(len(self.words)), np.diff(self.arrays["lexicon_offsets"]))
+            self._decode_cache["unknown_word_index"] = unknown_word_index(
+                zip([self.words[word_id] for word_id in word_ids.tolist()], self.arrays["lexicon_lhs"].tolist(),
+                    self.arrays["lexicon_counts"].tolist()), self.arrays["lhs_counts"].tolist())
+        return self._decode_cache["unknown_word_index"]
+
+    def _word_ids(self) -> Dict[str, int]:
+        if "word_ids" not in self._decode_cache:
+            self._decode_cache["word_ids"] = {word: i for i, word in enumerate(self.words)}
+        return self._decode_cache["word_ids"]
+
+    def binary_rule_index(self, by_right_child=False) -> Dict[int, Dict[int, ScoredLhsList]]:
+        key = "binary_rule_index_by_right" if by_right_child else "binary_rule_index"
+        if key not in self._decode_cache:
+            rules = self.binary_rule_arrays()
+            first, second = (rules.right, rules.left) if by_right_child else (rules.left, rules.right)
+            index: Dict[int, Dict[int, ScoredLhsList]] = dict()
+            for lhs, first_id, second_id, score in zip(rules.lhs.tolist(), first.tolist(), second.tolist(),
+                                                       rules.minus_log_probs.tolist()):
+                index.setdefault(first_id, dict()).setdefault(second_id, []).append((lhs, score))
+            self._decode_cache[key] = index
+        return self._decode_cache[key]
+
+    def unary_rule_index(self) -> Dict[int, ScoredLhsList]:
+        if "unary_rule_index" not in self._decode_cache:
+            index: Dict[int, ScoredLhsList] = dict()
+            for lhs, child, score in zip(self.arrays["unary_lhs"].tolist(), self.arrays["unary_child"].tolist(),
+                                         self.arrays["unary_scores"].tolist()):
+                index.setdefault(child, []).append((lhs, score))
+            self._decode_cache["unary_rule_index"] = index
+        return self._decode_cache["unary_rule_index"]
+
+    def binary_rule_arrays(self) -> RuleArrays:
+        return RuleArrays(*(self.arrays["binary_" + name] for name in
+                            ("lhs", "left", "right", "scores", "group_starts")))
+
+    def unary_closure(self) -> UnaryClosure:
+        if "unary_closure" not in self._decode_cache:
+            closure = self.unary_closure_arrays()
+            chain_offsets = self.arrays["closure_chain_offsets"].tolist()
+            chain_symbols = self.arrays["closure_chain_symbols"].tolist()
+            ancestors: Dict[int, ScoredLhsList] = dict()
+            chains: Dict[Tuple[int, int], Tuple[int, ...]] = dict()
+            for i, (ancestor, descendant, score) in enumerate(zip(closure.lhs.tolist(), closure.left.tolist(),
+                                                                  closure.minus_log_probs.tolist())):
+                ancestors.setdefault(descendant, []).append((ancestor, score))
+                chains[ancestor, descendant] = tuple(chain_symbols[chain_offsets[i]:chain_offsets[i + 1]])
+            self._decode_cache["unary_closure"] = UnaryClosure(ancestors, chains)
+        return self._decode_cache["unary_closure"]
+
+    def unary_closure_arrays(self) -> RuleArrays:
+        descendants = self.arrays["closure_descendants"]
+        return RuleArrays(self.arrays["closure_lhs"], descendants, np.full(descendants.shape, -1, dtype=np.int64),
+                          self.arrays["closure_scores"], self.arrays["closure_group_starts"])
+
+    def context_summary_estimates(self) -> Tuple[np.ndarray, np.ndarray]:
+        if "context_summary_estimates" not in self._decode_cache:
+            self._decode_cache["context_summary_estimates"] = context_summary_estimates(
+                len(self._symbol_index.symbols), np.unique(self.arrays["lexicon_lhs"]),
+                self.arrays["start_ids"], self.binary_rule_arrays(), self.unary_closure_arrays())
+        return self._decode_cache["context_summary_estimates"]
+
+    def symbol_feasibility(self) -> SymbolFeasibility:
+        if "symbol_feasibility" not in self._decode_cache:
+            self._decode_cache["symbol_feasibility"] = symbol_feasibility(
+                len(self._symbol_index.symbols), np.unique(self.arrays["lexicon_lhs"]),
+                self.arrays["start_ids"], self.binary_rule_arrays(), self.unary_closure_arrays())
+        return self._decode_cache["symbol_feasibility"]
+
+    def feasible_binary_rule_index(self, table: str) -> Dict[int, Dict[int, ScoredLhsList]]:
+        key = "feasible_binary_rule_index", table
+        if key not in self._decode_cache:
+            self._decode_cache[key] = restrict_rule_index(self.binary_rule_index(),
+                                                          getattr(self.symbol_feasibility(), table))
+        return self._decode_cache[key]
+
+    @property
+    def precolated_rules(self) -> Dict[Rule, PrecolatedRule]:
+        """
+        The rules added to the grammar by precolation, read from the store once asked for. Empty for stores having
+        none.
+        """
+        if "precolated_rules" not in self._decode_cache:
+            precolated_rules: Dict[Rule, PrecolatedRule] = dict()
+            precolated_path = os.path.join(self.path, _PRECOLATED_RULES_FILE)
+            if os.path.isfile(precolated_path):
+                with open(precolated_path, encoding="utf-8") as fp:
+                    for line in fp.read().splitlines():
+                        lhs, source_lhs, chain, lexical, rhs = line.split("\t")
+                        rhs = MultiSymbol(tuple(Terminal(symbol) if lexical == "1" else NonTerminal(symbol) for
+                                                symbol in rhs.split(" ")))
+                        precolated_rules[Rule(MultiSymbol((NonTerminal(lhs),)), rhs)] = PrecolatedRule(
+                            Rule(MultiSymbol((NonTerminal(source_lhs),)), rhs),
+                            tuple(NonTerminal(symbol) for symbol in chain.split(" ") if symbol))
+            self._decode_cache["precolated_rules"] = precolated_rules
+        return self._decode_cache["precolated_rules"]
+
+    def optimistic_projection(self) -> ProjectedGrammar:
+        # Symbol ids of the converted grammar follow the same order, so it's projection applies as is
+        return self.to_prob_grammar().optimistic_projection()
+
+    def fingerprint(self) -> str:
+        # A digest of the store's arrays, symbol table, words and precolated rules. It differs from the fingerprint of
+        # the ProbGrammar compiled, which digests it's rules instead.
+        if "fingerprint" not in self._decode_cache:
+            digest = hashlib.sha1()
+            for name in _ARRAYS:
+                digest.update(name.encode("utf-8"))
+                digest.update(np.ascontiguousarray(self.arrays[name]).tobytes())
+            digest.update("\n".join(sym.symbol_string for sym in self._symbol_index.symbols).encode("utf-8"))
+            digest.update("\n".join(self.words).encode("utf-8"))
+            precolated_path = os.path.join(self.path, _PRECOLATED_RULES_FILE)
+            if os.path.isfile(precolated_path):
+                with open(precolated_path, "rb") as fp:
+                    digest.update(fp.read())
+            self._decode_cache["fingerprint"] = digest.hexdigest()
+        return self._decode_cache["fingerprint"]
+
+    def to_prob_grammar(self) -> ProbGrammar:
+        """
+        Convert the compiled grammar back to a ProbGrammar, holding the same rules, counts and probabilities.
+        The conversion is done once, and kept.
+        """
+        if "prob_grammar" not in self._decode_cache:
+            symbols = [MultiSymbol((sym,)) for sym in self._symbol_index.symbols]
+            arrays = self.arrays
+            word_ids = np.repeat(np.arange(len(self.words)), np.diff(arrays["lexicon_offsets"]))
+            rules = [(Rule(symbols[lhs], MultiSymbol(symbols[left].symbol_list + symbols[right].symbol_list)), count,
+                      score) for lhs, left, right, count, score in zip(
+                *(arrays["binary_" + name].tolist() for name in ("lhs", "left", "right", "counts", "scores")))]
+            rules += [(Rule(symbols[lhs], symbols[child]), count, score) for lhs, child, count, score in zip(
+                *(arrays["unary_" + name].tolist() for name in ("lhs", "child", "counts", "scores")))]
+            rules += [(Rule(symbols[lhs], MultiSymbol((Terminal(self.words[word_id]),))), count, score) for
+                      lhs, word_id, count, score in zip(arrays["lexicon_lhs"].tolist(), word_ids.tolist(),
+                                                        arrays["lexicon_counts"].tolist(),
+                                                        arrays["lexicon_scores"].tolist())]
+            grammar = ProbGrammar.from_counts({rule: count for rule, count, _ in rules})
+            for rule, _, score in rules:
+                grammar[rule].minus_log_prob = score
+            grammar.lhs_counts = {symbols[i]: count for i, count in enumerate(arrays["lhs_counts"].tolist()) if
+                                  symbols[i] in grammar.lhs_counts}
+            grammar.start_symbols = set(self.start_symbols)
+            grammar.precolated_rules = dict(self.precolated_rules)
+            self._decode_cache["prob_grammar"] = grammar
+        return self._decode_cache["prob_grammar"]
+
+
+def compile_grammar(grammar: ProbGrammar, path: str):
+    """
+    Compile a trained grammar (after it's transformations) to a compiled grammar store : a directory holding every
+    array of the compiled grammar in a .npy file, along with the symbol table and the words of the lexicon.
+    Symbol ids follow the grammar's non-terminal index, and rules keep the order of the grammar's rule arrays, so
+    decoding with the compiled grammar finds the same parses.
+    :param grammar: The grammar to compile.
+    :param path: Directory of the compiled grammar store.
+    :return: None.
+    """
+    symbols, symbol_ids = grammar.non_terminal_index()
+    arrays: Dict[str, np.ndarray] = dict()
+    arrays["start_ids"] = np.array(sorted(symbol_ids[ss] for ss in grammar.start_symbols if ss in symbol_ids),
+                                   dtype=np.int64)
+    arrays["lhs_counts"] = np.array([grammar.lhs_counts.get(MultiSymbol((sym,)), 0) for sym in symbols],
+                                    dtype=np.int64)
+
+    binary_rules = grammar.binary_rule_arrays()
+    for name, array in zip(("lhs", "left", "right", "scores", "group_starts"), binary_rules):
+        arrays["binary_" + name] = array
+    binary_counts = {(symbol_ids[rule.lhs[0]], symbol_ids[rule.rhs[0]], symbol_ids[rule.rhs[1]]): count_and_prob.count
+                     for rule, count_and_prob in grammar.syntactic_rule_map.items()}
+    arrays["binary_counts"] = np.array([binary_counts[rule] for rule in zip(
+        binary_rules.lhs.tolist(), binary_rules.left.tolist(), binary_rules.right.tolist())], dtype=np.int64)
+
+    unary_rules = [(symbol_ids[rule.lhs[0]], symbol_ids[rule.rhs[0]], count_and_prob.minus_log_prob,
+                    count_and_prob.count) for rule, count_and_prob in grammar.unary_rule_map.items()]
+    for i, name in enumerate(("lhs", "child", "scores", "counts")):
+        arrays["unary_" + name] = np.array([rule[i] for rule in unary_rules],
+                                           dtype=np.float64 if name == "scores" else np.int64)
+
+    lexicon: Dict[str, List[Tuple[int, float, int]]] = dict()
+    for rule, count_and_prob in grammar.lexical_rule_map.items():
+        lexicon.setdefault(rule.rhs[0].symbol_string, []).append(
+            (symbol_ids[rule.lhs[0]], count_and_prob.minus_log_prob, count_and_prob.count))
+    words = sorted(lexicon)
+    lexical_rules = [rule for word in words for rule in lexicon[word]]
+    arrays["lexicon_offsets"] = np.concatenate(([0], np.cumsum([len(lexicon[word]) for word in words]))).astype(
+        np.int64)
+    for i, name in enumerate(("lhs", "scores", "counts")):
+        arrays["lexicon_" + name] = np.array([rule[i] for rule in lexical_rules],
+                                             dtype=np.float64 if name == "scores" else np.int64)
+
+    closure = grammar.unary_closure_arrays()
+    chains = grammar.unary_closure().chains
+    arrays.update(closure_lhs=closure.lhs, closure_descendants=closure.left, closure_scores=closure.minus_log_probs,
+                  closure_group_starts=closure.group_starts)
+    closure_chains = [chains[ancestor, descendant] for ancestor, descendant in
+                      zip(closure.lhs.tolist(), closure.left.tolist())]
+    arrays["closure_chain_offsets"] = np.concatenate(([0], np.cumsum([len(chain) for chain in closure_chains]))) \
+        .astype(np.int64)
+    arrays["closure_chain_symbols"] = np.array([symbol for chain in closure_chains for symbol in chain],
+                                               dtype=np.int64)
+
+    os.makedirs(path, exist_ok=True)
+    for name in _ARRAYS:
+        np.save(os.path.join(path, name + ".npy"), arrays[name])
+    with open(os.path.join(path, "symbols.txt"), "w", encoding="utf-8") as fp:
+        fp.write("\n".join(sym.symbol_string for sym in symbols))
+    with open(os.path.join(path, "words.txt"), "w", encoding="utf-8") as fp:
+        fp.write("\n".join(words))
+    with open(os.path.join(path, _PRECOLATED_RULES_FILE), "w", encoding="utf-8") as fp:
+        fp.write("".join("{}\t{}\t{}\t{}\t{}\n".format(
+            rule.lhs, precolated_rule.source.lhs, " ".join(sym.symbol_string for sym in precolated_rule.chain),
+            int(rule.is_lexical()), rule.rhs) for rule, precolated_rule in grammar.precolated_rules.items()))
+
+
+def load_compiled_grammar(path: str, mmap=True) -> CompiledGrammar:
+    """
+    Load a compiled grammar store written by compile_grammar.
+    :param path: Directory of the compiled grammar store.
+    :param mmap: True to memory map the grammar's arrays, False to read them to memory.
+    :return: The compiled grammar.
+    """
+    mmap_mode = "r" if mmap else None
+    with open(os.path.join(path, "symbols.txt"), encoding="utf-8") as fp:
+        symbols = fp.read().split("\n")
+    with open(os.path.join(path, "words.txt"), encoding="utf-8") as fp:
+        words = fp.read().split("\n")
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in _ARRAYS}
+    return CompiledGrammar(path, symbols, words, arrays)
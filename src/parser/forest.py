@@ -0,0 +1,279 @@
+import os
+from typing import List, Tuple, Dict, Iterable, Optional
+
+from math import inf
+
+import numpy as np
+
+from src.parser.kbest import ChartHypergraph, ChartNode, KBestExtractor
+from src.util.tree.node import Node
+
+# Arrays of a forest store, concatenated over all of it's forests. Node ids (and so edge tails) and chain offsets are
+# local to every forest.
+_NODE_ARRAYS = ("node_symbols", "node_starts", "node_lengths", "node_closed")
+_EDGE_ARRAYS = ("edge_heads", "edge_scores", "edge_left", "edge_right", "edge_chain_starts", "edge_chain_lengths")
+_OFFSET_ARRAYS = ("node_offsets", "edge_offsets", "root_offsets", "chain_offsets")
+
+
+class PackedForest:
+    """
+    A packed parse forest : the hypergraph of all derivations of a sentence held by a (possibly pruned) chart, kept
+    to the nodes reachable from the sentence's start symbols.
+
+    Nodes are identified by integers, and ordered such that tails of a hyperedge precede it's head. Every node has a
+    span (start and length), a symbol id and a closed flag : closed nodes are derived by a unary chain (possibly
+    empty) from a node of the same span which isn't closed, other nodes by a lexical rule (no tails) or a binary rule
+    (two closed tails). Hyperedges are sorted by their head, and hold their own score (minus log probability of the
+    rule, or chain of rules), their tails (-1 where missing) and the intermediate symbols of unary chains, top down.
+    Roots are the closed nodes of start symbols spanning the whole sentence.
+
+    Forests are built from a chart's hypergraph (see build_forest), stored and loaded (see write_forests and
+    load_forests), and support Viterbi decoding, k-best extraction and posteriors without the grammar.
+    """
+
+    def __init__(self, sentence: List[str], symbols: List[str], arrays: Dict[str, np.ndarray]):
+        self.sentence = sentence
+        self.symbols = symbols
+        self.node_symbols = arrays["node_symbols"]
+        self.node_starts = arrays["node_starts"]
+        self.node_lengths = arrays["node_lengths"]
+        self.node_closed = arrays["node_closed"]
+        self.edge_heads = arrays["edge_heads"]
+        self.edge_scores = arrays["edge_scores"]
+        self.edge_left = arrays["edge_left"]
+        self.edge_right = arrays["edge_right"]
+        self.edge_chain_starts = arrays["edge_chain_starts"]
+        self.edge_chain_lengths = arrays["edge_chain_lengths"]
+        self.chain_symbols = arrays["chain_symbols"]
+        self.roots = arrays["roots"]
+        # Offset of every node's hyperedges, and of every level (nodes of the same span length and closed flag)
+        self.node_edge_starts = np.searchsorted(self.edge_heads, np.arange(self.node_count + 1))
+        self.level_starts = np.flatnonzero(np.diff(self.node_lengths * 2 + self.node_closed, prepend=-1,
+                                                   append=-1)) if self.node_count else np.zeros(1, dtype=np.int64)
+        self._viterbi: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @property
+    def node_count(self) -> int:
+        return self.node_symbols.size
+
+    @property
+    def edge_count(self) -> int:
+        return self.edge_heads.size
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in _NODE_ARRAYS + _EDGE_ARRAYS + ("chain_symbols", "roots")}
+
+    def _levels(self) -> Iterable[Tuple[int, int, int, int]]:
+        """
+        Iterate the forest's levels bottom up, as (first node, end node, first edge, end edge).
+        """
+        for first, end in zip(self.level_starts[:-1].tolist(), self.level_starts[1:].tolist()):
+            yield first, end, self.node_edge_starts[first], self.node_edge_starts[end]
+
+    def viterbi(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the best derivation of every node.
+        :return: The minus log probability of every node's best derivation, and the hyperedge achieving it.
+        """
+        if self._viterbi is None:
+            # A trailing zero score stands for missing tails
+            inside = np.zeros(self.node_count + 1)
+            best_edges = np.full(self.node_count, -1, dtype=np.int64)
+            for first, end, first_edge, end_edge in self._levels():
+                edges = slice(first_edge, end_edge)
+                scores = self.edge_scores[edges] + inside[self.edge_left[edges]] + inside[self.edge_right[edges]]
+                group_starts = self.node_edge_starts[first:end] - first_edge
+                inside[first:end] = np.minimum.reduceat(scores, group_starts)
+                # The first hyperedge of every node achieving it's best score
+                group_sizes = np.diff(np.append(group_starts, scores.size))
+                achieving = np.where(scores == np.repeat(inside[first:end], group_sizes), np.arange(scores.size),
+                                     scores.size)
+                best_edges[first:end] = np.minimum.reduceat(achieving, group_starts) + first_edge
+            self._viterbi = inside[:-1], best_edges
+        return self._viterbi
+
+    def best_parse(self) -> Tuple[Node, float]:
+        """
+        :return: The most probable parse tree of the sentence and it's minus log probability.
+        """
+        assert self.roots.size
+        inside, best_edges = self.viterbi()
+        root = self.roots[np.argmin(inside[self.roots])]
+
+        def __build(node: int) -> Node:
+            edge = best_edges[node]
+            return self.build_tree(node, (0.0, edge), [__build(tail) for tail in self.tails(node, (0.0, edge))])
+
+        return __build(root), inside[root]
+
+    def kbest(self) -> KBestExtractor:
+        """
+        :return: An iterator of (parse tree, minus log probability), best first (see KBestExtractor).
+        """
+        return KBestExtractor(self)
+
+    def log_posteriors(self) -> np.ndarray:
+        """
+        Compute the posterior probability of every node, summing over all derivations of the forest (inside-outside).
+        :return: Log posterior of every node.
+        """
+        # Log inside and outside probabilities, with a trailing zero for missing tails
+        inside = np.zeros(self.node_count + 1)
+        for first, end, first_edge, end_edge in self._levels():
+            edges = slice(first_edge, end_edge)
+            scores = inside[self.edge_left[edges]] + inside[self.edge_right[edges]] - self.edge_scores[edges]
+            inside[first:end] = np.logaddexp.reduceat(scores, self.node_edge_starts[first:end] - first_edge)
+        outside = np.full(self.node_count + 1, -inf)
+        if not self.roots.size:
+            return outside[:-1]
+        total = np.logaddexp.reduce(inside[self.roots])
+        outside[self.roots] = 0.0
+        for first, end, first_edge, end_edge in reversed(list(self._levels())):
+            edges = slice(first_edge, end_edge)
+            left, right = self.edge_left[edges], self.edge_right[edges]
+            scores = outside[self.edge_heads[edges]] - self.edge_scores[edges]
+            np.logaddexp.at(outside, left, scores + inside[right])
+            np.logaddexp.at(outside, right, scores + inside[left])
+        return (inside + outside)[:-1] - total
+
+    # Hypergraph interface (see ChartHypergraph) : hyperedges are (score, edge id), and (0, root) into the goal node
+
+    def incoming(self, node: Optional[int]) -> List[Tuple[float, Tuple[float, int]]]:
+        inside, _ = self.viterbi()
+        if node is None:
+            return [(inside.item(root), (0.0, root)) for root in self.roots.tolist()]
+        edges = range(self.node_edge_starts[node], self.node_edge_starts[node + 1])
+        return [(self.edge_scores.item(edge) + sum(inside.item(tail) for tail in self.tails(node, (0.0, edge))),
+                 (self.edge_scores.item(edge), edge)) for edge in edges]
+
+    def tails(self, node: Optional[int], edge: Tuple[float, int]) -> Tuple[int, ...]:
+        if node is None:
+            return edge[1],
+        return tuple(tail for tail in (self.edge_left.item(edge[1]), self.edge_right.item(edge[1])) if tail >= 0)
+
+    def build_tree(self, node: Optional[int], edge: Tuple[float, int], children: List[Node]) -> Node:
+        if node is None:
+            return children[0]
+        tag = self.symbols[self.node_symbols[node]]
+        if not children:
+            return Node(tag, [Node(self.sentence[self.node_starts[node]])])
+        if not self.node_closed[node]:
+            return Node(tag, children)
+        if self.node_symbols[self.edge_left[edge[1]]] == self.node_symbols[node]:
+            return children[0]
+        tree = children[0]
+        chain_start = self.edge_chain_starts[edge[1]]
+        for symbol in reversed(self.chain_symbols[chain_start:chain_start + self.edge_chain_lengths[edge[1]]]):
+            tree = Node(self.symbols[symbol], [tree])
+        return Node(tag, [tree])
+
+
+def build_forest(hypergraph: ChartHypergraph) -> PackedForest:
+    """
+    Build the packed forest of a chart's hypergraph, keeping the nodes reachable from it's goal node.
+    """
+    chart = hypergraph.chart
+    roots = [hypergraph.tails(None, edge)[0] for _, edge in hypergraph.incoming(None)]
+    incoming: Dict[ChartNode, list] = dict()
+    agenda = list(roots)
+    while agenda:
+        node = agenda.pop()
+        if node in incoming:
+            continue
+        incoming[node] = [edge for _, edge in hypergraph.incoming(node)]
+        agenda += [tail for edge in incoming[node] for tail in hypergraph.tails(node, edge) if tail not in incoming]
+
+    # Tails precede their heads : by span length, and derived nodes before the closed nodes of the same span
+    nodes = sorted(incoming, key=lambda chart_node: (chart_node[1], chart_node[0], chart_node[2], chart_node[3]))
+    node_ids = {node: i for i, node in enumerate(nodes)}
+    edge_heads, edge_scores, edge_left, edge_right, edge_chain_starts, edge_chain_lengths = [], [], [], [], [], []
+    chain_symbols = []
+    for node_id, node in enumerate(nodes):
+        for edge in incoming[node]:
+            tails = [node_ids[tail] for tail in hypergraph.tails(node, edge)] + [-1, -1]
+            chain = chart.unary_chains.get((node[3], edge[2]), ()) if node[0] else ()
+            edge_heads.append(node_id)
+            edge_scores.append(edge[0])
+            edge_left.append(tails[0])
+            edge_right.append(tails[1])
+            edge_chain_starts.append(len(chain_symbols))
+            edge_chain_lengths.append(len(chain))
+            chain_symbols += chain
+
+    return PackedForest(chart.sentence, chart.tags, {
+        "node_symbols": np.array([node[3] for node in nodes], dtype=np.int32),
+        "node_starts": np.array([node[2] for node in nodes], dtype=np.int16),
+        "node_lengths": np.array([node[1] for node in nodes], dtype=np.int16),
+        "node_closed": np.array([node[0] for node in nodes], dtype=np.int8),
+        "edge_heads": np.array(edge_heads, dtype=np.int32),
+        "edge_scores": np.array(edge_scores, dtype=np.float64),
+        "edge_left": np.array(edge_left, dtype=np.int32),
+        "edge_right": np.array(edge_right, dtype=np.int32),
+        "edge_chain_starts": np.array(edge_chain_starts, dtype=np.int64),
+        "edge_chain_lengths": np.array(edge_chain_lengths, dtype=np.int8),
+        "chain_symbols": np.array(chain_symbols, dtype=np.int32),
+        "roots": np.array([node_ids[root] for root in roots], dtype=np.int32)})
+
+
+class ForestCorpus:
+    """
+    The forests of a corpus, loaded from a forest store (see write_forests). Arrays are memory mapped by default, so
+    forests are read from disk only once accessed.
+    """
+
+    def __init__(self, path: str, mmap=True):
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, "symbols.txt"), encoding="utf-8") as fp:
+            self.symbols = fp.read().split("\n")
+        with open(os.path.join(path, "sentences.txt"), encoding="utf-8") as fp:
+            self.sentences = [line.split() for line in fp.read().split("\n")[:-1]]
+        self._arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in
+                        _NODE_ARRAYS + _EDGE_ARRAYS + _OFFSET_ARRAYS + ("chain_symbols", "roots")}
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def __getitem__(self, i: int) -> PackedForest:
+        arrays = dict()
+        for names, offsets in ((_NODE_ARRAYS, "node_offsets"), (_EDGE_ARRAYS, "edge_offsets"),
+                               (("roots",), "root_offsets"), (("chain_symbols",), "chain_offsets")):
+            start, end = self._arrays[offsets][i:i + 2]
+            arrays.update({name: self._arrays[name][start:end] for name in names})
+        return PackedForest(self.sentences[i], self.symbols, arrays)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def write_forests(forests: Iterable[PackedForest], path: str):
+    """
+    Write forests (of sentences parsed by the same grammar) to a forest store : a directory holding every array of
+    the forests concatenated in a .npy file, along with the offsets of every forest's part of them, the sentences
+    and the symbols.
+    """
+    os.makedirs(path, exist_ok=True)
+    parts = {name: [] for name in _NODE_ARRAYS + _EDGE_ARRAYS + ("chain_symbols", "roots")}
+    sentences, symbols = [], []
+    for forest in forests:
+        sentences.append(" ".join(forest.sentence))
+        symbols = forest.symbols
+        for name, array in forest.arrays().items():
+            parts[name].append(array)
+    arrays = {name: np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32) for name, arrays in
+              parts.items()}
+    for offsets, name in (("node_offsets", "node_symbols"), ("edge_offsets", "edge_heads"),
+                          ("root_offsets", "roots"), ("chain_offsets", "chain_symbols")):
+        arrays[offsets] = np.concatenate(([0], np.cumsum([array.size for array in parts[name]]))).astype(np.int64)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    with open(os.path.join(path, "symbols.txt"), "w", encoding="utf-8") as fp:
+        fp.write("\n".join(symbols))
+    with open(os.path.join(path, "sentences.txt"), "w", encoding="utf-8") as fp:
+        fp.write("".join(sentence + "\n" for sentence in sentences))
+
+
+def load_forests(path: str, mmap=True) -> ForestCorpus:
+    """
+    Load a forest store written by write_forests.
+    """
+    return ForestCorpus(path, mmap)
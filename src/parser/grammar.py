@@ -1,20 +1,59 @@
-import copy
+import hashlib
+import heapq
 import pickle
-from typing import Set, Dict, List
+from typing import Set, Dict, List, NamedTuple, Tuple, Callable
 
-from math import inf, log
+from math import inf
 
+import numpy as np
+
+from src.parser.lexicon import unknown_word_index, unknown_word_rules
 from src.parser.rule import Rule
 from src.parser.symbol import Terminal, NonTerminal, MultiSymbol, Symbol
-from src.util.tree.cnf import parent_separator, brother_separator
+from src.util.tree.cnf import parent_separator, brother_separator, project_tag, strip_brother_history
+
+
+# Suffixes of start symbols' strings
+_START_SUFFIX = "{}S".format(parent_separator)
+_TOP_SUFFIX = "{}TOP".format(parent_separator)
 
 
 class CountAndProbability:
+    __slots__ = ("count", "minus_log_prob")
+
     def __init__(self, count=0, minus_log_prob=inf):
         self.count = count
         self.minus_log_prob = minus_log_prob
 
 
+SymbolIndex = NamedTuple("SymbolIndex", [("symbols", List[Symbol]), ("ids", Dict[Symbol, int])])
+# Non-terminal ids of a rule's LHS along with the rule's minus log probability
+ScoredLhsList = List[Tuple[int, float]]
+# Rules as parallel arrays of symbol ids and scores, sorted by LHS. group_starts holds the offset of every LHS group.
+# Unary rules keep their child in left, and -1 in right.
+RuleArrays = NamedTuple("RuleArrays", [("lhs", np.ndarray), ("left", np.ndarray), ("right", np.ndarray),
+                                       ("minus_log_probs", np.ndarray), ("group_starts", np.ndarray)])
+# Best unary chains : descendant -> [(ancestor, score of the best chain)], and the intermediate symbols of every
+# such chain, ordered top down : (ancestor, descendant) -> (intermediate, ...)
+UnaryClosure = NamedTuple("UnaryClosure", [("ancestors", Dict[int, ScoredLhsList]),
+                                           ("chains", Dict[Tuple[int, int], Tuple[int, ...]])])
+# A rule added by precolation (see precolate_grammar) : the rule it was derived from, and the intermediate symbols of
+# the unary chain it collapses, ordered top down
+PrecolatedRule = NamedTuple("PrecolatedRule", [("source", Rule), ("chain", Tuple[Symbol, ...])])
+# Which chart entries may be part of a full parse, as boolean arrays by symbol id (see ProbGrammar.symbol_feasibility) :
+# preterminal_only - the symbol derives single words only, never a span of several words.
+# left_child, right_child - the symbol is the left (right) child of some binary rule.
+# left_span, right_span - the symbol may be an entry of a span which is the left (right) child of a binary rule : it's
+#     a left (right) child, or is derived from one by a unary chain.
+# root_span - the symbol may be an entry of the span of the whole sentence : it's a start symbol, or is derived from
+#     one by a unary chain.
+# reachable - the symbol is part of some derivation of a start symbol.
+SymbolFeasibility = NamedTuple("SymbolFeasibility", [("preterminal_only", np.ndarray), ("left_child", np.ndarray),
+                                                     ("right_child", np.ndarray), ("left_span", np.ndarray),
+                                                     ("right_span", np.ndarray), ("root_span", np.ndarray),
+                                                     ("reachable", np.ndarray)])
+
+
 class ProbGrammar:
     """
     A probabilistic grammar, holding the set of it's rules, symbols (start symbols, terminals and non-terminals), and
@@ -36,40 +75,370 @@ class ProbGrammar:
         self.lhs_to_rhs_map: Dict[MultiSymbol, Set[Rule]] = dict()
         # Track lhs counts
         self.lhs_counts: Dict[MultiSymbol, int] = dict()
+        # LHS groups whose rule counts were updated since probabilities were generated (see update_rule_counts)
+        self.dirty_lhs: Set[MultiSymbol] = set()
+        # Rules added by precolation
+        self.precolated_rules: Dict[Rule, PrecolatedRule] = dict()
+        # Lookup structures derived from the rules for decoding, built lazily and dropped on every alteration
+        self._decode_cache: Dict[str, object] = dict()
+
+    def __getstate__(self):
+        # Derived lookup structures are rebuilt on demand, no need to store them
+        state = self.__dict__.copy()
+        state.pop("_decode_cache", None)
+        return state
+
+    def __setstate__(self, state):
+        # Grammars pickled before updates were tracked have no dirty groups nor precolated rules known
+        self.dirty_lhs = set()
+        self.precolated_rules = dict()
+        self.__dict__.update(state)
+        self._decode_cache = dict()
+
+    def invalidate_decode_cache(self):
+        """
+        Drop lookup structures derived from the rules. Must be called after altering rules or their probabilities
+        without going through the grammar's methods.
+        """
+        self._decode_cache.clear()
+
+    def non_terminal_index(self) -> SymbolIndex:
+        """
+        Enumerate the grammar's non-terminals with dense integer ids, used for indexing array based charts.
+        Ids follow the lexicographic order of the symbol strings, and are therefore stable for a given grammar.
+        """
+        if "non_terminal_index" not in self._decode_cache:
+            symbols = sorted(self.non_terminals, key=lambda sym: sym.symbol_string)
+            self._decode_cache["non_terminal_index"] = SymbolIndex(symbols, {sym: i for i, sym in enumerate(symbols)})
+        return self._decode_cache["non_terminal_index"]
+
+    def lexical_rules(self, word: str) -> ScoredLhsList:
+        """
+        The lexical rules deriving a word, as (lhs, score). Unknown words get the rules of their signature (see
+        unknown_word_index).
+        """
+        rules = self.lexical_index().get(word)
+        return rules if rules is not None else unknown_word_rules(self.unknown_word_index(), word)
+
+    def is_known_word(self, word: str) -> bool:
+        """
+        Whether some lexical rule of the grammar derives a word.
+        """
+        return word in self.lexical_index()
+
+    def unknown_word_index(self) -> Dict[str, ScoredLhsList]:
+        """
+        Index the lexical rules of unknown words by signature : signature -> [(lhs, score)], learned from the
+        grammar's rare words (see lexicon.unknown_word_index).
+        """
+        if "unknown_word_index" not in self._decode_cache:
+            self.renormalize()
+            symbols, symbol_ids = self.non_terminal_index()
+            self._decode_cache["unknown_word_index"] = unknown_word_index(
+                ((rule.rhs[0].symbol_string, symbol_ids[rule.lhs[0]], count_and_prob.count) for
+                 rule, count_and_prob in self.lexical_rule_map.items()),
+                [self.lhs_counts.get(MultiSymbol((sym,)), 0) for sym in symbols])
+        return self._decode_cache["unknown_word_index"]
+
+    def lexical_index(self) -> Dict[str, ScoredLhsList]:
+        """
+        Index lexical rules by their word : word -> [(lhs, score)].
+        """
+        if "lexical_index" not in self._decode_cache:
+            self.renormalize()
+            symbol_ids = self.non_terminal_index().ids
+            index: Dict[str, ScoredLhsList] = dict()
+            for rule, count_and_prob in self.lexical_rule_map.items():
+                index.setdefault(rule.rhs[0].symbol_string, []).append(
+                    (symbol_ids[rule.lhs[0]], count_and_prob.minus_log_prob))
+            self._decode_cache["lexical_index"] = index
+        return self._decode_cache["lexical_index"]
+
+    def binary_rule_index(self, by_right_child=False) -> Dict[int, Dict[int, ScoredLhsList]]:
+        """
+        Index binary syntactic rules by the ids of their RHS symbols : left child -> right child -> [(lhs, score)].
+        Lets a decoder visit only rules whose left child is actually present in the chart.
+        :param by_right_child: True to index by the right child first : right child -> left child -> [(lhs, score)].
+        """
+        key = "binary_rule_index_by_right" if by_right_child else "binary_rule_index"
+        if key not in self._decode_cache:
+            self.renormalize()
+            symbol_ids = self.non_terminal_index().ids
+            index: Dict[int, Dict[int, ScoredLhsList]] = dict()
+            for rhs, rules in self.rhs_to_lhs_map.items():
+                if len(rhs.symbol_list) != 2 or not all(sym in symbol_ids for sym in rhs.symbol_list):
+                    continue
+                first, second = (rhs[1], rhs[0]) if by_right_child else (rhs[0], rhs[1])
+                index.setdefault(symbol_ids[first], dict())[symbol_ids[second]] = [
+                    (symbol_ids[rule.lhs[0]], self[rule].minus_log_prob) for rule in rules]
+            self._decode_cache[key] = index
+        return self._decode_cache[key]
+
+    def unary_rule_index(self) -> Dict[int, ScoredLhsList]:
+        """
+        Index unary (non lexical) rules by the id of their RHS symbol : child -> [(lhs, score)].
+        """
+        if "unary_rule_index" not in self._decode_cache:
+            self.renormalize()
+            symbol_ids = self.non_terminal_index().ids
+            self._decode_cache["unary_rule_index"] = {
+                symbol_ids[rhs[0]]: [(symbol_ids[rule.lhs[0]], self[rule].minus_log_prob) for rule in rules]
+                for rhs, rules in self.rhs_to_lhs_map.items() if len(rhs.symbol_list) == 1 and rhs[0] in symbol_ids}
+        return self._decode_cache["unary_rule_index"]
+
+    def binary_rule_arrays(self) -> RuleArrays:
+        """
+        Binary syntactic rules compiled to arrays, for vectorized decoding.
+        """
+        if "binary_rule_arrays" not in self._decode_cache:
+            self._decode_cache["binary_rule_arrays"] = _rule_arrays(
+                [(lhs, left, right, score) for left, rules_by_right in self.binary_rule_index().items()
+                 for right, rules in rules_by_right.items() for lhs, score in rules])
+        return self._decode_cache["binary_rule_arrays"]
+
+    def unary_closure(self) -> UnaryClosure:
+        """
+        Best-path closure of the unary (non lexical) rules : for every pair of symbols A, B such that A ->* B, the
+        minimal minus log probability over unary chains deriving B from A, along with the chain achieving it.
+        Since the closure is transitive, a decoder needs to apply it only once to every chart cell.
+        """
+        if "unary_closure" not in self._decode_cache:
+            unary_rules = self.unary_rule_index()
+            ancestors: Dict[int, ScoredLhsList] = dict()
+            chains: Dict[Tuple[int, int], Tuple[int, ...]] = dict()
+            for descendant in unary_rules:
+                # Dijkstra up the unary graph, keeping for every reached symbol the symbol below it in the chain
+                scores = {descendant: 0.0}
+                below = {descendant: descendant}
+                done = set()
+                agenda = [(0.0, descendant)]
+                while agenda:
+                    score, symbol = heapq.heappop(agenda)
+                    if symbol in done:
+                        continue
+                    done.add(symbol)
+                    for lhs, rule_minus_log_prob in unary_rules.get(symbol, ()):
+                        if lhs not in scores or score + rule_minus_log_prob < scores[lhs]:
+                            scores[lhs] = score + rule_minus_log_prob
+                            below[lhs] = symbol
+                            heapq.heappush(agenda, (scores[lhs], lhs))
+                del scores[descendant]
+                ancestors[descendant] = list(scores.items())
+                for ancestor in scores:
+                    chain = []
+                    symbol = below[ancestor]
+                    while symbol != descendant:
+                        chain.append(symbol)
+                        symbol = below[symbol]
+                    chains[ancestor, descendant] = tuple(chain)
+            self._decode_cache["unary_closure"] = UnaryClosure(ancestors, chains)
+        return self._decode_cache["unary_closure"]
+
+    def unary_closure_arrays(self) -> RuleArrays:
+        """
+        The unary closure compiled to arrays (ancestor as LHS, descendant as left child), for vectorized decoding.
+        """
+        if "unary_closure_arrays" not in self._decode_cache:
+            self._decode_cache["unary_closure_arrays"] = _rule_arrays(
+                [(ancestor, descendant, -1, score) for descendant, scored_ancestors in
+                 self.unary_closure().ancestors.items() for ancestor, score in scored_ancestors])
+        return self._decode_cache["unary_closure_arrays"]
+
+    def context_summary_estimates(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Lower bounds on the minus log probabilities of derivations, ignoring lexical rules, by symbol id :
+        1. Inside : the cost of deriving the symbol, over any span.
+        2. Outside : the cost of deriving a start symbol with the symbol as one of it's constituents, over any context.
+        Adding the best lexical rule cost of every word in (or outside) a span gives an admissible and consistent
+        estimate, as required for A* decoding. Symbols which can't be derived, or can't be part of a derivation of a
+        start symbol have an infinite estimate.
+        """
+        if "context_summary_estimates" not in self._decode_cache:
+            symbol_ids = self.non_terminal_index().ids
+            preterminal_ids = {lhs for rules in self.lexical_index().values() for lhs, _ in rules}
+            self._decode_cache["context_summary_estimates"] = context_summary_estimates(
+                len(symbol_ids), list(preterminal_ids),
+                [symbol_ids[ss] for ss in self.start_symbols if ss in symbol_ids], self.binary_rule_arrays(),
+                self.unary_closure_arrays())
+        return self._decode_cache["context_summary_estimates"]
+
+    def symbol_feasibility(self) -> SymbolFeasibility:
+        """
+        Symbol level feasibility tables (see SymbolFeasibility), letting decoders skip chart entries and symbol pairs
+        which can never be part of a full parse.
+        """
+        if "symbol_feasibility" not in self._decode_cache:
+            symbol_ids = self.non_terminal_index().ids
+            preterminal_ids = {lhs for rules in self.lexical_index().values() for lhs, _ in rules}
+            self._decode_cache["symbol_feasibility"] = symbol_feasibility(
+                len(symbol_ids), list(preterminal_ids),
+                [symbol_ids[ss] for ss in self.start_symbols if ss in symbol_ids], self.binary_rule_arrays(),
+                self.unary_closure_arrays())
+        return self._decode_cache["symbol_feasibility"]
+
+    def feasible_binary_rule_index(self, table: str) -> Dict[int, Dict[int, ScoredLhsList]]:
+        """
+        The binary rule index (see binary_rule_index) restricted to the rules whose LHS is feasible by one of the
+        symbol feasibility tables, e.g. "root_span" for the rules which may derive an entry of the span of the whole
+        sentence.
+        :param table: The name of the feasibility table (see SymbolFeasibility).
+        """
+        key = "feasible_binary_rule_index", table
+        if key not in self._decode_cache:
+            self._decode_cache[key] = restrict_rule_index(self.binary_rule_index(),
+                                                          getattr(self.symbol_feasibility(), table))
+        return self._decode_cache[key]
+
+    def optimistic_projection(self) -> "ProjectedGrammar":
+        """
+        The optimistic coarse projection of the grammar (see project_grammar) dropping the brother history of "fake"
+        symbols, with the coarse symbol id of every symbol id. Coarse Viterbi scores of a sentence bound the scores of
+        the grammar's derivations from below.
+        """
+        if "optimistic_projection" not in self._decode_cache:
+            coarse = project_grammar(self, strip_brother_history, optimistic=True)
+            coarse_ids = coarse.non_terminal_index().ids
+            symbol_projection = [coarse_ids[NonTerminal(strip_brother_history(sym.symbol_string))] for sym in
+                                 self.non_terminal_index().symbols]
+            self._decode_cache["optimistic_projection"] = ProjectedGrammar(coarse, np.array(symbol_projection,
+                                                                                            dtype=np.int64))
+        return self._decode_cache["optimistic_projection"]
+
+    def fingerprint(self) -> str:
+        """
+        A digest of the grammar's start symbols, rules, their counts and probabilities, and it's precolated rules :
+        grammars decoding alike have the same fingerprint, in every process. Identifies the grammar parses were
+        decoded with (see ParseCache).
+        """
+        if "fingerprint" not in self._decode_cache:
+            self.renormalize()
+            lines = ["{}\t{}\t{!r}".format(rule, count_and_prob.count, count_and_prob.minus_log_prob) for rule_map in
+                     (self.syntactic_rule_map, self.unary_rule_map, self.lexical_rule_map) for rule, count_and_prob in
+                     rule_map.items()]
+            lines.sort()
+            lines += sorted("start\t{}".format(sym) for sym in self.start_symbols)
+            lines += sorted("precolated\t{}\t{}\t{}".format(rule, precolated_rule.source, " ".join(
+                sym.symbol_string for sym in precolated_rule.chain)) for rule, precolated_rule in
+                            self.precolated_rules.items())
+            self._decode_cache["fingerprint"] = hashlib.sha1("\n".join(lines).encode("utf-8")).hexdigest()
+        return self._decode_cache["fingerprint"]
 
     def get_relevant_rule_map(self, rule):
         return self.lexical_rule_map if rule.is_lexical() else self.unary_rule_map if rule.is_unary() else \
             self.syntactic_rule_map
 
     def add_rule(self, rule: Rule):
-        # Add newly seen symbols
-        self.terminals.update({sym for sym in rule.lhs.symbol_list + rule.rhs.symbol_list if type(sym) is Terminal})
-        self.non_terminals.update(
-            {sym for sym in rule.lhs.symbol_list + rule.rhs.symbol_list if type(sym) is NonTerminal})
-        self.start_symbols.update({sym for sym in rule.lhs.symbol_list + rule.rhs.symbol_list if type(
-            sym) is NonTerminal and sym.symbol_string.endswith(
-            "{}S".format(parent_separator)) or sym.symbol_string.endswith(
-            "{}TOP".format(parent_separator)) and brother_separator not in sym.symbol_string})
-        # Find relevant rule map to update
-        rules_to_update = self.get_relevant_rule_map(rule)
-        # Add rule to relevant map if first seen
-        if rule not in rules_to_update:
-            rules_to_update[rule] = CountAndProbability()
-        self.increment_rule_count(rule)
-        # Map LHS and RHS to rule
-        if rule.rhs not in self.rhs_to_lhs_map:
-            self.rhs_to_lhs_map[rule.rhs] = set()
+        self.add_rule_counts({rule: 1})
+
+    def add_rule_counts(self, rule_counts: Dict[Rule, int]):
+        """
+        Add rules along with their counts in a single pass, as adding every rule as many times as it's count would.
+        Rules (and their symbols) are added in the order of the mapping.
+        ! NOTE : Nullifies the probabilities of the rules added, as increment_rule_count.
+        :param rule_counts: Count of every rule to add.
+        :return: None.
+        """
+        self.invalidate_decode_cache()
+        terminals, non_terminals = self.terminals, self.non_terminals
+        rhs_to_lhs_map, lhs_to_rhs_map, lhs_counts = self.rhs_to_lhs_map, self.lhs_to_rhs_map, self.lhs_counts
+        for rule, count in rule_counts.items():
+            # Find relevant rule map to update
+            rules_to_update = self.get_relevant_rule_map(rule)
+            count_and_prob = rules_to_update.get(rule)
+            # Add rule to relevant map (and it's newly seen symbols), and map LHS and RHS to it, if first seen
+            if count_and_prob is None:
+                count_and_prob = rules_to_update[rule] = CountAndProbability()
+                for sym in rule.lhs.symbol_list + rule.rhs.symbol_list:
+                    if sym in non_terminals or sym in terminals:
+                        continue
+                    if type(sym) is Terminal:
+                        terminals.add(sym)
+                        continue
+                    non_terminals.add(sym)
+                    if sym.symbol_string.endswith(_START_SUFFIX) or sym.symbol_string.endswith(
+                            _TOP_SUFFIX) and brother_separator not in sym.symbol_string:
+                        self.start_symbols.add(sym)
+                rules_by_rhs = rhs_to_lhs_map.get(rule.rhs)
+                if rules_by_rhs is None:
+                    rules_by_rhs = rhs_to_lhs_map[rule.rhs] = set()
+                rules_by_lhs = lhs_to_rhs_map.get(rule.lhs)
+                if rules_by_lhs is None:
+                    lhs_counts[rule.lhs] = 0
+                    rules_by_lhs = lhs_to_rhs_map[rule.lhs] = set()
+                rules_by_rhs.add(rule)
+                rules_by_lhs.add(rule)
+            count_and_prob.count += count
+            count_and_prob.minus_log_prob = inf
+            lhs_counts[rule.lhs] += count
+
+    def update_rule_counts(self, rule_counts: Dict[Rule, int]):
+        """
+        Add rules along with their counts to a grammar whose probabilities were already generated, marking the LHS
+        groups of the rules as dirty. Only the probabilities of dirty groups are then regenerated, once needed for
+        decoding (see renormalize).
+        :param rule_counts: Count of every rule to add.
+        :return: None.
+        """
+        self.add_rule_counts(rule_counts)
+        self.dirty_lhs.update(rule.lhs for rule in rule_counts)
+
+    def renormalize(self):
+        """
+        Regenerate the probabilities of the rules of dirty LHS groups, as generate_rule_probabilities would.
+        Rules added by precolation keep their probabilities.
+        :return: None.
+        """
+        if not self.dirty_lhs:
+            return
+        self.invalidate_decode_cache()
+        entries: List[CountAndProbability] = []
+        lhs_counts: List[int] = []
+        for lhs in self.dirty_lhs:
+            group = [self[rule] for rule in self.lhs_to_rhs_map.get(lhs, ()) if rule not in self.precolated_rules]
+            entries += group
+            lhs_counts += [self.lhs_counts.get(lhs, 0)] * len(group)
+        counts = np.fromiter((count_and_prob.count for count_and_prob in entries), np.float64, len(entries))
+        with np.errstate(divide="ignore"):
+            minus_log_probs = -np.log(counts / np.array(lhs_counts, dtype=np.float64))
+        for count_and_prob, minus_log_prob in zip(entries, minus_log_probs.tolist()):
+            count_and_prob.minus_log_prob = minus_log_prob
+        self.dirty_lhs.clear()
+
+    def remove_rule(self, rule: Rule):
+        """
+        Remove a rule from the grammar, along with it's count. Symbols of the rule are kept.
+        :param rule: The rule to remove.
+        :return: None.
+        """
+        relevant_rule_map = self.get_relevant_rule_map(rule)
+        if rule not in relevant_rule_map:
+            raise ValueError("Rule doesn't exist in grammar.")
+        self.invalidate_decode_cache()
+        self.lhs_counts[rule.lhs] -= relevant_rule_map.pop(rule).count
+        for rule_map, key in ((self.rhs_to_lhs_map, rule.rhs), (self.lhs_to_rhs_map, rule.lhs)):
+            rule_map[key].discard(rule)
+            if not rule_map[key]:
+                del rule_map[key]
         if rule.lhs not in self.lhs_to_rhs_map:
-            self.lhs_counts[rule.lhs] = 0
-            self.lhs_to_rhs_map[rule.lhs] = set()
-        self.rhs_to_lhs_map[rule.rhs].update({rule})
-        self.lhs_to_rhs_map[rule.lhs].update({rule})
-        self.lhs_counts[rule.lhs] += 1
+            del self.lhs_counts[rule.lhs]
+        self.precolated_rules.pop(rule, None)
+
+    @classmethod
+    def from_counts(cls, rule_counts: Dict[Rule, int]) -> "ProbGrammar":
+        """
+        Build a grammar from aggregated rule counts (see add_rule_counts). Rule probabilities are yet to be generated.
+        :param rule_counts: Count of every rule of the grammar.
+        :return: The grammar.
+        """
+        grammar = cls()
+        grammar.add_rule_counts(rule_counts)
+        return grammar
 
     def set_rule_count_and_probability(self, rule, count: int, minus_log_prob: float):
         relevant_rule_map = self.get_relevant_rule_map(rule)
         if rule not in relevant_rule_map:
             raise ValueError("Rule doesn't exist in grammar.")
+        self.invalidate_decode_cache()
         relevant_rule_map[rule].count = count
         relevant_rule_map[rule].minus_log_prob = minus_log_prob
 
@@ -91,62 +460,314 @@ class ProbGrammar:
         Attach a probability ( - log of probability ) to every rule in the grammar.
         :return: None.
         """
+        self.invalidate_decode_cache()
         for rule_map in (self.syntactic_rule_map, self.unary_rule_map, self.lexical_rule_map):
-            for rule, count_and_prob in rule_map.items():
-                count_and_prob.minus_log_prob = -log(
-                    float(count_and_prob.count) / float(self.lhs_counts[rule.lhs]))
+            counts = np.fromiter((count_and_prob.count for count_and_prob in rule_map.values()), np.float64,
+                                 len(rule_map))
+            lhs_counts = np.fromiter((self.lhs_counts[rule.lhs] for rule in rule_map), np.float64, len(rule_map))
+            # Rules with no count get an infinite score
+            with np.errstate(divide="ignore"):
+                minus_log_probs = -np.log(counts / lhs_counts)
+            for count_and_prob, minus_log_prob in zip(rule_map.values(), minus_log_probs.tolist()):
+                count_and_prob.minus_log_prob = minus_log_prob
+        self.dirty_lhs.clear()
+
+
+# A coarse grammar, with the coarse symbol id of every symbol id of the grammar it was projected from
+ProjectedGrammar = NamedTuple("ProjectedGrammar", [("grammar", ProbGrammar), ("symbol_projection", np.ndarray)])
+
+
+def _rule_arrays(rules: List[Tuple[int, int, int, float]]) -> RuleArrays:
+    """
+    Compile (lhs, left, right, minus log probability) tuples of symbol ids to rule arrays.
+    """
+    rules = sorted(rules, key=lambda rule: rule[0])
+    lhs = np.array([rule[0] for rule in rules], dtype=np.int64)
+    return RuleArrays(lhs, np.array([rule[1] for rule in rules], dtype=np.int64),
+                      np.array([rule[2] for rule in rules], dtype=np.int64),
+                      np.array([rule[3] for rule in rules], dtype=np.float64), np.flatnonzero(np.diff(lhs, prepend=-1)))
+
+
+def context_summary_estimates(symbol_count: int, preterminal_ids: List[int], start_ids: List[int],
+                              binary_rules: RuleArrays, unary_closure: RuleArrays) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute context summary estimates (see ProbGrammar.context_summary_estimates) from a grammar's rule arrays.
+    :param symbol_count: Number of non-terminals.
+    :param preterminal_ids: Ids of the symbols deriving some word.
+    :param start_ids: Ids of the start symbols.
+    :param binary_rules: The grammar's binary rule arrays.
+    :param unary_closure: The grammar's unary closure arrays.
+    :return: Inside and outside estimates by symbol id.
+    """
+    inside = np.full(symbol_count, inf)
+    inside[preterminal_ids] = 0.0
+    _relax_to_fixpoint(inside, [
+        (binary_rules.lhs, lambda: inside[binary_rules.left] + inside[binary_rules.right] +
+                                   binary_rules.minus_log_probs),
+        (unary_closure.lhs, lambda: inside[unary_closure.left] + unary_closure.minus_log_probs)])
+    outside = np.full(symbol_count, inf)
+    outside[start_ids] = 0.0
+    _relax_to_fixpoint(outside, [
+        (binary_rules.left, lambda: outside[binary_rules.lhs] + binary_rules.minus_log_probs +
+                                    inside[binary_rules.right]),
+        (binary_rules.right, lambda: outside[binary_rules.lhs] + binary_rules.minus_log_probs +
+                                     inside[binary_rules.left]),
+        (unary_closure.left, lambda: outside[unary_closure.lhs] + unary_closure.minus_log_probs)])
+    return inside, outside
+
+
+def symbol_feasibility(symbol_count: int, preterminal_ids: List[int], start_ids: List[int],
+                       binary_rules: RuleArrays, unary_closure: RuleArrays) -> SymbolFeasibility:
+    """
+    Compute symbol feasibility tables (see ProbGrammar.symbol_feasibility) from a grammar's rule arrays.
+    :param symbol_count: Number of non-terminals.
+    :param preterminal_ids: Ids of the symbols deriving some word.
+    :param start_ids: Ids of the start symbols.
+    :param binary_rules: The grammar's binary rule arrays.
+    :param unary_closure: The grammar's unary closure arrays.
+    :return: The feasibility tables.
+    """
+    # The closure being transitive, a single pass over it derives every symbol reached by unary chains
+    derives_word = np.zeros(symbol_count, dtype=bool)
+    derives_word[preterminal_ids] = True
+    derives_word[unary_closure.lhs[derives_word[unary_closure.left]]] = True
+    derives_words = np.zeros(symbol_count, dtype=bool)
+    derives_words[binary_rules.lhs] = True
+    derives_words[unary_closure.lhs[derives_words[unary_closure.left]]] = True
+    spans = []
+    for children in (binary_rules.left, binary_rules.right, start_ids):
+        child = np.zeros(symbol_count, dtype=bool)
+        child[children] = True
+        span = child.copy()
+        span[unary_closure.left[child[unary_closure.lhs]]] = True
+        spans.append((child, span))
+    (left_child, left_span), (right_child, right_span), (_, root_span) = spans
+    reachable = root_span.copy()
+    grown = True
+    while grown:
+        previous = reachable.copy()
+        reachable[binary_rules.left[reachable[binary_rules.lhs]]] = True
+        reachable[binary_rules.right[reachable[binary_rules.lhs]]] = True
+        reachable[unary_closure.left[reachable[unary_closure.lhs]]] = True
+        grown = bool((reachable != previous).any())
+    return SymbolFeasibility(derives_word & ~derives_words, left_child, right_child, left_span, right_span, root_span,
+                             reachable)
+
+
+def restrict_rule_index(index: Dict[int, Dict[int, ScoredLhsList]],
+                        lhs_feasible: np.ndarray) -> Dict[int, Dict[int, ScoredLhsList]]:
+    """
+    Restrict a binary rule index (see ProbGrammar.binary_rule_index) to the rules whose LHS is feasible.
+    :param index: The binary rule index.
+    :param lhs_feasible: True for feasible LHS, by symbol id.
+    :return: A new index, without children pairs left with no rules.
+    """
+    lhs_feasible = lhs_feasible.tolist()
+    restricted: Dict[int, Dict[int, ScoredLhsList]] = dict()
+    for first, rules_by_second in index.items():
+        for second, rules in rules_by_second.items():
+            rules = [(lhs, score) for lhs, score in rules if lhs_feasible[lhs]]
+            if rules:
+                restricted.setdefault(first, dict())[second] = rules
+    return restricted
+
+
+def _relax_to_fixpoint(estimates: np.ndarray, relaxations: List[Tuple[np.ndarray, Callable[[], np.ndarray]]]):
+    """
+    Minimize estimates in place until no relaxation improves them.
+    :param estimates: Estimate by symbol id.
+    :param relaxations: Pairs of target symbol ids and a function computing the candidate estimate of every target.
+    """
+    improved = True
+    while improved:
+        improved = False
+        for targets, candidates in relaxations:
+            previous = estimates.copy()
+            np.minimum.at(estimates, targets, candidates())
+            improved |= bool((estimates < previous).any())
 
 
 def precolate_grammar(grammar: ProbGrammar) -> ProbGrammar:
     """
     Collapse unit rules in the grammar.
     :param grammar: The grammar to collapse unit rules in.
-    :return: None.
+    :return: The grammar, altered in place.
 
-    Collapses all unit rules in BINARY (!) grammar: For each A ->* BC, the rule A->BC is added.
+    Collapses all unit rules in BINARY (!) grammar: For each A ->* B --> C D, the rule A --> C D is added, scored by the
+    best unit chain A ->* B (taken from the grammar's unary closure, see ProbGrammar.unary_closure) and B --> C D. If
+    several chains derive A --> C D, the most probable is kept. Rules are added in a single pass once all are scored.
     !Notes :
     1. Rules must have probability already generated !
-    2. Rules added in this function shall have no count.
-    3. Although all possible rules are added recursively, new unit rules ARE NOT added.
-    """
-    # Keep track of unhandled unary rules
-    unit_rules = [urule for urule in grammar.unary_rule_map]
-    # Generate local copy of unary rules, ATM we do not wish to alter grammar's instance
-    unit_rule_map = copy.deepcopy(grammar.unary_rule_map)
-    # While unhandled unary rules remain
-    while unit_rules:
-        # Pop A --> B
-        unit_rule = unit_rules.pop()
-        # Find all unit rules with current rule's RHS as LHS:
-        # i.e all rules B --> C
-        for urule in unit_rules:
-            if urule.lhs == unit_rule.rhs:
-                # Shortcut A and C : Create a rule A --> C
-                new_rule = Rule(unit_rule.lhs, urule.rhs)
-                # If this is a new rule, add it as a new unit rule to local copy of unit rule map
-                if new_rule not in unit_rule_map:
-                    # TODO : Currently count is disregarded and only probability is generated.
-                    unit_rule_map[new_rule] = CountAndProbability(0, unit_rule_map[unit_rule].minus_log_prob +
-                                                                  unit_rule_map[unit_rule].minus_log_prob)
-                    # Add the new unit rule for further handling
-                    unit_rules.append(new_rule)
-        # Expand unary rule to all immediate binary rules
-        # Traverse all non-unary rules with current (unary) rule's RHS as LHS : B --> C D
-        for rule in grammar.lhs_to_rhs_map[unit_rule.rhs]:
+    2. Rules added in this function have no count, and don't alter LHS counts.
+    3. Although rules are added for all unit chains, new unit rules ARE NOT added.
+    4. Every rule added is kept in the grammar's precolated_rules, along with the rule and chain it was derived from,
+       so that parses can be reverted to the original rules (see revert_precolation).
+    """
+    symbols = grammar.non_terminal_index().symbols
+    unary_closure = grammar.unary_closure()
+    new_rules: Dict[Rule, Tuple[float, Rule, int, int]] = dict()
+    for descendant, scored_ancestors in unary_closure.ancestors.items():
+        ancestors = [(MultiSymbol((symbols[ancestor],)), ancestor, chain_minus_log_prob) for
+                     ancestor, chain_minus_log_prob in scored_ancestors]
+        # Expand unit chains to all immediate non-unary rules of the chain's bottom : B --> C D
+        for rule in grammar.lhs_to_rhs_map[MultiSymbol((symbols[descendant],))]:
             if rule.is_unary() and not rule.is_lexical():
                 continue
-            # Create a rule A --> C D
-            new_rule = Rule(unit_rule.lhs, rule.rhs)
-            # TODO : If rule already exists in grammar, how to choose probability ?
-            if new_rule not in grammar:
-                grammar.add_rule(new_rule)
-                # Take the unit rule's probability from the local copy as it might have unit rules which do not exist
-                # in the grammar
-                grammar[new_rule].minus_log_prob = grammar[rule].minus_log_prob + unit_rule_map[
-                    unit_rule].minus_log_prob
+            rule_minus_log_prob = grammar[rule].minus_log_prob
+            for lhs, ancestor, chain_minus_log_prob in ancestors:
+                # Create a rule A --> C D
+                new_rule = Rule(lhs, rule.rhs)
+                # TODO : If rule already exists in grammar, how to choose probability ?
+                if new_rule in grammar:
+                    continue
+                minus_log_prob = rule_minus_log_prob + chain_minus_log_prob
+                best = new_rules.get(new_rule)
+                if best is None or minus_log_prob < best[0]:
+                    new_rules[new_rule] = (minus_log_prob, rule, ancestor, descendant)
+    grammar.add_rule_counts(dict.fromkeys(new_rules, 0))
+    for new_rule, (minus_log_prob, rule, ancestor, descendant) in new_rules.items():
+        grammar[new_rule].minus_log_prob = minus_log_prob
+        grammar.precolated_rules[new_rule] = PrecolatedRule(rule, tuple(
+            symbols[sym] for sym in unary_closure.chains[ancestor, descendant]))
     return grammar
 
 
+# Best unary chains by pair of symbols : (ancestor, descendant) -> (score, intermediate symbols of the chain)
+_ScoredChains = Dict[Tuple[Symbol, Symbol], Tuple[float, Tuple[Symbol, ...]]]
+
+
+def _scored_chains(grammar: ProbGrammar) -> _ScoredChains:
+    """
+    The grammar's unary closure (see ProbGrammar.unary_closure) by symbols rather than symbol ids, which change as
+    symbols are added.
+    """
+    symbols = grammar.non_terminal_index().symbols
+    unary_closure = grammar.unary_closure()
+    return {(symbols[ancestor], symbols[descendant]): (
+        score, tuple(symbols[sym] for sym in unary_closure.chains[ancestor, descendant]))
+        for descendant, scored_ancestors in unary_closure.ancestors.items() for ancestor, score in scored_ancestors}
+
+
+class IncrementalPrecolation:
+    """
+    Re-runs the parts of precolation (see precolate_grammar) affected by an update of a precolated grammar's rule counts
+    (see GrammarTransformationPipeline.update), leaving the grammar as precolating it from scratch would.
+    A precolated rule A --> C D depends on the best unary chain A ->* B and on B --> C D, for every such B. Only rules
+    of pairs A ->* B having A, B or an intermediate symbol of their chain in an updated LHS group, or whose chain
+    changed, are derived again.
+    """
+
+    def __init__(self):
+        self.updated_symbols: Set[Symbol] = set()
+        self.chains: _ScoredChains = dict()
+
+    def before_update(self, grammar: ProbGrammar, rule_counts: Dict[Rule, int]):
+        """
+        Called before the rule counts are added to the grammar.
+        """
+        self.updated_symbols = {rule.lhs[0] for rule in rule_counts}
+        self.chains = _scored_chains(grammar)
+        # Precolated rules counted by the update become plain rules
+        for rule in [rule for rule in rule_counts if rule in grammar.precolated_rules]:
+            grammar.remove_rule(rule)
+
+    def after_update(self, grammar: ProbGrammar):
+        """
+        Called once the rule counts were added to the grammar.
+        """
+        # Chains are scored by the updated probabilities
+        grammar.renormalize()
+        chains = _scored_chains(grammar)
+        precolated_rules, lhs_to_rhs_map = grammar.precolated_rules, grammar.lhs_to_rhs_map
+        updated = self.updated_symbols
+        affected_pairs = {pair for pair, (_, chain) in list(self.chains.items()) + list(chains.items()) if
+                          pair[0] in updated or pair[1] in updated or not updated.isdisjoint(chain) or
+                          self.chains.get(pair) != chains.get(pair)}
+        # Non-unary (or lexical) rules which are not precolated, with their minus log probabilities, by bottom symbol
+        # of the chains of affected pairs, and of every chain of their ancestors
+        affected_ancestors = {ancestor for ancestor, _ in affected_pairs}
+        source_rules: Dict[Symbol, List[Tuple[Rule, float]]] = dict()
+        for _, descendant in affected_pairs | {pair for pair in chains if pair[0] in affected_ancestors}:
+            if descendant not in source_rules:
+                source_rules[descendant] = [
+                    (rule, grammar[rule].minus_log_prob) for rule in lhs_to_rhs_map.get(MultiSymbol((descendant,)), ())
+                    if (rule.is_lexical() or not rule.is_unary()) and rule not in precolated_rules]
+        # RHS of the precolated rules to derive again, by LHS symbol
+        affected_rhs: Dict[Symbol, Set[MultiSymbol]] = dict()
+        for ancestor, descendant in affected_pairs:
+            affected_rhs.setdefault(ancestor, set()).update(rule.rhs for rule, _ in source_rules[descendant])
+        # The most probable A ->* B --> C D over all B, for every affected A --> C D
+        new_rules: Dict[Tuple[Symbol, MultiSymbol], Tuple[float, Rule, Tuple[Symbol, ...]]] = dict()
+        for (ancestor, descendant), (chain_minus_log_prob, chain) in chains.items():
+            rhs_set = affected_rhs.get(ancestor)
+            if not rhs_set:
+                continue
+            for rule, rule_minus_log_prob in source_rules[descendant]:
+                if rule.rhs in rhs_set:
+                    minus_log_prob = rule_minus_log_prob + chain_minus_log_prob
+                    best = new_rules.get((ancestor, rule.rhs))
+                    if best is None or minus_log_prob < best[0]:
+                        new_rules[ancestor, rule.rhs] = (minus_log_prob, rule, chain)
+        # Precolated rules no longer derived are removed, others are updated in place
+        for rule in [rule for rule in precolated_rules if rule.rhs in affected_rhs.get(rule.lhs[0], ())]:
+            if (rule.lhs[0], rule.rhs) not in new_rules:
+                grammar.remove_rule(rule)
+        for (ancestor, rhs), (minus_log_prob, rule, chain) in new_rules.items():
+            new_rule = Rule(MultiSymbol((ancestor,)), rhs)
+            if new_rule not in precolated_rules:
+                if new_rule in grammar:
+                    continue
+                grammar.add_rule_counts({new_rule: 0})
+            grammar[new_rule].minus_log_prob = minus_log_prob
+            precolated_rules[new_rule] = PrecolatedRule(rule, chain)
+        grammar.invalidate_decode_cache()
+
+
+def project_grammar(grammar: ProbGrammar, projection: Callable[[str], str] = project_tag,
+                    optimistic: bool = False) -> ProbGrammar:
+    """
+    Generate a coarse grammar by projecting every non-terminal of a grammar to a coarser symbol.
+    :param grammar: The (fine) grammar to project.
+    :param projection: Maps a fine tag to it's coarse tag. By default binarization annotations are stripped.
+    :param optimistic: False to generate the coarse probabilities from counts summed over the fine rules projected to
+                       every coarse rule, True to score every coarse rule by the best of these fine rules instead, so
+                       that coarse derivations never score worse than the fine derivations projected to them.
+    :return: A new grammar over the projected symbols.
+
+    Note : Unless optimistic, rules with no count (such as those added by precolation) are not projected.
+    """
+
+    def __project(multi_symbol: MultiSymbol) -> MultiSymbol:
+        return MultiSymbol(tuple(NonTerminal(projection(sym.symbol_string)) if type(sym) is NonTerminal else sym
+                                 for sym in multi_symbol.symbol_list))
+
+    coarse_counts: Dict[Rule, int] = dict()
+    coarse_minus_log_probs: Dict[Rule, float] = dict()
+    for rule_map in (grammar.syntactic_rule_map, grammar.unary_rule_map, grammar.lexical_rule_map):
+        for rule, count_and_prob in rule_map.items():
+            if count_and_prob.count or optimistic:
+                coarse_rule = Rule(__project(rule.lhs), __project(rule.rhs))
+                coarse_counts[coarse_rule] = coarse_counts.get(coarse_rule, 0) + count_and_prob.count
+                coarse_minus_log_probs[coarse_rule] = min(coarse_minus_log_probs.get(coarse_rule, inf),
+                                                          count_and_prob.minus_log_prob)
+    coarse = ProbGrammar.from_counts(coarse_counts)
+    for coarse_rule, minus_log_prob in coarse_minus_log_probs.items():
+        coarse[coarse_rule].minus_log_prob = minus_log_prob
+    coarse.start_symbols = {NonTerminal(projection(sym.symbol_string)) for sym in grammar.start_symbols}
+    if not optimistic:
+        coarse.generate_rule_probabilities()
+    return coarse
+
+
+def child_groups(children: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Order rules by a child, returning the ordering, the child id of every group and the groups' offsets.
+    """
+    order = np.argsort(children, kind="stable")
+    group_starts = np.flatnonzero(np.diff(children[order], prepend=-1))
+    return order, children[order][group_starts], group_starts
+
+
 def write_grammar_to_files(grammar: ProbGrammar, gram_path: str, lex_path: str):
     """
     Write a grammar to gram,lex files.
@@ -0,0 +1,152 @@
+from typing import Dict, List, NamedTuple, Tuple
+
+from math import log
+
+from src.parser.compact_grammar import compact_nbytes
+from src.parser.grammar import ProbGrammar
+from src.parser.rule import Rule
+from src.parser.symbol import NonTerminal, MultiSymbol, Symbol
+from src.util.tree.cnf import brother_separator, parent_separator, strip_brother_history
+
+# Sizes of a grammar before and after a reduction : number of rules, of binary rules (which decoding cost grows
+# with), of symbols (non-terminals and terminals), and bytes as a compact grammar (see compact_nbytes)
+ReductionReport = NamedTuple("ReductionReport", [("name", str), ("rules", Tuple[int, int]),
+                                                 ("binary_rules", Tuple[int, int]), ("symbols", Tuple[int, int]),
+                                                 ("nbytes", Tuple[int, int])])
+
+
+class GrammarReduction:
+    """
+    A grammar transformer (see GrammarTransformationPipeline) shrinking a grammar for faster decoding, at the cost of
+    some accuracy. Subclasses reduce the grammar's rule counts (see reduce_counts), from which a new grammar is built
+    and it's probabilities are generated, as done in training. Symbols left with no rules are dropped.
+
+    Reductions alter rule counts, so they should run before transformations adding rules with no count (as
+    precolation), and can't be applied incrementally (see GrammarTransformationPipeline.update).
+    A report of the reduction (see ReductionReport) is kept for every grammar reduced, and printed if verbose.
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.reports: List[ReductionReport] = []
+
+    def reduce_counts(self, grammar: ProbGrammar) -> Dict[Rule, int]:
+        """
+        The counts of the rules of the reduced grammar.
+        """
+        raise NotImplementedError
+
+    def __call__(self, grammar: ProbGrammar) -> ProbGrammar:
+        if grammar.precolated_rules:
+            raise ValueError("Grammar reductions should run before precolation.")
+        reduced = ProbGrammar.from_counts(self.reduce_counts(grammar))
+        reduced.generate_rule_probabilities()
+        self.reports.append(ReductionReport(type(self).__name__, *zip(_grammar_sizes(grammar),
+                                                                      _grammar_sizes(reduced))))
+        if self.verbose:
+            print(self)
+        return reduced
+
+    def __str__(self):
+        if not self.reports:
+            return "{} : no grammar reduced".format(type(self).__name__)
+        report = self.reports[-1]
+        return "{} : ".format(report.name) + ", ".join("{} {} -> {} ({:.1%})".format(
+            name, before, after, 1 - after / before if before else 0.0) for name, (before, after) in
+            zip(ReductionReport._fields[1:], report[1:]))
+
+
+class RulePruning(GrammarReduction):
+    """
+    Drop rules seen less than min_count times, or whose probability is below min_prob. Either may be disabled by
+    leaving it as None. Lexical rules are kept unless pruning them too, as pruning them makes words unknown.
+    """
+
+    def __init__(self, min_count: int = None, min_prob: float = None, prune_lexical=False, verbose=False):
+        super().__init__(verbose)
+        self.min_count = min_count
+        self.min_prob = min_prob
+        self.prune_lexical = prune_lexical
+
+    def reduce_counts(self, grammar: ProbGrammar) -> Dict[Rule, int]:
+        max_minus_log_prob = -log(self.min_prob) if self.min_prob is not None else None
+        rule_counts: Dict[Rule, int] = dict()
+        for rule_map in (grammar.syntactic_rule_map, grammar.unary_rule_map, grammar.lexical_rule_map):
+            for rule, count_and_prob in rule_map.items():
+                if self.prune_lexical or not rule.is_lexical():
+                    if self.min_count is not None and count_and_prob.count < self.min_count:
+                        continue
+                    if max_minus_log_prob is not None and count_and_prob.minus_log_prob > max_minus_log_prob:
+                        continue
+                rule_counts[rule] = count_and_prob.count
+        return rule_counts
+
+
+class RuleCap(GrammarReduction):
+    """
+    Keep at most max_rules rules of every LHS, the most frequent (the first in the grammar's order among rules seen as
+    many times). Lexical rules are kept unless capping them too, as capping them makes words unknown.
+    """
+
+    def __init__(self, max_rules: int, cap_lexical=False, verbose=False):
+        super().__init__(verbose)
+        self.max_rules = max_rules
+        self.cap_lexical = cap_lexical
+
+    def reduce_counts(self, grammar: ProbGrammar) -> Dict[Rule, int]:
+        rules_by_lhs: Dict[MultiSymbol, List[Tuple[Rule, int]]] = dict()
+        rule_counts: Dict[Rule, int] = dict()
+        for rule_map in (grammar.syntactic_rule_map, grammar.unary_rule_map, grammar.lexical_rule_map):
+            for rule, count_and_prob in rule_map.items():
+                if self.cap_lexical or not rule.is_lexical():
+                    rules_by_lhs.setdefault(rule.lhs, []).append((rule, count_and_prob.count))
+                else:
+                    rule_counts[rule] = count_and_prob.count
+        for rules in rules_by_lhs.values():
+            rules.sort(key=lambda rule_and_count: -rule_and_count[1])
+            rule_counts.update(rules[:self.max_rules])
+        return rule_counts
+
+
+class RareSymbolMerging(GrammarReduction):
+    """
+    Merge rare "fake" symbols created by markovization, i.e. seen as an LHS less than min_count times, into the symbol
+    having the same parent context and brothers to generate, but no history of brothers already generated
+    (see strip_brother_history), e.g. S|NP-VP*PP-yyDOT -> S|*PP-yyDOT. Rules are rewritten over merged symbols, and
+    counts of rules rewritten to the same rule are summed. Merged symbols are still "fake", so trees parsed with the
+    reduced grammar are reverted as usual (see revert_binarization).
+    """
+
+    def __init__(self, min_count: int, verbose=False):
+        super().__init__(verbose)
+        self.min_count = min_count
+
+    def reduce_counts(self, grammar: ProbGrammar) -> Dict[Rule, int]:
+        merged: Dict[Symbol, Symbol] = dict()
+        for lhs, count in grammar.lhs_counts.items():
+            tag = lhs[0].symbol_string
+            if count < self.min_count and brother_separator in tag.rpartition(parent_separator)[2]:
+                merged[lhs[0]] = NonTerminal(strip_brother_history(tag))
+
+        def __merge(multi_symbol: MultiSymbol) -> MultiSymbol:
+            if not any(sym in merged for sym in multi_symbol.symbol_list):
+                return multi_symbol
+            return MultiSymbol(tuple(merged.get(sym, sym) for sym in multi_symbol.symbol_list))
+
+        rule_counts: Dict[Rule, int] = dict()
+        for rule_map in (grammar.syntactic_rule_map, grammar.unary_rule_map, grammar.lexical_rule_map):
+            for rule, count_and_prob in rule_map.items():
+                lhs, rhs = __merge(rule.lhs), __merge(rule.rhs)
+                if lhs is not rule.lhs or rhs is not rule.rhs:
+                    rule = Rule(lhs, rhs)
+                rule_counts[rule] = rule_counts.get(rule, 0) + count_and_prob.count
+        return rule_counts
+
+
+def _grammar_sizes(grammar: ProbGrammar) -> Tuple[int, int, int, int]:
+    """
+    Number of rules, binary rules and symbols of a grammar, and it's size in bytes as a compact grammar.
+    """
+    rule_count = len(grammar.syntactic_rule_map) + len(grammar.unary_rule_map) + len(grammar.lexical_rule_map)
+    symbol_count = len(grammar.non_terminals) + len(grammar.terminals)
+    return rule_count, len(grammar.syntactic_rule_map), symbol_count, compact_nbytes(rule_count, symbol_count)
@@ -0,0 +1,222 @@
+import heapq
+from typing import List, Tuple, Dict, Iterator, Optional, Set, Hashable
+
+from math import inf
+
+import numpy as np
+
+from src.parser.cky import CkyChart, max_plus_chart, LEXICAL_SPLIT, UNARY_SPLIT
+from src.parser.grammar import ProbGrammar, RuleArrays
+from src.parser.pruning import CellPruning
+from src.parser.symbol import Symbol
+from src.util.tree.node import Node
+
+# A node of a chart's hypergraph : (closed, span length, span start, symbol id). Closed nodes are entries after
+# applying unary chains, derived by a (possibly empty) unary chain from an entry of the same cell which isn't closed.
+# Other nodes are derived by lexical rules, or by binary rules from closed nodes. None is the hypergraph's goal node.
+ChartNode = Tuple[bool, int, int, int]
+# A hyperedge into a chart node, in the layout of chart backpointers : (score, split, left id, right id). Unary chain
+# edges keep the chain's bottom symbol as the left id, goal edges keep the start symbol.
+Hyperedge = Tuple[float, int, int, int]
+# A derivation of a node : (score, hyperedge, rank of the derivation used for every tail node of the hyperedge)
+Derivation = Tuple[float, Hashable, Tuple[int, ...]]
+
+
+class ChartHypergraph:
+    """
+    The hypergraph of derivations held by a filled chart (which kept it's derived scores). Hyperedges are enumerated
+    from the chart's scores when asked for.
+
+    Hypergraphs used for k-best extraction (see KBestExtractor) provide :
+    1. incoming(node) : The hyperedges into a node, each with the score of the best derivation using it. Hyperedges
+       are hashable, and hold their own score first.
+    2. tails(node, hyperedge) : The nodes a hyperedge derives it's head from.
+    3. build_tree(node, hyperedge, children) : The tree of a derivation, given the trees of the hyperedge's tails.
+    """
+
+    def __init__(self, grammar: ProbGrammar, chart: CkyChart, symbol_ids: Dict[Symbol, int], include_unary=False):
+        assert chart.derived_scores is not None
+        self.chart = chart
+        self.include_unary = include_unary
+        self.binary_rules = grammar.binary_rule_arrays()
+        self.unary_closure = grammar.unary_closure_arrays()
+        n = len(chart.sentence)
+        self.start_ids = [symbol_ids[ss] for ss in grammar.start_symbols if
+                          ss in symbol_ids and chart.scores[n, 0, symbol_ids[ss]] < inf]
+
+    def incoming(self, node: Optional[ChartNode]) -> List[Tuple[float, Hyperedge]]:
+        chart = self.chart
+        if node is None:
+            n = len(chart.sentence)
+            return [(chart.scores.item(n, 0, start_id), (0.0, UNARY_SPLIT, start_id, -1)) for start_id in
+                    self.start_ids]
+
+        closed, span_length, span_start, symbol_id = node
+        edges = []
+        if closed:
+            derived_scores = chart.derived_scores[span_length, span_start]
+            if derived_scores[symbol_id] < inf:
+                edges.append((derived_scores.item(symbol_id), (0.0, UNARY_SPLIT, symbol_id, -1)))
+            if self.include_unary:
+                chains = _lhs_slice(self.unary_closure, symbol_id)
+                descendants, chain_scores = self.unary_closure.left[chains], self.unary_closure.minus_log_probs[chains]
+                scores = chain_scores + derived_scores[descendants]
+                edges += [(scores.item(i), (chain_scores.item(i), UNARY_SPLIT, descendants.item(i), -1)) for i in
+                          np.flatnonzero(scores < inf).tolist()]
+        elif span_length == 1:
+            score = chart.derived_scores.item(span_length, span_start, symbol_id)
+            edges.append((score, (score, LEXICAL_SPLIT, -1, -1)))
+        else:
+            rules = _lhs_slice(self.binary_rules, symbol_id)
+            left, right, rule_scores = (self.binary_rules.left[rules], self.binary_rules.right[rules],
+                                        self.binary_rules.minus_log_probs[rules])
+            for split in range(1, span_length):
+                scores = chart.scores[split, span_start][left] + rule_scores + chart.scores[
+                    span_length - split, span_start + split][right]
+                edges += [(scores.item(i), (rule_scores.item(i), split, left.item(i), right.item(i))) for i in
+                          np.flatnonzero(scores < inf).tolist()]
+        return edges
+
+    def tails(self, node: Optional[ChartNode], edge: Hyperedge) -> Tuple[ChartNode, ...]:
+        _, split, left_id, right_id = edge
+        if node is None:
+            return (True, len(self.chart.sentence), 0, left_id),
+        _, span_length, span_start, _ = node
+        if split == LEXICAL_SPLIT:
+            return ()
+        if split == UNARY_SPLIT:
+            return (False, span_length, span_start, left_id),
+        return (True, split, span_start, left_id), (True, span_length - split, span_start + split, right_id)
+
+    def build_tree(self, node: Optional[ChartNode], edge: Hyperedge, children: List[Node]) -> Node:
+        chart = self.chart
+        if node is None:
+            return children[0]
+        closed, span_length, span_start, symbol_id = node
+        if edge[1] == LEXICAL_SPLIT:
+            return Node(chart.tags[symbol_id], [Node(chart.sentence[span_start])])
+        if closed:
+            if edge[2] == symbol_id:
+                return children[0]
+            tree = children[0]
+            for symbol in reversed(chart.unary_chains.get((symbol_id, edge[2]), ())):
+                tree = Node(chart.tags[symbol], [tree])
+            return Node(chart.tags[symbol_id], [tree])
+        return Node(chart.tags[symbol_id], children)
+
+
+class _NodeDerivations:
+    """
+    The derivations of a node found so far (best first), and the candidates for the next one.
+    """
+
+    def __init__(self, candidates: List[Tuple[float, int, Hashable, Tuple[int, ...]]]):
+        heapq.heapify(candidates)
+        self.derivations: List[Derivation] = []
+        self.candidates = candidates
+        self.seen: Set[Tuple[Hashable, Tuple[int, ...]]] = {(edge, ranks) for _, _, edge, ranks in candidates}
+
+
+class KBestExtractor:
+    """
+    Lazy extraction of the k best derivations of a hypergraph's goal node (None), following algorithm 3 of
+    Huang & Chiang (2005) "Better k-best parsing". See ChartHypergraph for the hypergraph's interface.
+    Hyperedges are enumerated only for nodes reached by the extraction. The i'th best derivation of a node is found
+    only once asked for, by advancing the rank of a single tail of the derivations found so far, so every derivation
+    after the first costs about a logarithmic number of operations per node of it's tree.
+
+    In a chart's hypergraph unary chains are the grammar's best chains (see ProbGrammar.unary_closure), so derivations
+    differing only by the chain deriving a symbol from another one are not enumerated.
+    """
+
+    def __init__(self, hypergraph):
+        self.hypergraph = hypergraph
+        self._nodes: Dict[Hashable, _NodeDerivations] = dict()
+        self._counter = 0
+
+    def __iter__(self) -> Iterator[Tuple[Node, float]]:
+        """
+        Iterate the derivations of the goal node best first.
+        :return: An iterator of (tree, minus log probability of the tree's derivation).
+        """
+        rank = 0
+        while True:
+            derivation = self._kth_best(None, rank)
+            if derivation is None:
+                return
+            yield self._build_tree(None, rank), derivation[0]
+            rank += 1
+
+    def _kth_best(self, node: Hashable, k: int) -> Optional[Derivation]:
+        """
+        Find the k'th best derivation (0 based) of a node, or None if the node has no more derivations.
+        """
+        derivations = self._nodes.get(node)
+        if derivations is None:
+            candidates = []
+            for score, edge in self.hypergraph.incoming(node):
+                self._push(candidates, score, edge, (0,) * len(self.hypergraph.tails(node, edge)))
+            derivations = self._nodes[node] = _NodeDerivations(candidates)
+        while len(derivations.derivations) <= k:
+            if derivations.derivations:
+                self._push_successors(node, derivations, derivations.derivations[-1])
+            if not derivations.candidates:
+                return None
+            score, _, edge, ranks = heapq.heappop(derivations.candidates)
+            derivations.derivations.append((score, edge, ranks))
+        return derivations.derivations[k]
+
+    def _push_successors(self, node: Hashable, derivations: _NodeDerivations, derivation: Derivation):
+        """
+        Add the derivations following a derivation (advancing the rank of one of it's tails) to a node's candidates.
+        """
+        _, edge, ranks = derivation
+        tails = self.hypergraph.tails(node, edge)
+        for i, tail in enumerate(tails):
+            next_ranks = ranks[:i] + (ranks[i] + 1,) + ranks[i + 1:]
+            if (edge, next_ranks) in derivations.seen or self._kth_best(tail, next_ranks[i]) is None:
+                continue
+            derivations.seen.add((edge, next_ranks))
+            score = edge[0] + sum(self._kth_best(tail_node, rank)[0] for tail_node, rank in zip(tails, next_ranks))
+            self._push(derivations.candidates, score, edge, next_ranks)
+
+    def _push(self, candidates: list, score: float, edge: Hashable, ranks: Tuple[int, ...]):
+        # The counter breaks ties in order of discovery
+        heapq.heappush(candidates, (score, self._counter, edge, ranks))
+        self._counter += 1
+
+    def _build_tree(self, node: Hashable, rank: int) -> Node:
+        """
+        Build the parse tree of a node's derivation of a given rank (which was already found).
+        """
+        _, edge, ranks = self._kth_best(node, rank)
+        children = [self._build_tree(tail, tail_rank) for tail, tail_rank in
+                    zip(self.hypergraph.tails(node, edge), ranks)]
+        return self.hypergraph.build_tree(node, edge, children)
+
+
+def _lhs_slice(rules: RuleArrays, lhs: int) -> slice:
+    return slice(np.searchsorted(rules.lhs, lhs, "left"), np.searchsorted(rules.lhs, lhs, "right"))
+
+
+def parse_hypergraph(grammar: ProbGrammar, sentence: List[str], include_unary=False, pruning: CellPruning = None) -> \
+        ChartHypergraph:
+    """
+    Parse a sentence, keeping the hypergraph of all it's derivations in the (possibly pruned) chart.
+    :param grammar: The probabilistic grammar to use.
+    :param sentence: A sentence of lexical tokens separated by white space.
+    :param include_unary: True if to support unary rules in run, False otherwise.
+    :param pruning: Pruning to apply to chart cells, None for exhaustive decoding.
+    :return: The chart's hypergraph.
+    """
+    chart, symbol_ids = max_plus_chart(grammar, sentence, include_unary, pruning, keep_derived=True)
+    return ChartHypergraph(grammar, chart, symbol_ids, include_unary)
+
+
+def kbest_parses(grammar: ProbGrammar, sentence: List[str], include_unary=False, pruning: CellPruning = None) -> \
+        Iterator[Tuple[Node, float]]:
+    """
+    Parse a sentence once, and lazily extract it's derivations best first (see KBestExtractor).
+    :return: An iterator of (parse tree, minus log probability), best first.
+    """
+    return iter(KBestExtractor(parse_hypergraph(grammar, sentence, include_unary, pruning)))
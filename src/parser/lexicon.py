@@ -0,0 +1,84 @@
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from math import log
+
+# Words seen at most this many times in training are rare : the tags of rare words are those unknown words are
+# likely to have
+RARE_WORD_COUNT = 1
+# Signatures of less rare word occurrences than this back off to more general signatures (see word_signatures)
+MIN_SIGNATURE_COUNT = 5
+# Number of tags (the most frequent) kept for every signature, so that cells of unknown words stay narrow
+MAX_SIGNATURE_TAGS = 10
+
+# Prefix of signature strings, not a prefix of any word of the (upper case transliterated) treebank
+_SIGNATURE_PREFIX = "<unk>"
+# Hebrew letters prefixed to words : the definite article and prepositions, conjunctions and relativizers
+_PREFIX_LETTERS = frozenset("HBLMWKF")
+# Hebrew inflection and possessive suffixes, longest first
+_SUFFIXES = ("IM", "WT", "TI", "NW", "TM", "TN", "IH", "WN", "IW", "H", "T", "I", "W", "K")
+
+
+def word_signatures(word: str) -> List[str]:
+    """
+    The signatures of an unknown word, from the most specific to the most general, which is shared by all words :
+    1. yy punctuation tokens (e.g. yyDOT) share a signature.
+    2. Numbers, and words having a digit, share a signature (by whether the word is all digits).
+    3. Hebrew words get a signature by their prefix letter and suffix, backing off to their suffix only.
+    """
+    signatures = []
+    if word.startswith("yy"):
+        signatures.append("yy")
+    elif any(char.isdigit() for char in word):
+        signatures.append("num" if all(char.isdigit() or char in ".,/-%" for char in word) else "num-mix")
+        signatures.append("num-any")
+    else:
+        prefix = word[0] if len(word) > 2 and word[0] in _PREFIX_LETTERS else ""
+        suffix = next((suffix for suffix in _SUFFIXES if len(word) > len(suffix) + 1 and word.endswith(suffix)), "")
+        signatures.append("he-{}-{}".format(prefix, suffix))
+        signatures.append("he--{}".format(suffix))
+    signatures.append("")
+    return [_SIGNATURE_PREFIX + signature for signature in signatures]
+
+
+def unknown_word_index(lexicon: Iterable[Tuple[str, int, int]],
+                       lhs_counts: Sequence[int]) -> Dict[str, List[Tuple[int, float]]]:
+    """
+    Index the lexical rules of unknown words by signature (see word_signatures) : signature -> [(lhs, score)].
+    The tags of every signature are the LHS of the rare words (see RARE_WORD_COUNT) having it, the MAX_SIGNATURE_TAGS
+    most frequent kept. A tag is scored as if the signature was a word seen with the tag as often as it's rare words
+    were, so that unknown words compete with known words as rare words do. Signatures of fewer than
+    MIN_SIGNATURE_COUNT rare word occurrences are dropped, except for the most general one.
+    :param lexicon: Every lexical rule of the grammar, as (word, LHS id, count).
+    :param lhs_counts: The LHS count of every symbol, by symbol id.
+    :return: The index.
+    """
+    rules_by_word: Dict[str, List[Tuple[int, int]]] = dict()
+    for word, lhs, count in lexicon:
+        if count > 0:
+            rules_by_word.setdefault(word, []).append((lhs, count))
+    signature_counts: Dict[str, Dict[int, int]] = dict()
+    for word, rules in rules_by_word.items():
+        if sum(count for _, count in rules) > RARE_WORD_COUNT:
+            continue
+        for signature in word_signatures(word):
+            tag_counts = signature_counts.setdefault(signature, dict())
+            for lhs, count in rules:
+                tag_counts[lhs] = tag_counts.get(lhs, 0) + count
+    index: Dict[str, List[Tuple[int, float]]] = dict()
+    for signature, tag_counts in signature_counts.items():
+        if sum(tag_counts.values()) < MIN_SIGNATURE_COUNT and signature != _SIGNATURE_PREFIX:
+            continue
+        tags = sorted(tag_counts.items(), key=lambda tag_count: -tag_count[1])[:MAX_SIGNATURE_TAGS]
+        index[signature] = [(lhs, -log(count / lhs_counts[lhs])) for lhs, count in tags]
+    return index
+
+
+def unknown_word_rules(index: Dict[str, List[Tuple[int, float]]], word: str) -> List[Tuple[int, float]]:
+    """
+    The lexical rules of an unknown word : those of it's most specific signature in an unknown word index (see
+    unknown_word_index). Empty if the index has none of it's signatures.
+    """
+    for signature in word_signatures(word):
+        if signature in index:
+            return index[signature]
+    return []
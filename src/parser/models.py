@@ -1,7 +1,14 @@
-from src.parser.cky import add_top, cky
+from src.parser.astar import AgendaStats, astar_parse
+from src.parser.chart_cache import ChartCache
+from src.parser.chart_constraints import ChartConstraints
+from src.parser.cky import add_top, cky, max_plus_cky
+from src.parser.coarse_to_fine import CoarseToFinePruning
 from src.parser.grammar import precolate_grammar
+from src.parser.kbest import parse_hypergraph
 from src.parser.parser_model import ParserModel
+from src.parser.pruning import CellPruning
 from src.parser.pipeline import TreeTransformationPipeline, GrammarTransformationPipeline
+from src.parser.pretagger import TagPruning
 from src.util.tree.cnf import binarization, revert_binarization
 
 tree_no_vert_max_horiz_transformer = TreeTransformationPipeline([
@@ -33,9 +40,11 @@ class P0VCMHC(ParserModel):
     Precolation, 0 vertical context, maximum horizontal context
     """
 
-    def __init__(self):
+    def __init__(self, pruning: CellPruning = None):
         super().__init__(tree_no_vert_max_horiz_transformer, tree_detransformer, grammar_precolation_transformer,
-                         lambda gram, sent: cky(gram, sent, False))
+                         lambda gram, sent: cky(gram, sent, False, self.pruning, deadline=self.deadline),
+                         pruning=pruning,
+                         hypergraph_algorithm=lambda gram, sent: parse_hypergraph(gram, sent, False, self.pruning))
         self.pkl_path = "../../exps/parser_P_0VC_MHC.pkl"
 
 
@@ -44,9 +53,11 @@ class NP0VCMHC(ParserModel):
     No precolation, 0 vertical context, maximum horizontal context
     """
 
-    def __init__(self):
+    def __init__(self, pruning: CellPruning = None):
         super().__init__(tree_no_vert_max_horiz_transformer, tree_detransformer, grammar_no_precolation_transformer,
-                         lambda gram, sent: cky(gram, sent, True))
+                         lambda gram, sent: cky(gram, sent, True, self.pruning, deadline=self.deadline),
+                         pruning=pruning,
+                         hypergraph_algorithm=lambda gram, sent: parse_hypergraph(gram, sent, True, self.pruning))
         self.pkl_path = "../../exps/parser_NP_0VC_MHC.pkl"
 
 
@@ -55,9 +66,11 @@ class NP1VCMHC(ParserModel):
     No precolation, 1 vertical context, maximum horizontal context
     """
 
-    def __init__(self):
+    def __init__(self, pruning: CellPruning = None):
         super().__init__(tree_1_vert_max_horiz_transformer, tree_detransformer, grammar_no_precolation_transformer,
-                         lambda gram, sent: cky(gram, sent, True))
+                         lambda gram, sent: cky(gram, sent, True, self.pruning, deadline=self.deadline),
+                         pruning=pruning,
+                         hypergraph_algorithm=lambda gram, sent: parse_hypergraph(gram, sent, True, self.pruning))
         self.pkl_path = "../../exps/parser_NP_1VC_MHC.pkl"
 
 
@@ -66,7 +79,77 @@ class NP1VC2HC(ParserModel):
     No precolation, 1 vertical context, 2 horizontal context
     """
 
-    def __init__(self):
+    def __init__(self, pruning: CellPruning = None):
         super().__init__(tree_1_vert_2_horiz_transformer, tree_detransformer, grammar_no_precolation_transformer,
-                         lambda gram, sent: cky(gram, sent, True))
+                         lambda gram, sent: cky(gram, sent, True, self.pruning, deadline=self.deadline),
+                         pruning=pruning,
+                         hypergraph_algorithm=lambda gram, sent: parse_hypergraph(gram, sent, True, self.pruning))
         self.pkl_path = "../../exps/parser_NP_1VC_2HC.pkl"
+
+
+class VNP1VC2HC(NP1VC2HC):
+    """
+    NP1VC2HC, decoded with the vectorized max-plus CKY
+    """
+
+    def __init__(self, pruning: CellPruning = None):
+        super().__init__(pruning)
+        self.decode_alg = lambda gram, sent: max_plus_cky(gram, sent, True, self.pruning, self.deadline)
+
+
+class BNP1VC2HC(NP1VC2HC):
+    """
+    NP1VC2HC, with chart cells pruned for bounded decoding time on long sentences
+    """
+
+    def __init__(self):
+        super().__init__(CellPruning(beam_width=80, threshold=15.0, max_entries=120))
+
+
+class CNP1VC2HC(NP1VC2HC):
+    """
+    NP1VC2HC, with chart entries pruned by a coarse-to-fine pass over the unannotated grammar
+    """
+
+    def __init__(self):
+        super().__init__(CoarseToFinePruning(posterior_threshold=1e-4))
+
+
+class ENP1VC2HC(NP1VC2HC):
+    """
+    NP1VC2HC, with chart cells closed by constraints on the words constituents begin and end at
+    """
+
+    def __init__(self):
+        super().__init__(ChartConstraints(boundary_threshold=0.05))
+
+
+class TNP1VC2HC(NP1VC2HC):
+    """
+    NP1VC2HC, with lexical cells restricted to the most probable tags of an HMM pre-tagger
+    """
+
+    def __init__(self):
+        super().__init__(TagPruning(max_tags=3))
+
+
+class MNP1VC2HC(NP1VC2HC):
+    """
+    NP1VC2HC, with the cells of short spans memoized across sentences
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chart_cache = ChartCache()
+        self.decode_alg = lambda gram, sent: cky(gram, sent, True, self.pruning, self.chart_cache, self.deadline)
+
+
+class ANP1VC2HC(NP1VC2HC):
+    """
+    NP1VC2HC, decoded with exact A* parsing
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stats = AgendaStats()
+        self.decode_alg = lambda gram, sent: astar_parse(gram, sent, True, self.stats, self.deadline)
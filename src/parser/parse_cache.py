@@ -0,0 +1,129 @@
+import sqlite3
+from typing import Dict, List, NamedTuple
+
+# A parse stored in the cache : the written tree, the decoding stage which produced it (see
+# ParserModel.decode_with_fallback), and the seconds spent decoding it
+CachedParse = NamedTuple("CachedParse", [("tree", str), ("stage", str), ("parse_seconds", float)])
+
+# Number of sentences looked up per query, below SQLite's limit of variables per statement
+_LOOKUP_BATCH = 400
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS parses (
+    grammar TEXT NOT NULL,
+    model TEXT NOT NULL,
+    sentence TEXT NOT NULL,
+    tree TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    parse_seconds REAL NOT NULL,
+    size INTEGER NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (grammar, model, sentence)
+);
+CREATE INDEX IF NOT EXISTS parses_by_last_used ON parses (last_used);
+"""
+
+
+class ParseCache:
+    """
+    A persistent cache of parses, kept in an SQLite database file, keyed by the fingerprint of the grammar decoded
+    with (see ProbGrammar.fingerprint), the model's class and the sentence's words. Parsing a corpus (see
+    ParserModel.write_parse) looks up all of it's sentences at once before decoding, and decodes the misses only, so
+    re-parsing a corpus with an unchanged model reads it's parses back rather than decoding them again.
+    Parses of every decoding stage are cached, so the parses of sentences which failed to parse fully are read back
+    along with the stage which produced them.
+    Parses are kept while their total size (of their keys and trees, in bytes) is at most max_bytes, evicting the least
+    recently used first.
+    Counts of hits and misses, and the decoding time saved by hits, are accumulated over all lookups.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        # Recency of the last use of a parse, increasing with every lookup and store
+        self._clock = self.connection.execute("SELECT COALESCE(MAX(last_used), 0) FROM parses").fetchone()[0]
+
+    def lookup(self, grammar: str, model: str, corpus: List[List[str]]) -> Dict[int, CachedParse]:
+        """
+        Look up the cached parses of a corpus' sentences.
+        :param grammar: Fingerprint of the grammar decoded with.
+        :param model: Name of the model's class.
+        :param corpus: The sentences.
+        :return: Cached parse of every cached sentence, by it's index in the corpus.
+        """
+        indices: Dict[str, List[int]] = dict()
+        for index, sentence in enumerate(corpus):
+            indices.setdefault(_sentence_key(sentence), []).append(index)
+        sentences = list(indices)
+        found: Dict[int, CachedParse] = dict()
+        self._clock += 1
+        with self.connection:
+            for start in range(0, len(sentences), _LOOKUP_BATCH):
+                batch = sentences[start:start + _LOOKUP_BATCH]
+                where = "grammar = ? AND model = ? AND sentence IN ({})".format(", ".join("?" * len(batch)))
+                rows = self.connection.execute("SELECT sentence, tree, stage, parse_seconds FROM parses WHERE " + where,
+                                               [grammar, model] + batch).fetchall()
+                for sentence, tree, stage, parse_seconds in rows:
+                    for index in indices[sentence]:
+                        found[index] = CachedParse(tree, stage, parse_seconds)
+                self.connection.execute("UPDATE parses SET last_used = ? WHERE " + where,
+                                        [self._clock, grammar, model] + batch)
+        self.hits += len(found)
+        self.misses += len(corpus) - len(found)
+        self.saved_seconds += sum(parse.parse_seconds for parse in found.values())
+        return found
+
+    def store(self, grammar: str, model: str, sentence: List[str], parse: CachedParse):
+        """
+        Cache the parse of a sentence, evicting least recently used parses as needed.
+        :param grammar: Fingerprint of the grammar decoded with.
+        :param model: Name of the model's class.
+        :param sentence: The sentence.
+        :param parse: It's parse.
+        """
+        key = _sentence_key(sentence)
+        size = sum(len(field.encode("utf-8")) for field in (grammar, model, key, parse.tree))
+        if size > self.max_bytes:
+            return
+        self._clock += 1
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO parses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (grammar, model, key, parse.tree, parse.stage, parse.parse_seconds, size,
+                                     self._clock))
+            self._evict()
+
+    def _evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM parses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Walk the parses from the least recently used, until enough were found to be evicted
+        excess = total - self.max_bytes
+        cutoff = None
+        for last_used, size in self.connection.execute("SELECT last_used, size FROM parses ORDER BY last_used"):
+            excess -= size
+            cutoff = last_used
+            if excess <= 0:
+                break
+        self.connection.execute("DELETE FROM parses WHERE last_used <= ?", (cutoff,))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return "Parse cache : {} hits of {} lookups ({:.1%}), saving {:.1f} seconds of decoding, {} parses " \
+               "cached".format(self.hits, lookups, self.hits / lookups if lookups else 0.0, self.saved_seconds,
+                               len(self))
+
+
+def _sentence_key(sentence: List[str]) -> str:
+    # Words have no spaces (they are the leaves of bracketed trees)
+    return " ".join(sentence)
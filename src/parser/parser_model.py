@@ -1,14 +1,31 @@
+import multiprocessing
+import os
 import time
-from typing import Callable, List
+from typing import Callable, Iterator, List, NamedTuple, Tuple, Dict, Type
 
+from src.parser.cky import DecodeFailure, DecodeTimeout, flat_parse, partial_parse
+from src.parser.forest import build_forest, write_forests
 from src.parser.grammar import ProbGrammar, pickle_grammar, unpickle_grammar
+from src.parser.kbest import ChartHypergraph, KBestExtractor
+from src.parser.parse_cache import CachedParse, ParseCache
+from src.parser.pruning import CellPruning
 from src.parser.pipeline import TreeTransformationPipeline, GrammarTransformationPipeline
-from src.parser.tree_parser import get_rules_from_tree
+from src.parser.rule import Rule, RuleKey, rule_to_key, rule_from_key
+from src.parser.tree_parser import get_rules_from_tree, revert_precolation
 from src.util.tree.builders import node_tree_from_sequence
 from src.util.tree.node import Node
 from src.util.tree.treebank import StringCorpus
 from src.util.tree.writer import write_tree
 
+# Stages of decoding a sentence, from the best parses to the fastest (see ParserModel.decode_with_fallback)
+STAGE_FULL = "full"
+STAGE_BEAM = "beam"
+STAGE_PARTIAL = "partial"
+STAGE_FLAT = "flat"
+
+# A decoded sentence : it's detransformed tree, the stage which produced it, and whether a stage ran out of time
+Decoded = NamedTuple("Decoded", [("tree", Node), ("stage", str), ("timed_out", bool)])
+
 
 class ParserModel:
     """
@@ -26,7 +43,12 @@ class ParserModel:
 
     Decoding is as follows :
     The given sentence is transformed to a basic tree, which is transformed using the model's tree transformation
-    pipeline. The transformed tree is then decoded using the decode algorithm given.
+    pipeline. The transformed tree is then decoded using the decode algorithm given. Rules added to the grammar by
+    precolation are reverted in the decoded tree (see revert_precolation) before applying the tree detransformation
+    pipeline.
+
+    Sentences are written (see write_parse) decoding within a time budget per sentence, and in stages degrading rather
+    than failing (see decode_with_fallback), so every sentence gets a parse.
 
     Notes :
     1) tree_detransformation_pipeline should revert all alterations done by tree_transformation_pipeline,
@@ -37,20 +59,35 @@ class ParserModel:
     def __init__(self, tree_transformation_pipeline: TreeTransformationPipeline,
                  tree_detransformation_pipeline: TreeTransformationPipeline,
                  grammar_transformation_pipeline: GrammarTransformationPipeline,
-                 decode_algorithm: Callable[[ProbGrammar, List[str]], Node], grammar: ProbGrammar = None):
+                 decode_algorithm: Callable[[ProbGrammar, List[str]], Node], grammar: ProbGrammar = None,
+                 pruning: CellPruning = None,
+                 hypergraph_algorithm: Callable[[ProbGrammar, List[str]], ChartHypergraph] = None):
         self.grammar: ProbGrammar = ProbGrammar() if grammar is None else grammar
         self.tree_transformation_pipeline = tree_transformation_pipeline
         self.tree_detransformation_pipeline = tree_detransformation_pipeline
         self.grammar_transformation_pipline = grammar_transformation_pipeline
         self.decode_alg = decode_algorithm
+        # Parses a sentence keeping the hypergraph of all it's derivations, for k-best decoding and parse forests
+        self.hypergraph_alg = hypergraph_algorithm
+        # Chart pruning used by the decode algorithm, if any
+        self.pruning = pruning
+        # Persistent cache of parses written by write_parse, if any
+        self.parse_cache: ParseCache = None
+        # Seconds every decoding stage may take per sentence (see decode_with_fallback), None for no limit
+        self.sentence_budget: float = None
+        # Pruning of the beam stage of decode_with_fallback, None to skip it
+        self.fallback_pruning = CellPruning(beam_width=80, threshold=15.0, max_entries=120)
+        # Time the decode algorithm should stop at, if any (see cky.check_deadline). Set by decode_with_fallback.
+        self.deadline: float = None
         self.pkl_path = "../../data/model.pkl"
 
-    def train(self, corpus: StringCorpus, verbose=False):
+    def train(self, corpus: StringCorpus, verbose=False, processes: int = 1):
         """
         Train the model on a given corpus.
         :param corpus: The corpus with whcih to train.
         :param verbose: Whether to log.
-        :param pickle_result : True if to pickle resulting grammar, false otherwise
+        :param processes: Number of worker processes to extract rules with (see count_rules_parallel), 1 to train
+                          serially.
         :return: None.
 
         The corpus is traversed sequence by sequence, a tree is generated from each sequence, on which the
@@ -58,34 +95,323 @@ class ParserModel:
         from the tree and added to the grammar. Once all rules from all sequences in the corpus have been added to
         the grammar, rule probabilities are generated, AFTER WHICH the grammar_transformation_pipeline is applied
         to the grammar (where, for instance, unary rule precolation could occur).
+        The model's pruning, if any, is then trained on the transformed trees (see CellPruning.train).
         """
-        self.grammar = ProbGrammar()  # Clear grammar
-        for i, sentence in enumerate(corpus, 1):
+        # Rules are counted first, and added to a new grammar at once
+        if processes > 1:
+            rule_counts = {rule_from_key(rule_key): count for rule_key, count in
+                           self.count_rules_parallel(corpus, processes, verbose).items()}
+        else:
+            rule_counts = self.count_rules(corpus, verbose)
+        self.grammar = ProbGrammar.from_counts(rule_counts)
+        self.grammar.generate_rule_probabilities()
+        self.grammar = self.grammar_transformation_pipline.transform(self.grammar)
+        if self.pruning is not None:
+            self.pruning.train(self.transformed_trees(corpus))
+
+    def update(self, corpus: StringCorpus, verbose=False):
+        """
+        Update a trained model with additional training sentences, without training it again.
+        Rules of the corpus are counted as train does, and added to the grammar. Only the probabilities of the LHS
+        groups of these rules are regenerated, lazily (see ProbGrammar.update_rule_counts), and the
+        grammar_transformation_pipeline re-runs only the parts of it's transformations affected by the update (see
+        GrammarTransformationPipeline.update). The grammar is then as if the model was trained on both corpora.
+        :param corpus: The additional sentences.
+        :param verbose: Whether to log.
+        :return: None.
+        """
+        self.grammar = self.grammar_transformation_pipline.update(self.grammar, self.count_rules(corpus, verbose),
+                                                                  verbose)
+
+    def count_rules(self, corpus: StringCorpus, verbose=False) -> Dict[Rule, int]:
+        """
+        Count the rules of a corpus' transformed trees.
+        :param corpus: The corpus to count rules of.
+        :param verbose: Whether to log.
+        :return: Count of every rule, by order of first occurrence.
+        """
+        rule_counts: Dict[Rule, int] = dict()
+        for i, sent_tree in enumerate(self.transformed_trees(corpus), 1):
             if verbose:
                 print("Parsing #{}".format(i))
-            sent_tree = node_tree_from_sequence(sentence)
-            sent_tree = self.tree_transformation_pipeline.transform(sent_tree)
             for rule in get_rules_from_tree(sent_tree):
-                self.grammar.add_rule(rule)
-        self.grammar.generate_rule_probabilities()
-        self.grammar = self.grammar_transformation_pipline.transform(self.grammar)
+                rule_counts[rule] = rule_counts.get(rule, 0) + 1
+        return rule_counts
+
+    def transformed_trees(self, corpus: StringCorpus) -> Iterator[Node]:
+        """
+        Build the trees of a corpus and transform them using the tree transformation pipeline, as done in training.
+        :param corpus: The corpus of trees.
+        :return: The transformed trees, in the order of the corpus.
+        """
+        for sentence in corpus:
+            yield self.tree_transformation_pipeline.transform(node_tree_from_sequence(sentence))
+
+    def count_rules_parallel(self, corpus: StringCorpus, processes: int, verbose=False) -> Dict[RuleKey, int]:
+        """
+        Count the rules of a corpus' transformed trees using a pool of worker processes.
+        The corpus is split into contiguous shards, every worker counts the rules of a shard (building and transforming
+        it's trees as train does), and the counts of the shards are merged in the order of the corpus. Rules are
+        therefore ordered by their first occurrence in the corpus, so that adding them to a grammar in this order
+        results in the very same grammar as adding every occurrence serially.
+        As in write_parse_parallel, every worker builds it's own model of the model's class.
+        :param corpus: The corpus to count rules of.
+        :param processes: Number of worker processes.
+        :param verbose: Whether to log.
+        :return: Count of every rule (as a rule key), by order of first occurrence.
+        """
+        # Several shards per worker, so workers done early take over remaining shards
+        shard_size = max(1, -(-len(corpus) // (processes * _SHARDS_PER_WORKER)))
+        shards = [corpus[start:start + shard_size] for start in range(0, len(corpus), shard_size)]
+        rule_counts: Dict[RuleKey, int] = dict()
+        with multiprocessing.Pool(processes, _init_worker, (type(self), dict())) as pool:
+            for i, shard_counts in enumerate(pool.imap(_count_rules_in_worker, shards), 1):
+                for rule_key, count in shard_counts:
+                    rule_counts[rule_key] = rule_counts.get(rule_key, 0) + count
+                if verbose:
+                    print("Counted shard {} of {}, {} rules so far".format(i, len(shards), len(rule_counts)))
+        return rule_counts
 
     def decode(self, sentence: List[str]) -> Node:
-        tree = self.decode_alg(self.grammar, sentence)
+        return self._detransform(self.decode_alg(self.grammar, sentence))
+
+    def _detransform(self, tree: Node) -> Node:
+        tree = revert_precolation(tree, self.grammar.precolated_rules)
         return self.tree_detransformation_pipeline.transform(tree)
 
-    def write_parse(self, corpus: List[List[str]], output_treebank_file: str, versbose=False):
+    def decode_with_fallback(self, sentence: List[str]) -> Decoded:
+        """
+        Decode a sentence in stages, each tried only if the ones before it failed (raised), so a parse is always found :
+        1) full - the decode algorithm, stopped once sentence_budget seconds passed.
+        2) beam - if the full stage ran out of time, the decode algorithm with fallback_pruning instead of the model's
+           pruning, stopped once sentence_budget seconds more passed. Skipped otherwise (as when no start symbol
+           spans the sentence), as pruning only removes chart entries.
+        3) partial - the constituents of the chart filled by the last stage failing with one (see cky.partial_parse),
+           stitched under a root.
+        4) flat - every word under it's most probable tag (see cky.flat_parse).
+        :param sentence: The sentence to decode.
+        :return: The decoded sentence.
+        """
+        timed_out = False
+        chart = None
+        stages = [(STAGE_FULL, self.pruning)]
+        if self.fallback_pruning is not None:
+            stages.append((STAGE_BEAM, self.fallback_pruning))
+        pruning = self.pruning
+        try:
+            for stage, stage_pruning in stages:
+                if stage != STAGE_FULL and not timed_out:
+                    break
+                self.pruning = stage_pruning
+                if self.sentence_budget is not None:
+                    self.deadline = time.monotonic() + self.sentence_budget
+                try:
+                    return Decoded(self.decode(sentence), stage, timed_out)
+                except DecodeFailure as e:
+                    timed_out |= isinstance(e, DecodeTimeout)
+                    chart = e.chart if e.chart is not None else chart
+                except Exception:
+                    pass
+        finally:
+            self.pruning = pruning
+            self.deadline = None
+        if chart is not None:
+            return Decoded(self._detransform(partial_parse(chart)), STAGE_PARTIAL, timed_out)
+        return Decoded(self._detransform(flat_parse(self.grammar, sentence)), STAGE_FLAT, timed_out)
+
+    def decode_kbest(self, sentence: List[str], k: int) -> List[Tuple[Node, float]]:
+        """
+        Decode the k most probable parses of a sentence.
+        :param sentence: The sentence to decode.
+        :param k: Maximal number of parses to return.
+        :return: List of (detransformed tree, minus log probability) sorted by probability. Derivations detransformed
+                 to an already returned tree are skipped, so every tree is scored by it's most probable derivation.
+        """
+        assert self.hypergraph_alg is not None
+        parses = []
+        seen = set()
+        derivations = iter(KBestExtractor(self.hypergraph_alg(self.grammar, sentence)))
+        while len(parses) < k:
+            tree, minus_log_prob = next(derivations, (None, None))
+            if tree is None:
+                break
+            tree = revert_precolation(tree, self.grammar.precolated_rules)
+            tree = self.tree_detransformation_pipeline.transform(tree)
+            tree_string = write_tree(tree)
+            if tree_string not in seen:
+                seen.add(tree_string)
+                parses.append((tree, minus_log_prob))
+        return parses
+
+    def write_parse(self, corpus: List[List[str]], output_treebank_file: str, versbose=False, processes: int = 1):
+        """
+        Parse a corpus, writing a parse per line in the order of the corpus. Sentences are decoded within the model's
+        sentence budget, falling back to faster stages when failing (see decode_with_fallback). With a parse cache set
+        (see parse_cache), the parses of all sentences are looked up before parsing, and only sentences which weren't
+        cached are decoded (and cached, unless some stage ran out of time).
+        :param corpus: The sentences to parse.
+        :param output_treebank_file: Path of the output file.
+        :param versbose: Whether to log.
+        :param processes: Number of worker processes to parse with (see write_parse_parallel), 1 to parse serially.
+        """
+        if processes > 1:
+            self.write_parse_parallel(corpus, output_treebank_file, processes, versbose)
+            return
+        cached = self._cached_parses(corpus)
+        stage_counts: Dict[str, int] = dict()
         with open(output_treebank_file, "wb", 0) as fp:
-            fail_count = 0
             for i, sentence in enumerate(corpus, 1):
-                ts = time.monotonic()
-                parsed_tree = ""
-                try:
-                    parsed_tree = write_tree(self.decode(sentence))
-                except Exception as e:
-                    fail_count += 1
-                    print("Failed {} ".format(i))
-                fp.write("{}\n".format(parsed_tree).encode("utf-8"))
-                if versbose:
-                    print("{} of length {} took {} seconds. {} Failed. ".format(i, len(sentence), time.monotonic() - ts,
-                                                                                fail_count))
+                if i - 1 in cached:
+                    parse = cached[i - 1]
+                else:
+                    ts = time.monotonic()
+                    decoded = self.decode_with_fallback(sentence)
+                    parse = CachedParse(write_tree(decoded.tree), decoded.stage, time.monotonic() - ts)
+                    if not decoded.timed_out:
+                        self._cache_parse(sentence, parse)
+                    if decoded.stage != STAGE_FULL:
+                        print("Fell back to stage {} for {} ".format(decoded.stage, i))
+                    if versbose:
+                        print("{} of length {} took {} seconds, by stage {}. ".format(i, len(sentence),
+                                                                                     parse.parse_seconds, parse.stage))
+                stage_counts[parse.stage] = stage_counts.get(parse.stage, 0) + 1
+                fp.write("{}\n".format(parse.tree).encode("utf-8"))
+        if versbose:
+            self._log_parse_stats(stage_counts)
+
+    def write_parse_parallel(self, corpus: List[List[str]], output_treebank_file: str, processes: int,
+                             versbose=False):
+        """
+        Parse a corpus using a pool of worker processes, writing a parse per line in the order of the corpus (see
+        write_parse).
+        Every worker gets the model's grammar, pruning and decoding stages settings once, when started, and builds it's
+        own model of the same class, so the model's class should be constructible with no arguments (as all models in
+        models.py are).
+        Sentences are handed out longest first, so the longest sentences don't end up parsed last, each by a single
+        worker. Parses are written as soon as all parses preceding them were. With a parse cache set, only sentences
+        which weren't cached are handed out (see write_parse).
+        :param corpus: The sentences to parse.
+        :param output_treebank_file: Path of the output file.
+        :param processes: Number of worker processes.
+        :param versbose: Whether to log.
+        """
+        st = time.monotonic()
+        cached = self._cached_parses(corpus)
+        stage_counts: Dict[str, int] = dict()
+        for parse in cached.values():
+            stage_counts[parse.stage] = stage_counts.get(parse.stage, 0) + 1
+        # Parses done but not yet written, by sentence index, and the time every worker spent parsing
+        done: Dict[int, str] = {index: parse.tree for index, parse in cached.items()}
+        busy_time: Dict[int, float] = dict()
+        longest_first = sorted((index for index in range(len(corpus)) if index not in done),
+                               key=lambda index: -len(corpus[index]))
+        next_index = 0
+        with open(output_treebank_file, "wb", 0) as fp:
+            while next_index in done:
+                fp.write("{}\n".format(done.pop(next_index)).encode("utf-8"))
+                next_index += 1
+            if longest_first:
+                worker_attributes = dict(grammar=self.grammar, pruning=self.pruning,
+                                         sentence_budget=self.sentence_budget, fallback_pruning=self.fallback_pruning)
+                with multiprocessing.Pool(processes, _init_worker, (type(self), worker_attributes)) as pool:
+                    tasks = ((index, corpus[index]) for index in longest_first)
+                    for index, parse, timed_out, worker in pool.imap_unordered(_parse_in_worker, tasks):
+                        busy_time[worker] = busy_time.get(worker, 0.0) + parse.parse_seconds
+                        stage_counts[parse.stage] = stage_counts.get(parse.stage, 0) + 1
+                        if not timed_out:
+                            self._cache_parse(corpus[index], parse)
+                        if parse.stage != STAGE_FULL:
+                            print("Fell back to stage {} for {} ".format(parse.stage, index + 1))
+                        done[index] = parse.tree
+                        while next_index in done:
+                            fp.write("{}\n".format(done.pop(next_index)).encode("utf-8"))
+                            next_index += 1
+                        if versbose:
+                            print("{} of length {} took {} seconds, by stage {}. ".format(
+                                index + 1, len(corpus[index]), parse.parse_seconds, parse.stage))
+        if versbose:
+            wall_time = time.monotonic() - st
+            for worker, worker_time in sorted(busy_time.items()):
+                print("Worker {} parsed for {:.1f} of {:.1f} seconds ({:.0%} utilization)".format(
+                    worker, worker_time, wall_time, worker_time / wall_time))
+            self._log_parse_stats(stage_counts)
+
+    def _log_parse_stats(self, stage_counts: Dict[str, int]):
+        print("Sentences by stage : {}".format(", ".join("{} {}".format(stage, stage_counts.get(stage, 0)) for stage in
+                                                         (STAGE_FULL, STAGE_BEAM, STAGE_PARTIAL, STAGE_FLAT))))
+        if self.pruning is not None:
+            print(self.pruning)
+        if self.parse_cache is not None:
+            print(self.parse_cache)
+
+    def _cached_parses(self, corpus: List[List[str]]) -> Dict[int, CachedParse]:
+        """
+        Look up the parses of a corpus' sentences in the parse cache, if set.
+        :return: Cached parse of every cached sentence, by it's index in the corpus.
+        """
+        if self.parse_cache is None:
+            return dict()
+        return self.parse_cache.lookup(self.grammar.fingerprint(), type(self).__name__, corpus)
+
+    def _cache_parse(self, sentence: List[str], parse: CachedParse):
+        if self.parse_cache is not None:
+            self.parse_cache.store(self.grammar.fingerprint(), type(self).__name__, sentence, parse)
+
+    def write_forests(self, corpus: List[List[str]], forest_path: str, verbose=False):
+        """
+        Parse a corpus, writing the packed parse forest of every sentence to a forest store (see forest.py), in the
+        order of the corpus. Sentences failing to parse get an empty forest (having no roots).
+        :param corpus: The sentences to parse.
+        :param forest_path: Directory of the forest store.
+        :param verbose: Whether to log.
+        """
+        assert self.hypergraph_alg is not None
+        forests = []
+        fail_count = 0
+        for i, sentence in enumerate(corpus, 1):
+            ts = time.monotonic()
+            forest = build_forest(self.hypergraph_alg(self.grammar, sentence))
+            if not forest.roots.size:
+                fail_count += 1
+                print("Failed {} ".format(i))
+            forests.append(forest)
+            if verbose:
+                print("{} of length {} took {} seconds, {} nodes and {} hyperedges. {} Failed. ".format(
+                    i, len(sentence), time.monotonic() - ts, forest.node_count, forest.edge_count, fail_count))
+        write_forests(forests, forest_path)
+
+
+# Number of corpus shards per worker process when training in parallel (see ParserModel.count_rules_parallel)
+_SHARDS_PER_WORKER = 4
+# The model parsing (or counting rules) in a worker process (see ParserModel.write_parse_parallel)
+_worker_model: ParserModel = None
+
+
+def _init_worker(model_class: Type[ParserModel], attributes: Dict[str, object]):
+    """
+    Build the model of a worker process, setting the given attributes (e.g. it's grammar) on it.
+    """
+    global _worker_model
+    _worker_model = model_class()
+    for name, value in attributes.items():
+        setattr(_worker_model, name, value)
+
+
+def _count_rules_in_worker(shard: StringCorpus) -> List[Tuple[RuleKey, int]]:
+    """
+    Count the rules of a corpus shard's transformed trees in a worker process.
+    :return: Count of every rule (as a rule key), by order of first occurrence in the shard.
+    """
+    return [(rule_to_key(rule), count) for rule, count in _worker_model.count_rules(shard).items()]
+
+
+def _parse_in_worker(task: Tuple[int, List[str]]) -> Tuple[int, CachedParse, bool, int]:
+    """
+    Parse a sentence in a worker process (see ParserModel.decode_with_fallback).
+    :return: The sentence's index, it's parse, whether some decoding stage ran out of time and the worker's pid.
+    """
+    index, sentence = task
+    ts = time.monotonic()
+    decoded = _worker_model.decode_with_fallback(sentence)
+    return index, CachedParse(write_tree(decoded.tree), decoded.stage, time.monotonic() - ts), decoded.timed_out, \
+        os.getpid()
@@ -1,6 +1,7 @@
-from typing import List, Tuple, Callable
+from typing import List, Tuple, Callable, Dict
 
-from src.parser.grammar import ProbGrammar
+from src.parser.grammar import ProbGrammar, precolate_grammar, IncrementalPrecolation
+from src.parser.rule import Rule
 from src.util.tree.node import Node
 
 
@@ -34,3 +35,34 @@ class GrammarTransformationPipeline:
                 print(transformer_name)
             grammar = transformer(grammar)
         return grammar
+
+    def update(self, grammar: ProbGrammar, rule_counts: Dict[Rule, int], verbose=False) -> ProbGrammar:
+        """
+        Add rule counts to a grammar generated by the pipeline, re-running only the parts of the transformations
+        affected by the update, rather than generating and transforming the whole grammar again.
+        Every transformer should have an incremental counterpart (see INCREMENTAL_TRANSFORMERS), having a
+        before_update(grammar, rule_counts) method called (in reverse order of the pipeline) before the counts are
+        added, and an after_update(grammar) method called (in order of the pipeline) after.
+        :param grammar: The grammar to update.
+        :param rule_counts: Count of every rule to add.
+        :param verbose: Whether to log.
+        :return: The updated grammar.
+        """
+        updates = []
+        for transformer_name, transformer in self.transformers:
+            if transformer not in INCREMENTAL_TRANSFORMERS:
+                raise ValueError("Transformer {} can't be applied incrementally.".format(transformer_name))
+            updates.append((transformer_name, INCREMENTAL_TRANSFORMERS[transformer]()))
+        for _, update in reversed(updates):
+            update.before_update(grammar, rule_counts)
+        grammar.update_rule_counts(rule_counts)
+        for transformer_name, update in updates:
+            if verbose:
+                print(transformer_name)
+            update.after_update(grammar)
+        return grammar
+
+
+# Incremental counterparts of grammar transformers, by transformer (see GrammarTransformationPipeline.update)
+INCREMENTAL_TRANSFORMERS: Dict[Callable[[ProbGrammar], ProbGrammar], Callable] = {
+    precolate_grammar: IncrementalPrecolation}
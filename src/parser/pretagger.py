@@ -0,0 +1,157 @@
+from typing import Dict, Iterable, List, Optional
+
+from math import inf
+
+import numpy as np
+
+from src.parser.grammar import ProbGrammar
+from src.parser.pruning import CellPruning
+from src.util.tree.node import Node
+
+
+class HmmTagger:
+    """
+    A bigram HMM over the preterminals of a treebank's trees (as decoded, e.g. binarized), computing tag posteriors
+    of every word of a sentence by forward-backward, in time linear in the sentence's length.
+    Tag transitions are learned from the trees, smoothed by interpolating with the tags' unigram distribution.
+    Emissions are the lexical rules of the grammar decoded with (so unknown words are tagged by signature, see
+    ProbGrammar.lexical_rules), and only the tags having a lexical rule for a word are considered for it.
+    """
+
+    def __init__(self, smoothing: float = 1.0):
+        # Weight of the unigram distribution in smoothed transition probabilities
+        self.smoothing = smoothing
+        # Id of every tag, the sentence start and end having the last two ids
+        self.tag_ids: Dict[str, int] = dict()
+        # Bigram counts, by key (previous tag id * number of ids + tag id), sorted by key
+        self.bigram_keys: np.ndarray = np.zeros(0, dtype=np.int64)
+        self.bigram_counts: np.ndarray = np.zeros(0)
+        # Counts of tags as the previous tag of a bigram, and unigram probabilities of tags, by tag id
+        self.history_counts: np.ndarray = np.zeros(0)
+        self.unigram_probs: np.ndarray = np.zeros(0)
+
+    def train(self, trees: Iterable[Node]):
+        """
+        Count the tag bigrams of the preterminal layer of trees.
+        """
+        tag_sequences = [preterminal_tags(tree) for tree in trees]
+        tags = sorted({tag for sequence in tag_sequences for tag in sequence})
+        self.tag_ids = {tag: i for i, tag in enumerate(tags)}
+        start, end = len(tags), len(tags) + 1
+        id_count = len(tags) + 2
+        keys = [previous * id_count + tag for sequence in tag_sequences for previous, tag in
+                zip([start] + [self.tag_ids[tag] for tag in sequence], [self.tag_ids[tag] for tag in sequence] + [end])]
+        self.bigram_keys, counts = np.unique(np.array(keys, dtype=np.int64), return_counts=True)
+        self.bigram_counts = counts.astype(np.float64)
+        self.history_counts = np.bincount(self.bigram_keys // id_count, self.bigram_counts, id_count)
+        unigram_counts = np.bincount(self.bigram_keys % id_count, self.bigram_counts, id_count)
+        self.unigram_probs = unigram_counts / max(unigram_counts.sum(), 1.0)
+
+    def transitions(self, previous: np.ndarray, following: np.ndarray) -> np.ndarray:
+        """
+        Smoothed transition probabilities between every previous tag and every following tag, by their ids.
+        """
+        id_count = len(self.history_counts)
+        keys = (previous[:, None] * id_count + following[None, :]).ravel()
+        positions = np.minimum(np.searchsorted(self.bigram_keys, keys), max(len(self.bigram_keys) - 1, 0))
+        counts = np.where(self.bigram_keys[positions] == keys, self.bigram_counts[positions], 0.0) if \
+            len(self.bigram_keys) else np.zeros(keys.shape)
+        counts = counts.reshape(len(previous), len(following))
+        return (counts + self.smoothing * self.unigram_probs[following][None, :]) / \
+               (self.history_counts[previous][:, None] + self.smoothing)
+
+    def posteriors(self, candidates: List[np.ndarray], emissions: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Forward-backward over the candidate tags of every word of a sentence.
+        :param candidates: Ids of the candidate tags of every word.
+        :param emissions: Emission probabilities of every word's candidate tags.
+        :return: Posterior probabilities of every word's candidate tags.
+        """
+        start = np.array([len(self.tag_ids)])
+        end = np.array([len(self.tag_ids) + 1])
+        # Rescaled after every word, so long sentences don't underflow
+        forward = []
+        scores = self.transitions(start, candidates[0])[0] * emissions[0]
+        forward.append(scores / scores.sum())
+        for i in range(1, len(candidates)):
+            scores = (forward[-1] @ self.transitions(candidates[i - 1], candidates[i])) * emissions[i]
+            forward.append(scores / scores.sum())
+        backward = self.transitions(candidates[-1], end)[:, 0]
+        posteriors = [None] * len(candidates)
+        for i in range(len(candidates) - 1, -1, -1):
+            if i < len(candidates) - 1:
+                backward = self.transitions(candidates[i], candidates[i + 1]) @ (emissions[i + 1] * backward)
+            backward = backward / backward.sum()
+            scores = forward[i] * backward
+            posteriors[i] = scores / scores.sum()
+        return posteriors
+
+
+class TagPruning(CellPruning):
+    """
+    Pre-tagging : an HMM tagger (see HmmTagger), trained along with the model on it's transformed training trees,
+    tags every sentence before it's decoded, and lexical cells are seeded only with the max_tags most probable tags of
+    their word, among those whose posterior probability is at least posterior_threshold. Either may be disabled by
+    leaving it as None. Lexical entries of symbols which aren't tags (as the collapsed unary chains of precolated
+    grammars) are kept, as are all entries of sentences the tagger can't tag (having a word with no tag at all).
+    Beam, threshold and cap pruning (see CellPruning) can be applied on top.
+    """
+
+    def __init__(self, max_tags: int = 3, posterior_threshold: float = None, beam_width: int = None,
+                 threshold: float = None, max_entries: int = None, tagger: HmmTagger = None):
+        super().__init__(beam_width, threshold, max_entries)
+        self.max_tags = max_tags
+        self.posterior_threshold = posterior_threshold
+        self.tagger = HmmTagger() if tagger is None else tagger
+        self.grammar: ProbGrammar = None
+        # HMM tag id of every symbol id of the grammar, -1 for symbols which aren't tags
+        self.symbol_tags: np.ndarray = None
+        # Symbol ids of the tags dropped from the lexical cell of every word of the sentence decoded
+        self.dropped: Optional[List[np.ndarray]] = None
+
+    def train(self, trees: Iterable[Node]):
+        self.tagger.train(trees)
+        self.grammar = None
+
+    def start_sentence(self, grammar: ProbGrammar, sentence: List[str]):
+        if grammar is not self.grammar:
+            self.grammar = grammar
+            self.symbol_tags = np.array([self.tagger.tag_ids.get(sym.symbol_string, -1) for sym in
+                                         grammar.non_terminal_index().symbols], dtype=np.int64)
+        self.dropped = None
+        candidates, emissions, symbols = [], [], []
+        for word in sentence:
+            rules = [(lhs, self.symbol_tags[lhs], minus_log_prob) for lhs, minus_log_prob in
+                     grammar.lexical_rules(word) if self.symbol_tags[lhs] >= 0]
+            if not rules:
+                return
+            symbols.append(np.array([rule[0] for rule in rules], dtype=np.int64))
+            candidates.append(np.array([rule[1] for rule in rules], dtype=np.int64))
+            emissions.append(np.exp(-np.array([rule[2] for rule in rules])))
+        self.dropped = []
+        for word_symbols, posteriors in zip(symbols, self.tagger.posteriors(candidates, emissions)):
+            dropped = np.zeros(len(posteriors), dtype=bool)
+            if self.max_tags is not None:
+                dropped[np.argsort(-posteriors, kind="stable")[self.max_tags:]] = True
+            if self.posterior_threshold is not None:
+                dropped |= posteriors < self.posterior_threshold
+            self.dropped.append(word_symbols[dropped])
+
+    def prune_derived(self, span_length: int, span_start: int, cell_scores: np.ndarray):
+        if span_length == 1 and self.dropped is not None:
+            for row in range(cell_scores.shape[0]):
+                dropped = self.dropped[span_start + row]
+                pruned = np.count_nonzero(cell_scores[row, dropped] < inf)
+                self.entry_count += pruned
+                self.pruned_count += pruned
+                cell_scores[row, dropped] = inf
+        super().prune_derived(span_length, span_start, cell_scores)
+
+
+def preterminal_tags(tree: Node) -> List[str]:
+    """
+    The tags of a tree's preterminals (the parents of it's words), from left to right.
+    """
+    if len(tree.children) == 1 and not tree.children[0].children:
+        return [tree.tag]
+    return [tag for child in tree.children for tag in preterminal_tags(child)]
@@ -0,0 +1,96 @@
+from typing import Iterable, List
+
+from math import inf
+
+import numpy as np
+
+from src.parser.grammar import ProbGrammar
+from src.util.tree.node import Node
+
+
+class CellPruning:
+    """
+    Pruning of CKY chart cells, trading parse accuracy for bounded decoding time.
+
+    Cells are pruned in two stages :
+    1) Once the cell's lexical or binary entries are final, only the beam_width best of them are kept.
+    2) Once unary rules were applied to the cell, entries worse than the cell's best by more than threshold are
+       dropped, after which at most max_entries entries are kept.
+    Any of the modes may be disabled by leaving it as None. The cell spanning the whole sentence is never pruned, as
+    only start symbols are looked up in it.
+
+    Counts of examined and pruned entries are accumulated over all decoded sentences.
+    Subclasses may prune by other criteria, preparing per sentence data in start_sentence, close whole cells before
+    they are filled (see cell_open), or learn from the model's training trees (see train).
+    """
+
+    def __init__(self, beam_width: int = None, threshold: float = None, max_entries: int = None):
+        self.beam_width = beam_width
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.entry_count = 0
+        self.pruned_count = 0
+
+    def train(self, trees: Iterable[Node]):
+        """
+        Called once the model is trained, with it's transformed training trees (generated lazily, as they are read).
+        """
+        pass
+
+    def start_sentence(self, grammar: ProbGrammar, sentence: List[str]):
+        """
+        Called before decoding every sentence.
+        """
+        pass
+
+    def cell_open(self, span_length: int, span_start: int) -> bool:
+        """
+        Whether a cell may hold entries at all. Closed cells are skipped by decoders filling cells one by one, and
+        emptied by others.
+        """
+        return True
+
+    def prune_derived(self, span_length: int, span_start: int, cell_scores: np.ndarray):
+        """
+        Apply the beam to cells holding their lexical or binary entries only.
+        :param span_length: Length of the cells' span.
+        :param span_start: Start of the first cell's span, following rows are the cells starting right after it.
+        :param cell_scores: Scores of a batch of cells (rows) by symbol id (columns), pruned in place.
+        """
+        if self.beam_width is not None:
+            pruned = _keep_best(cell_scores, self.beam_width)
+            self.entry_count += pruned
+            self.pruned_count += pruned
+
+    def prune_closed(self, span_length: int, span_start: int, cell_scores: np.ndarray):
+        """
+        Apply the threshold and the cap on entries to cells unary rules were applied to.
+        :param span_length: Length of the cells' span.
+        :param span_start: Start of the first cell's span, following rows are the cells starting right after it.
+        :param cell_scores: Scores of a batch of cells (rows) by symbol id (columns), pruned in place.
+        """
+        self.entry_count += np.count_nonzero(cell_scores < inf)
+        if self.threshold is not None:
+            dropped = cell_scores > cell_scores.min(axis=1, keepdims=True) + self.threshold
+            dropped &= cell_scores < inf
+            self.pruned_count += np.count_nonzero(dropped)
+            cell_scores[dropped] = inf
+        if self.max_entries is not None:
+            self.pruned_count += _keep_best(cell_scores, self.max_entries)
+
+    def __str__(self):
+        return "Pruned {} of {} chart entries".format(self.pruned_count, self.entry_count)
+
+
+def _keep_best(cell_scores: np.ndarray, k: int) -> int:
+    """
+    Keep only the k best entries of every cell (ties broken by symbol id).
+    :return: Number of entries pruned.
+    """
+    rows = np.flatnonzero(np.count_nonzero(cell_scores < inf, axis=1) > k)
+    if not rows.size:
+        return 0
+    worst = np.argsort(cell_scores[rows], axis=1, kind="stable")[:, k:]
+    dropped = cell_scores[rows[:, None], worst] < inf
+    cell_scores[rows[:, None], worst] = inf
+    return int(np.count_nonzero(dropped))
@@ -1,33 +1,66 @@
-from typing import List, Type
+from typing import List, Type, Tuple
 
 from src.parser.symbol import Symbol, Terminal, NonTerminal, MultiSymbol
 
+# A rule as plain strings : (LHS symbol string, ((RHS symbol string, True for terminals), ...)). Rule keys pass rules
+# between processes without interning their symbols (see rule_from_key).
+RuleKey = Tuple[str, Tuple[Tuple[str, bool], ...]]
+
 
 class Rule:
     """
     A derivation rule, lexical or grammatical.
     The rule is represented as rewrite of a sequence of left hand side (lhs) symbols (strings) into a sequence of
     right hand side (rhs) symbols.
+    Rules are immutable : their hash and kind (unary, lexical) are computed once, when created.
     """
+    __slots__ = ("lhs", "rhs", "_hash", "_unary", "_lexical")
 
     def __init__(self, lhs_symbol: MultiSymbol, rhs_symbol: MultiSymbol):
-        self.lhs: MultiSymbol = lhs_symbol
-        self.rhs: MultiSymbol = rhs_symbol
+        object.__setattr__(self, "lhs", lhs_symbol)
+        object.__setattr__(self, "rhs", rhs_symbol)
+        object.__setattr__(self, "_hash", hash((lhs_symbol, rhs_symbol)))
+        object.__setattr__(self, "_unary", len(lhs_symbol.symbol_list) == 1 and len(rhs_symbol.symbol_list) == 1)
+        object.__setattr__(self, "_lexical", all(type(sym) is Terminal for sym in rhs_symbol.symbol_list))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Rules are immutable")
+
+    def __reduce__(self):
+        return Rule, (self.lhs, self.rhs)
 
     def is_unary(self):
-        return len(self.lhs.symbol_list) == 1 and len(self.rhs.symbol_list) == 1
+        return self._unary
 
     def is_lexical(self):
-        return all(map(lambda x: type(x) is Terminal, self.rhs.symbol_list))
+        return self._lexical
 
     def __str__(self):
         return "{} --> {}".format(str(self.lhs), str(self.rhs))
 
     def __hash__(self):
-        return hash("".join(map(str, (self.lhs.symbol_list + self.rhs.symbol_list))))
+        return self._hash
 
     def __eq__(self, other: "Rule"):
-        return self.lhs == other.lhs and self.rhs == other.rhs
+        return self is other or (self._hash == other._hash and self.lhs == other.lhs and self.rhs == other.rhs)
+
+
+def rule_to_key(rule: Rule) -> RuleKey:
+    """
+    Convert a rule (having a single LHS symbol) to it's rule key.
+    """
+    return rule.lhs[0].symbol_string, tuple((sym.symbol_string, type(sym) is Terminal) for sym in rule.rhs.symbol_list)
+
+
+def rule_from_key(key: RuleKey) -> Rule:
+    """
+    Convert a rule key to a rule. RHS symbols are interned before the LHS symbol, as done when extracting rules from
+    trees, so converting keys in the order rules were first extracted interns symbols in the same order (and so with
+    the same ids) as extracting them.
+    """
+    lhs, rhs = key
+    rhs_symbols = tuple(Terminal(symbol) if terminal else NonTerminal(symbol) for symbol, terminal in rhs)
+    return Rule(MultiSymbol((NonTerminal(lhs),)), MultiSymbol(rhs_symbols))
 
 
 if __name__ == '__main__':
@@ -1,50 +1,82 @@
-from typing import List, Tuple
+from typing import Dict, Tuple
 
 
 class Symbol:
     """
     An abstract symbol.
-    """
 
-    def __init__(self, symbol_string: str):
-        self.symbol_string = symbol_string
+    Symbols are interned : every symbol string is created once per vocabulary (one vocabulary per symbol type), so
+    equal symbols are the same object, and are compared by identity. Every symbol carries an integer id, it's order of
+    creation in it's vocabulary, which is stable for the lifetime of the process and serves as it's hash.
+    Symbols are immutable.
+    """
+    __slots__ = ("symbol_string", "id")
+    # Symbols created so far, by symbol string. Every symbol type gets it's own vocabulary.
+    _vocabulary: Dict[str, "Symbol"] = dict()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._vocabulary = dict()
+
+    def __new__(cls, symbol_string: str):
+        symbol = cls._vocabulary.get(symbol_string)
+        if symbol is None:
+            symbol = super().__new__(cls)
+            object.__setattr__(symbol, "symbol_string", symbol_string)
+            object.__setattr__(symbol, "id", len(cls._vocabulary))
+            cls._vocabulary[symbol_string] = symbol
+        return symbol
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Symbols are immutable")
+
+    def __reduce__(self):
+        # Unpickled symbols are interned as well
+        return type(self), (self.symbol_string,)
 
     def __str__(self):
         return self.symbol_string
 
     def __eq__(self, other: "Symbol"):
-        return self.symbol_string == other.symbol_string and type(self) == type(other)
+        return self is other
 
     def __hash__(self):
-        return hash(self.symbol_string)
+        return self.id
 
 
 class Terminal(Symbol):
     """
     A terminal symbol.
     """
-
-    def __init__(self, symbol_string: str): super().__init__(symbol_string)
+    __slots__ = ()
 
 
 class NonTerminal(Symbol):
     """
     A non-terminal symbol.
     """
-
-    def __init__(self, symbol_string: str): super().__init__(symbol_string)
+    __slots__ = ()
 
 
 class MultiSymbol:
     """
     An ordered list of symbols, representing a derivation participant (LHS or RHS).
+    Multi symbols are immutable, and hashed once.
     """
+    __slots__ = ("symbol_list", "_hash")
 
     def __init__(self, symbols: Tuple[Symbol, ...]):
-        self.symbol_list: Tuple[Symbol, ...] = symbols
+        object.__setattr__(self, "symbol_list", symbols)
+        object.__setattr__(self, "_hash", hash(symbols))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Multi symbols are immutable")
+
+    def __reduce__(self):
+        return MultiSymbol, (self.symbol_list,)
 
     def __eq__(self, other: "MultiSymbol"):
-        return self.symbol_list == other.symbol_list
+        return self is other or (self._hash == other._hash and self.symbol_list == other.symbol_list)
 
     def __str__(self):
         return ' '.join([sym.symbol_string for sym in self.symbol_list])
@@ -54,7 +86,7 @@ class MultiSymbol:
         return MultiSymbol(self.symbol_list + other.symbol_list)
 
     def __hash__(self):
-        return hash("".join(map(str, self.symbol_list)))
+        return self._hash
 
     def __getitem__(self, item: int):
         return self.symbol_list[item]
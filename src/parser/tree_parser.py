@@ -1,5 +1,6 @@
-from typing import Iterator
+from typing import Iterator, Dict
 
+from src.parser.grammar import PrecolatedRule
 from src.parser.rule import Rule
 from src.parser.symbol import MultiSymbol, NonTerminal, Terminal
 from src.util.tree.builders import node_tree_from_sequence
@@ -16,17 +17,43 @@ def get_rules_from_tree(root: Node) -> Iterator[Rule]:
     # BFS style traversal of tree
     while node_list:
         node = node_list.pop()
-        lhs = MultiSymbol((NonTerminal(node.tag),))
         if not node.children:
             continue
         node_list += node.children
-        rhs_symbols = ()
-        for child in node.children:
-            if child.children:  # not terminal:
-                rhs_symbols = rhs_symbols + (NonTerminal(child.tag),)
-            else:
-                rhs_symbols = rhs_symbols + (Terminal(child.tag),)
-        yield Rule(lhs, MultiSymbol(rhs_symbols))
+        # Children with no children of their own are terminals. Symbols are interned, so every tag's symbol is
+        # created once
+        rhs_symbols = tuple(NonTerminal(child.tag) if child.children else Terminal(child.tag) for child in
+                            node.children)
+        yield Rule(MultiSymbol((NonTerminal(node.tag),)), MultiSymbol(rhs_symbols))
+
+
+def revert_precolation(root: Node, precolated_rules: Dict[Rule, PrecolatedRule]) -> Node:
+    """
+    Revert the rules added by precolation (see precolate_grammar) in a parse tree : every node derived by a precolated
+    rule A --> C D is expanded back to the unit chain A -> ... -> B and the rule B --> C D it was derived from.
+    :param root: Root node of the tree.
+    :param precolated_rules: The precolated rules of the grammar the tree was parsed with.
+    :return: The tree, altered in place.
+    """
+    if not precolated_rules:
+        return root
+    node_list = [root]
+    while node_list:
+        node = node_list.pop()
+        if not node.children:
+            continue
+        node_list += node.children
+        rhs_symbols = tuple(NonTerminal(child.tag) if child.children else Terminal(child.tag) for child in
+                            node.children)
+        precolated_rule = precolated_rules.get(Rule(MultiSymbol((NonTerminal(node.tag),)), MultiSymbol(rhs_symbols)))
+        if precolated_rule is None:
+            continue
+        # Insert the chain's intermediate symbols and bottom between the node and it's children
+        bottom = Node(precolated_rule.source.lhs[0].symbol_string, node.children)
+        for symbol in reversed(precolated_rule.chain):
+            bottom = Node(symbol.symbol_string, [bottom])
+        node.children = [bottom]
+    return root
 
 
 if __name__ == '__main__':
@@ -79,6 +79,34 @@ def revert_binarization(root: Node) -> Node:
     return root
 
 
+def project_tag(tag: str) -> str:
+    """
+    Strip the annotations added by binarization from a tag : the parent context is dropped, and "fake" nodes are
+    projected to the tag of the constituent they were created for, followed by the brother separator.
+    e.g S|NP -> NP, S|VP*NP-CC -> S*
+    :param tag: A (possibly) annotated tag.
+    :return: The coarse tag.
+    """
+    parents, _, base_tag = tag.rpartition(parent_separator)
+    if brother_separator not in base_tag:
+        return base_tag
+    return parents.split(join_symbol)[-1] + brother_separator
+
+
+def strip_brother_history(tag: str) -> str:
+    """
+    Strip the history of brothers already generated from "fake" nodes, keeping their parent context and the brothers
+    they still generate. Other tags are kept as is.
+    e.g S|VP*NP-CC -> S|*NP-CC, S|NP -> S|NP
+    :param tag: A (possibly) annotated tag.
+    :return: The coarse tag.
+    """
+    parents, separator, base_tag = tag.rpartition(parent_separator)
+    if brother_separator not in base_tag:
+        return tag
+    return parents + separator + brother_separator + base_tag.partition(brother_separator)[2]
+
+
 if __name__ == '__main__':
     sent = "(TOP (S (yyQUOT yyQUOT) (S (VP (VB THIH)) (NP (NN NQMH)) (CC W) (ADVP (RB BGDWL))) (yyDOT yyDOT)))"
     head = node_tree_from_sequence(sent)